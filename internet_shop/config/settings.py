@@ -14,6 +14,7 @@ import os
 from datetime import timedelta
 from pathlib import Path
 
+from celery.schedules import crontab
 from dotenv import load_dotenv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -105,6 +106,12 @@ else:
         }
     }
 
+CACHE_URL = os.getenv("CACHE_URL")
+if CACHE_URL:
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": CACHE_URL}}
+else:
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -164,6 +171,37 @@ DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379")
 CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", CELERY_BROKER_URL)
 
+PRODUCT_IMPORT_DIR = Path(os.getenv("PRODUCT_IMPORT_DIR", BASE_DIR / "imports"))
+SALES_REPORT_DIR = Path(os.getenv("SALES_REPORT_DIR", BASE_DIR / "reports"))
+PRODUCT_SEARCH_CONFIG = os.getenv("PRODUCT_SEARCH_CONFIG", "russian")
+FACETS_CACHE_TIMEOUT = int(os.getenv("FACETS_CACHE_TIMEOUT", 300))
+PRODUCT_DETAIL_CACHE_TIMEOUT = int(os.getenv("PRODUCT_DETAIL_CACHE_TIMEOUT", 600))
+CATEGORY_TREE_CACHE_TIMEOUT = int(os.getenv("CATEGORY_TREE_CACHE_TIMEOUT", 300))
+CHECKOUT_LOCK_TIMEOUT = os.getenv("CHECKOUT_LOCK_TIMEOUT", "2s")
+CART_BACKEND = os.getenv("CART_BACKEND", "database")
+CART_CACHE_TIMEOUT = int(os.getenv("CART_CACHE_TIMEOUT", 7 * 24 * 3600))
+CART_STOCK_CACHE_TIMEOUT = int(os.getenv("CART_STOCK_CACHE_TIMEOUT", 30))
+CART_BATCH_LIMIT = int(os.getenv("CART_BATCH_LIMIT", 200))
+REVIEW_INGEST_LIMIT = int(os.getenv("REVIEW_INGEST_LIMIT", 10000))
+STOCK_RESERVATION_TTL = int(os.getenv("STOCK_RESERVATION_TTL", 900))
+STOCK_RESERVATION_MAX_TTL = int(os.getenv("STOCK_RESERVATION_MAX_TTL", 86400))
+STOCK_RESERVATION_BATCH_LIMIT = int(os.getenv("STOCK_RESERVATION_BATCH_LIMIT", 5000))
+
+CELERY_BEAT_SCHEDULE = {
+    "release-expired-stock-reservations": {
+        "task": "shop.tasks.release_expired_reservations",
+        "schedule": int(os.getenv("STOCK_RESERVATION_SWEEP_INTERVAL", 60)),
+    },
+    "reconcile-stock-shards": {
+        "task": "shop.tasks.reconcile_stock_shards",
+        "schedule": int(os.getenv("STOCK_SHARD_RECONCILE_INTERVAL", 10)),
+    },
+    "reconcile-carts": {
+        "task": "shop.tasks.reconcile_carts",
+        "schedule": crontab(hour=int(os.getenv("CART_RECONCILE_HOUR", 3)), minute=0),
+    },
+}
+
 SHOW_QUERIES = os.getenv("SHOW_QUERIES") == "TRUE"
 if SHOW_QUERIES:
     LOGGING = {
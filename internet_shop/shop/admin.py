@@ -1,11 +1,19 @@
 from django.contrib import admin
 
 from .models import Cart, CartItems, Product, ProductCategory
+from .stock import StockShardService
 
 
 class ProductAdmin(admin.ModelAdmin):
     model = Product
     exclude = ["price"]
+    # число шардов меняется командой shard_stock: она же переносит остаток между товаром и шардами
+    readonly_fields = ["stock_shards"]
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and obj.stock_shards and "available_quantity" in form.changed_data:
+            StockShardService.set_stock(obj.id, obj.available_quantity)
 
 
 class CartItemsInlineAdmin(admin.TabularInline):
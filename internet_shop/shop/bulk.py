@@ -0,0 +1,160 @@
+import tempfile
+import zlib
+from decimal import Decimal
+from typing import Iterable
+
+from django.db import connections, models, transaction
+from django.db.models import Max
+
+
+class CopyLoader:
+    """
+    Потоковая загрузка моделей через COPY FROM STDIN (PostgreSQL).
+    Строки пишутся в SpooledTemporaryFile и отправляются пачками по batch_size, поэтому память
+    ограничена spool_size. На других СУБД загрузка откатывается на bulk_create.
+    """
+
+    def __init__(
+        self,
+        model: type[models.Model],
+        fields: list[str] | None = None,
+        include_pk: bool = False,
+        using: str = "default",
+        batch_size: int = 100000,
+        spool_size: int = 64 * 1024 * 1024,
+    ):
+        self.model = model
+        self.using = using
+        self.connection = connections[using]
+        self.batch_size = batch_size
+        self.spool_size = spool_size
+        if fields is None:
+            self.fields = [field for field in model._meta.concrete_fields if include_pk or not field.primary_key]
+        else:
+            self.fields = [model._meta.get_field(name) for name in fields]
+
+    @property
+    def is_postgresql(self) -> bool:
+        return self.connection.vendor == "postgresql"
+
+    def reserve_ids(self, count: int) -> list[int]:
+        """
+        Резервирует count первичных ключей заранее, чтобы связанные строки (дети, позиции заказа)
+        можно было сформировать до вставки. Вне PostgreSQL годится только для однопоточной загрузки.
+        """
+        if count <= 0:
+            return []
+        pk_column = self.model._meta.pk.column
+        if self.is_postgresql:
+            with self.connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+                    [self.model._meta.db_table, pk_column, count],
+                )
+                return [row[0] for row in cursor.fetchall()]
+        start = (self.model._default_manager.using(self.using).aggregate(max_id=Max("pk"))["max_id"] or 0) + 1
+        return list(range(start, start + count))
+
+    def load(self, objects: Iterable[models.Model]) -> int:
+        loaded = 0
+        batch = []
+        for obj in objects:
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                loaded += self._flush(batch)
+                batch = []
+        if batch:
+            loaded += self._flush(batch)
+        return loaded
+
+    def _flush(self, batch: list[models.Model]) -> int:
+        if not self.is_postgresql:
+            self.model._default_manager.using(self.using).bulk_create(batch, batch_size=self.batch_size)
+            return len(batch)
+
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_size, mode="w+", newline="") as buffer:
+            for obj in batch:
+                buffer.write(self._format_row(obj))
+            buffer.seek(0)
+            columns = ", ".join(self.connection.ops.quote_name(field.column) for field in self.fields)
+            table = self.connection.ops.quote_name(self.model._meta.db_table)
+            with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+                # copy_expert идёт мимо обёртки курсора Django: ошибки драйвера приводятся к django.db вручную
+                with self.connection.wrap_database_errors:
+                    cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        return len(batch)
+
+    def _format_row(self, obj: models.Model) -> str:
+        """
+        Строка в CSV-формате COPY: NULL - пустое значение без кавычек, строки всегда в кавычках,
+        поэтому пустая строка и NULL различаются.
+        """
+        values = []
+        for field in self.fields:
+            value = getattr(obj, field.attname)
+            if value is None and (getattr(field, "auto_now_add", False) or getattr(field, "auto_now", False)):
+                value = field.pre_save(obj, add=True)
+            value = field.get_db_prep_save(value, connection=self.connection)
+            if value is None or isinstance(value, float) and value != value:
+                values.append("")
+            elif isinstance(value, (bool, int, float, Decimal)):
+                values.append(str(value))
+            else:
+                values.append('"' + str(value).replace('"', '""') + '"')
+        return ",".join(values) + "\n"
+
+
+def assign_tree_fields(nodes: list, start_tree_id: int, order_by: str | None = None) -> int:
+    """
+    Заполняет tree_id/lft/rght/level для новых MPTT-деревьев целиком, без сдвигов в базе.
+    У всех узлов уже должны быть id и parent_id, родитель каждого некорневого узла должен входить в nodes.
+    Возвращает следующий свободный tree_id.
+    """
+    children = {}
+    roots = []
+    ids = {node.id for node in nodes}
+    for node in nodes:
+        if node.parent_id is None:
+            roots.append(node)
+        elif node.parent_id in ids:
+            children.setdefault(node.parent_id, []).append(node)
+        else:
+            raise ValueError(f"родитель узла {node.id} не входит в загружаемые деревья")
+
+    def sort(items):
+        return sorted(items, key=lambda item: getattr(item, order_by)) if order_by else items
+
+    tree_id = start_tree_id
+    for root in sort(roots):
+        counter = 1
+        stack = [(root, 0, False)]
+        while stack:
+            node, level, visited = stack.pop()
+            if visited:
+                node.rght = counter
+                counter += 1
+                continue
+            node.tree_id, node.level, node.lft = tree_id, level, counter
+            counter += 1
+            stack.append((node, level, True))
+            for child in reversed(sort(children.get(node.id, []))):
+                stack.append((child, level + 1, False))
+        tree_id += 1
+    return tree_id
+
+
+def next_tree_id(model: type[models.Model]) -> int:
+    return (model._default_manager.aggregate(max_tree_id=Max("tree_id"))["max_tree_id"] or 0) + 1
+
+
+def lock_tree_ids(model: type[models.Model]) -> None:
+    """
+    Сериализует выдачу tree_id: next_tree_id и MPTT при вставке корня берут max(tree_id) + 1,
+    и без блокировки параллельные транзакции получают одинаковые номера деревьев.
+    Берётся транзакционная advisory-блокировка на таблицу: она нужна только тем, кто создаёт новые деревья,
+    ответы в существующие деревья её не ждут. Вызывается внутри транзакции до чтения max(tree_id).
+    """
+    connection = connections[model._default_manager.db]
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [zlib.crc32(model._meta.db_table.encode())])
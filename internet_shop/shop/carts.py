@@ -0,0 +1,492 @@
+from abc import ABC, abstractmethod
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .models import Cart, CartItems, Product
+from .serializers import CartItemValuesSerializer
+
+
+class CartStore(ABC):
+    """
+    Хранилище корзины пользователя. Каждая операция возвращает корзину целиком
+    в формате {"id", "user", "items"}, items - как у CartItemSerializer.
+    Товар с нулевым остатком не добавляется (ValueError), несуществующий - Product.DoesNotExist.
+    """
+
+    _serializer = None
+
+    @abstractmethod
+    def get(self, user) -> dict:
+        pass
+
+    @abstractmethod
+    def set_item(self, user, product_id: int, quantity: int) -> dict:
+        pass
+
+    @abstractmethod
+    def remove_item(self, user, product_id: int) -> dict:
+        pass
+
+    @abstractmethod
+    def apply(self, user, operations: dict[int, int]) -> dict:
+        """
+        Пакетное изменение {product_id: количество}, количество 0 убирает позицию.
+        Возвращает корзину с дополнительным ключом rejected - отклонённые позиции с причиной.
+        """
+
+    @abstractmethod
+    def clamp(self, user) -> dict:
+        """
+        Урезает количество в позициях до текущего остатка товара.
+        """
+
+    def persist(self, user) -> None:
+        """
+        Переносит корзину в Cart/CartItems перед оформлением заказа.
+        """
+
+    def clear(self, user) -> None:
+        """
+        Очищает корзину после оформления заказа.
+        """
+
+    @classmethod
+    def render(cls, cart_id: int, user_id: int, rows) -> dict:
+        """
+        rows - кортежи (product_name, product_id, product_price, product_available_quantity, quantity, added_at).
+        """
+        if cls._serializer is None:
+            CartStore._serializer = CartItemValuesSerializer()
+        return {"id": cart_id, "user": user_id, "items": cls._serializer.serialize_rows(rows)}
+
+
+class DatabaseCartStore(CartStore):
+    """
+    Корзина в Cart/CartItems. На PostgreSQL каждая операция - одно выражение: корзина создаётся
+    INSERT ... ON CONFLICT DO NOTHING, позиция добавляется INSERT ... ON CONFLICT DO UPDATE
+    с проверкой остатка, а содержимое корзины возвращается тем же запросом.
+    На других СУБД те же операции выполняются несколькими запросами через ORM.
+    """
+
+    CART = """
+        existing AS (SELECT id FROM {cart} WHERE user_id = %(user_id)s),
+        created AS (
+            INSERT INTO {cart} (user_id) SELECT %(user_id)s WHERE NOT EXISTS (SELECT 1 FROM existing)
+            ON CONFLICT (user_id) DO NOTHING RETURNING id
+        ),
+        cart AS (SELECT id FROM existing UNION ALL SELECT id FROM created)
+    """
+    ITEMS = """
+        SELECT cart.id, product.name, product.id, product.price, product.available_quantity,
+               {quantity}, item.added_at, item.id, NULL
+        FROM cart
+        LEFT JOIN {items} item ON item.cart_id = cart.id {exclude}
+        LEFT JOIN {product} product ON product.id = item.product_id
+    """
+
+    def get(self, user) -> dict:
+        if connection.vendor != "postgresql":
+            cart, _ = Cart.objects.get_or_create(user=user)
+            return self.render(cart.id, user.id, self._item_rows(cart.id))
+        return self._execute(user, self._sql(f"WITH {self.CART} {self.ITEMS} ORDER BY 8"), {})
+
+    def set_item(self, user, product_id: int, quantity: int) -> dict:
+        if connection.vendor != "postgresql":
+            return self._set_item_orm(user, product_id, quantity)
+        sql = f"""
+            WITH {self.CART},
+            requested AS (
+                SELECT id, name, price, available_quantity FROM {{product}} WHERE id = %(product_id)s
+            ),
+            upserted AS (
+                INSERT INTO {{items}} (cart_id, product_id, price, quantity, added_at)
+                SELECT cart.id, requested.id, requested.price,
+                       LEAST(%(quantity)s, requested.available_quantity), %(now)s
+                FROM cart, requested WHERE requested.available_quantity > 0
+                ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = EXCLUDED.quantity, price = EXCLUDED.price
+                RETURNING id, quantity, added_at
+            )
+            {self.ITEMS}
+            UNION ALL
+            SELECT cart.id, requested.name, requested.id, requested.price, requested.available_quantity,
+                   upserted.quantity, upserted.added_at, upserted.id, requested.id
+            FROM cart CROSS JOIN requested LEFT JOIN upserted ON true
+            ORDER BY 8
+        """
+        sql = self._sql(sql, exclude="AND item.product_id <> %(product_id)s")
+        params = {"product_id": product_id, "quantity": quantity, "now": timezone.now()}
+        return self._execute(user, sql, params, requested=True)
+
+    def apply(self, user, operations: dict[int, int]) -> dict:
+        if connection.vendor != "postgresql":
+            return self._apply_orm(user, operations)
+        sql = f"""
+            WITH {self.CART},
+            requested AS (
+                SELECT operation.product_id, operation.quantity,
+                       product.name, product.price, product.available_quantity
+                FROM unnest(%(product_ids)s::bigint[], %(quantities)s::integer[]) AS operation(product_id, quantity)
+                LEFT JOIN {{product}} product ON product.id = operation.product_id
+                WHERE operation.quantity > 0
+            ),
+            removed AS (
+                DELETE FROM {{items}}
+                WHERE cart_id IN (SELECT id FROM cart) AND product_id = ANY(%(removed_ids)s::bigint[])
+            ),
+            upserted AS (
+                INSERT INTO {{items}} (cart_id, product_id, price, quantity, added_at)
+                SELECT cart.id, requested.product_id, requested.price,
+                       LEAST(requested.quantity, requested.available_quantity), %(now)s
+                FROM cart, requested WHERE requested.available_quantity > 0
+                ORDER BY requested.product_id
+                ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = EXCLUDED.quantity, price = EXCLUDED.price
+                RETURNING id, product_id, quantity, added_at
+            )
+            {self.ITEMS}
+            UNION ALL
+            SELECT cart.id, requested.name, requested.product_id, requested.price, requested.available_quantity,
+                   upserted.quantity, upserted.added_at, upserted.id, requested.product_id
+            FROM cart CROSS JOIN requested LEFT JOIN upserted ON upserted.product_id = requested.product_id
+            ORDER BY 8
+        """
+        exclude = (
+            "AND item.product_id NOT IN (SELECT product_id FROM upserted)"
+            " AND item.product_id <> ALL(%(removed_ids)s::bigint[])"
+        )
+        params = {
+            "product_ids": list(operations),
+            "quantities": list(operations.values()),
+            "removed_ids": [product_id for product_id, quantity in operations.items() if quantity == 0],
+            "now": timezone.now(),
+        }
+        rows = self._fetch(user, self._sql(sql, exclude=exclude), params)
+        rejected = []
+        for row in rows:
+            if row[8] is None or row[7] is not None:
+                continue
+            rejected.append(
+                {"product_id": row[8], "error": "product not found" if row[1] is None else "not enough product"}
+            )
+        cart = self.render(rows[0][0], user.id, [row[1:7] for row in rows if row[7] is not None])
+        return {**cart, "rejected": rejected}
+
+    def remove_item(self, user, product_id: int) -> dict:
+        if connection.vendor != "postgresql":
+            cart, _ = Cart.objects.get_or_create(user=user)
+            CartItems.objects.filter(cart=cart, product_id=product_id).delete()
+            return self.render(cart.id, user.id, self._item_rows(cart.id))
+        sql = f"""
+            WITH {self.CART},
+            removed AS (
+                DELETE FROM {{items}} WHERE cart_id IN (SELECT id FROM cart) AND product_id = %(product_id)s
+            )
+            {self.ITEMS}
+            ORDER BY 8
+        """
+        sql = self._sql(sql, exclude="AND item.product_id <> %(product_id)s")
+        return self._execute(user, sql, {"product_id": product_id})
+
+    def clamp(self, user) -> dict:
+        if connection.vendor != "postgresql":
+            cart, _ = Cart.objects.get_or_create(user=user)
+            CartReconciliationService.reconcile_cart(cart.id)
+            return self.render(cart.id, user.id, self._item_rows(cart.id))
+        sql = f"""
+            WITH {self.CART},
+            clamped AS (
+                {CartReconciliationService.UPDATE.replace("{where}", "item.cart_id IN (SELECT id FROM cart)")}
+                RETURNING item.id, item.quantity
+            )
+            {self.ITEMS}
+            LEFT JOIN clamped ON clamped.id = item.id
+            ORDER BY 8
+        """
+        return self._execute(user, self._sql(sql, quantity="COALESCE(clamped.quantity, item.quantity)"), {})
+
+    @staticmethod
+    def _sql(template: str, quantity: str = "item.quantity", exclude: str = "") -> str:
+        quote = connection.ops.quote_name
+        return template.format(
+            cart=quote(Cart._meta.db_table),
+            items=quote(CartItems._meta.db_table),
+            product=quote(Product._meta.db_table),
+            quantity=quantity,
+            exclude=exclude,
+        )
+
+    def _fetch(self, user, sql: str, params: dict, retry: bool = True) -> list[tuple]:
+        """
+        Строки результата: (id корзины, 6 полей позиции, id позиции, маркер запрошенного товара).
+        Пустая корзина даёт одну строку с NULL в полях позиции.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {"user_id": user.id, **params})
+            rows = cursor.fetchall()
+        if not rows and retry:
+            # корзину одновременно создал параллельный запрос: её строка не видна в снимке этого выражения
+            return self._fetch(user, sql, params, retry=False)
+        return rows
+
+    def _execute(self, user, sql: str, params: dict, requested: bool = False) -> dict:
+        rows = self._fetch(user, sql, params)
+        if requested:
+            product_rows = [row for row in rows if row[8] is not None]
+            if not product_rows:
+                raise Product.DoesNotExist
+            if product_rows[0][7] is None:
+                raise ValueError("not enough product")
+        return self.render(rows[0][0], user.id, [row[1:7] for row in rows if row[7] is not None])
+
+    def _set_item_orm(self, user, product_id: int, quantity: int) -> dict:
+        product = Product.objects.get(id=product_id)
+        if product.available_quantity == 0:
+            raise ValueError("not enough product")
+        cart, _ = Cart.objects.get_or_create(user=user)
+        CartItems.objects.update_or_create(
+            cart=cart,
+            product=product,
+            defaults={"quantity": min(quantity, product.available_quantity), "price": product.price},
+        )
+        return self.render(cart.id, user.id, self._item_rows(cart.id))
+
+    @transaction.atomic
+    def _apply_orm(self, user, operations: dict[int, int]) -> dict:
+        cart, _ = Cart.objects.get_or_create(user=user)
+        products = Product.objects.filter(
+            id__in=[product_id for product_id, quantity in operations.items() if quantity]
+        )
+        products = {
+            product_id: (price, available)
+            for product_id, price, available in products.values_list("id", "price", "available_quantity")
+        }
+        existing = {item.product_id: item for item in CartItems.objects.filter(cart=cart, product_id__in=operations)}
+        created, updated, removed, rejected = [], [], [], []
+        for product_id, quantity in operations.items():
+            if quantity == 0:
+                removed.append(product_id)
+                continue
+            if product_id not in products:
+                rejected.append({"product_id": product_id, "error": "product not found"})
+                continue
+            price, available_quantity = products[product_id]
+            if available_quantity == 0:
+                rejected.append({"product_id": product_id, "error": "not enough product"})
+                continue
+            item = existing.get(product_id) or CartItems(cart=cart, product_id=product_id)
+            item.quantity, item.price = min(quantity, available_quantity), price
+            (updated if item.pk else created).append(item)
+        if removed:
+            CartItems.objects.filter(cart=cart, product_id__in=removed).delete()
+        CartItems.objects.bulk_create(created)
+        CartItems.objects.bulk_update(updated, ["quantity", "price"])
+        return {**self.render(cart.id, user.id, self._item_rows(cart.id)), "rejected": rejected}
+
+    @staticmethod
+    def _item_rows(cart_id: int):
+        return (
+            CartItems.objects.filter(cart_id=cart_id)
+            .order_by("id")
+            .values_list(
+                "product__name", "product_id", "product__price", "product__available_quantity", "quantity", "added_at"
+            )
+        )
+
+
+class CacheCartStore(CartStore):
+    """
+    Корзина в кэше (Redis при заданном CACHE_URL): {"id": id корзины, "items": {product_id: [количество, added_at]}}.
+    Остаток и цена проверяются по кэшированным снимкам товаров, которые живут CART_STOCK_CACHE_TIMEOUT секунд,
+    поэтому в устойчивом режиме операции не обращаются к базе; при оформлении заказа остаток всё равно
+    перепроверяется под блокировкой. В Cart/CartItems корзина переносится методом persist.
+    Изменения корзины одного пользователя не атомарны: при параллельных запросах побеждает последний.
+    Вытесненная из кэша корзина откатывается к состоянию в базе, поэтому Redis нужен с политикой без вытеснения.
+    """
+
+    key_prefix = "cart"
+
+    def get(self, user) -> dict:
+        return self._render(user, self._load(user))
+
+    def set_item(self, user, product_id: int, quantity: int) -> dict:
+        product = self._products([product_id]).get(product_id)
+        if product is None:
+            raise Product.DoesNotExist
+        if product[2] == 0:
+            raise ValueError("not enough product")
+        data = self._load(user)
+        _, added_at = data["items"].get(product_id, (None, timezone.now()))
+        data["items"][product_id] = (min(quantity, product[2]), added_at)
+        self._save(user, data)
+        return self._render(user, data)
+
+    def apply(self, user, operations: dict[int, int]) -> dict:
+        products = self._products([product_id for product_id, quantity in operations.items() if quantity])
+        data = self._load(user)
+        rejected = []
+        now = timezone.now()
+        for product_id, quantity in operations.items():
+            if quantity == 0:
+                data["items"].pop(product_id, None)
+            elif product_id not in products:
+                rejected.append({"product_id": product_id, "error": "product not found"})
+            elif products[product_id][2] == 0:
+                rejected.append({"product_id": product_id, "error": "not enough product"})
+            else:
+                _, added_at = data["items"].get(product_id, (None, now))
+                data["items"][product_id] = (min(quantity, products[product_id][2]), added_at)
+        self._save(user, data)
+        return {**self._render(user, data), "rejected": rejected}
+
+    def remove_item(self, user, product_id: int) -> dict:
+        data = self._load(user)
+        if data["items"].pop(product_id, None) is not None:
+            self._save(user, data)
+        return self._render(user, data)
+
+    def clamp(self, user) -> dict:
+        data = self._load(user)
+        products = self._products(data["items"])
+        changed = False
+        for product_id, (quantity, added_at) in data["items"].items():
+            available = products[product_id][2] if product_id in products else 0
+            if quantity > available:
+                data["items"][product_id] = (available, added_at)
+                changed = True
+        if changed:
+            self._save(user, data)
+        return self._render(user, data, products)
+
+    @transaction.atomic
+    def persist(self, user) -> None:
+        data = self._load(user)
+        products = self._products(data["items"])
+        CartItems.objects.filter(cart_id=data["id"]).delete()
+        CartItems.objects.bulk_create(
+            [
+                CartItems(
+                    cart_id=data["id"],
+                    product_id=product_id,
+                    price=products[product_id][1] if product_id in products else None,
+                    quantity=quantity,
+                    added_at=added_at,
+                )
+                for product_id, (quantity, added_at) in data["items"].items()
+            ]
+        )
+
+    def clear(self, user) -> None:
+        data = self._load(user)
+        data["items"] = {}
+        self._save(user, data)
+
+    def _load(self, user) -> dict:
+        data = cache.get(self._key(user.id))
+        if data is None:
+            # первое обращение: корзина подхватывается из базы
+            cart, _ = Cart.objects.get_or_create(user=user)
+            items = CartItems.objects.filter(cart=cart).order_by("id").values_list("product_id", "quantity", "added_at")
+            data = {
+                "id": cart.id,
+                "items": {product_id: (quantity, added_at) for product_id, quantity, added_at in items},
+            }
+            self._save(user, data)
+        return data
+
+    def _save(self, user, data: dict) -> None:
+        cache.set(self._key(user.id), data, settings.CART_CACHE_TIMEOUT)
+
+    def _render(self, user, data: dict, products: dict | None = None) -> dict:
+        products = self._products(data["items"]) if products is None else products
+        rows = []
+        for product_id, (quantity, added_at) in data["items"].items():
+            if product_id in products:
+                name, price, available_quantity = products[product_id]
+                rows.append((name, product_id, price, available_quantity, quantity, added_at))
+        return self.render(data["id"], user.id, rows)
+
+    def _products(self, product_ids) -> dict[int, tuple[str, Decimal, int]]:
+        """
+        Снимки товаров {product_id: (name, price, available_quantity)}: один запрос к кэшу
+        и один к базе на все промахи.
+        """
+        keys = {self._product_key(product_id): product_id for product_id in product_ids}
+        products = {keys[key]: value for key, value in cache.get_many(keys).items()}
+        missing = [product_id for product_id in keys.values() if product_id not in products]
+        if missing:
+            fetched = {
+                product_id: (name, price, available_quantity)
+                for product_id, name, price, available_quantity in Product.objects.filter(id__in=missing).values_list(
+                    "id", "name", "price", "available_quantity"
+                )
+            }
+            cache.set_many(
+                {self._product_key(product_id): value for product_id, value in fetched.items()},
+                settings.CART_STOCK_CACHE_TIMEOUT,
+            )
+            products.update(fetched)
+        return products
+
+    def _key(self, user_id: int) -> str:
+        return f"{self.key_prefix}:{user_id}"
+
+    def _product_key(self, product_id: int) -> str:
+        return f"{self.key_prefix}:product:{product_id}"
+
+
+class CartReconciliationService:
+    """
+    Сверка позиций корзин с товарами одним UPDATE ... FROM product: количество урезается до остатка,
+    цена обновляется до текущей. Меняются только расходящиеся строки.
+    """
+
+    UPDATE = """
+        UPDATE {items} AS item
+        SET quantity = CASE WHEN item.quantity > product.available_quantity
+                            THEN product.available_quantity ELSE item.quantity END,
+            price = product.price
+        FROM {product} AS product
+        WHERE {where} AND product.id = item.product_id
+          AND (item.quantity > product.available_quantity OR item.price IS NULL OR item.price <> product.price)
+    """
+
+    @classmethod
+    def reconcile_cart(cls, cart_id: int) -> int:
+        return cls._update("item.cart_id = %(cart_id)s", {"cart_id": cart_id})
+
+    @classmethod
+    def reconcile(cls, start_id: int, end_id: int) -> int:
+        """
+        Сверка позиций всех корзин с id позиции в диапазоне [start_id, end_id).
+        """
+        return cls._update("item.id >= %(start_id)s AND item.id < %(end_id)s", {"start_id": start_id, "end_id": end_id})
+
+    @staticmethod
+    def batches(batch_size: int) -> range:
+        """
+        Начала диапазонов id позиций корзин для reconcile.
+        """
+        bounds = CartItems.objects.aggregate(min_id=Min("id"), max_id=Max("id"))
+        if bounds["min_id"] is None:
+            return range(0)
+        return range(bounds["min_id"], bounds["max_id"] + 1, batch_size)
+
+    @classmethod
+    def _update(cls, where: str, params: dict) -> int:
+        with connection.cursor() as cursor:
+            cursor.execute(DatabaseCartStore._sql(cls.UPDATE.replace("{where}", where)), params)
+            return cursor.rowcount
+
+
+class CartStoreFactory:
+    STORES = {"database": DatabaseCartStore(), "cache": CacheCartStore()}
+
+    @classmethod
+    def get_store(cls) -> CartStore:
+        if settings.CART_BACKEND not in cls.STORES:
+            raise ValueError(f"неизвестное хранилище корзины: {settings.CART_BACKEND}")
+        return cls.STORES[settings.CART_BACKEND]
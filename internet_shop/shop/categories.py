@@ -0,0 +1,126 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+
+from .models import ProductCategory
+
+
+class CategoryTreeService:
+    """
+    Вложенное дерево категорий с количеством товаров в узле и во всём поддереве.
+    Дерево лежит в общем кэше под ключом с версией и дублируется в памяти процесса;
+    запись категории увеличивает версию, локальная копия сверяется с ней на каждом обращении.
+    Множества id поддеревьев считаются по локальной копии один раз и запоминаются до смены версии.
+    """
+
+    key_prefix = "category-tree"
+    _local = {"version": None, "expires_at": 0.0, "roots": [], "nodes": {}, "descendants": {}}
+
+    @classmethod
+    def get_tree(cls) -> list[dict]:
+        return cls._load()["roots"]
+
+    @classmethod
+    def get_node(cls, category_id: int) -> dict | None:
+        return cls._load()["nodes"].get(category_id)
+
+    @classmethod
+    def get_descendant_ids(cls, category_id: int) -> list[int] | None:
+        """
+        id категории и всех её потомков; None, если категории нет.
+        """
+        local = cls._load()
+        if category_id not in local["descendants"]:
+            node = local["nodes"].get(category_id)
+            if node is None:
+                return None
+            ids = []
+            stack = [node]
+            while stack:
+                current = stack.pop()
+                ids.append(current["id"])
+                stack.extend(current["children"])
+            local["descendants"][category_id] = ids
+        return local["descendants"][category_id]
+
+    @classmethod
+    def get_subtree_ids(cls, category_ids) -> set[int]:
+        subtree_ids = set()
+        for category_id in category_ids:
+            subtree_ids.update(cls.get_descendant_ids(category_id) or ())
+        return subtree_ids
+
+    @classmethod
+    def invalidate(cls) -> None:
+        def bump_version():
+            try:
+                cache.incr(cls._version_key())
+            except ValueError:
+                pass
+
+        transaction.on_commit(bump_version)
+
+    @classmethod
+    def _version_key(cls) -> str:
+        return f"{cls.key_prefix}:version"
+
+    @classmethod
+    def _load(cls) -> dict:
+        version = cache.get_or_set(cls._version_key(), time.time_ns, timeout=None)
+        local = cls._local
+        if local["version"] == version and local["expires_at"] > time.monotonic():
+            return local
+
+        tree_key = f"{cls.key_prefix}:{version}"
+        roots = cache.get(tree_key)
+        if roots is None:
+            roots = cls._build()
+            cache.set(tree_key, roots, settings.CATEGORY_TREE_CACHE_TIMEOUT)
+
+        nodes = {}
+        stack = list(roots)
+        while stack:
+            node = stack.pop()
+            nodes[node["id"]] = node
+            stack.extend(node["children"])
+        cls._local = {
+            "version": version,
+            "expires_at": time.monotonic() + settings.CATEGORY_TREE_CACHE_TIMEOUT,
+            "roots": roots,
+            "nodes": nodes,
+            "descendants": {},
+        }
+        return cls._local
+
+    @staticmethod
+    def _build() -> list[dict]:
+        rows = (
+            ProductCategory.objects.annotate(product_count=Count("products"))
+            .values("id", "name", "parent_id", "product_count")
+            .order_by("tree_id", "lft")
+        )
+        nodes = {}
+        roots = []
+        for row in rows:
+            node = {
+                "id": row["id"],
+                "name": row["name"],
+                "parent": row["parent_id"],
+                "product_count": row["product_count"],
+                "total_product_count": row["product_count"],
+                "children": [],
+            }
+            nodes[node["id"]] = node
+            if node["parent"] is None:
+                roots.append(node)
+            else:
+                nodes[node["parent"]]["children"].append(node)
+
+        # в порядке (tree_id, lft) потомки идут после предков, поэтому обратный проход суммирует снизу вверх
+        for node in reversed(list(nodes.values())):
+            if node["parent"] is not None:
+                nodes[node["parent"]]["total_product_count"] += node["total_product_count"]
+        return roots
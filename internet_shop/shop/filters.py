@@ -1,16 +1,27 @@
 import json
 
 import django_filters
+from django.conf import settings
 from django.contrib.postgres.search import (
     SearchQuery,
     SearchRank,
-    SearchVector,
     TrigramWordSimilarity,
 )
-from django.db.models import Avg, Count, F, Q, Sum
+from django.db.models import Avg, Count, DecimalField, ExpressionWrapper, F, Q, Sum
+from django.db.models.functions import Greatest
 from django_filters.rest_framework import FilterSet
 
-from .models import OrderItems, Product, ProductCategory
+from .categories import CategoryTreeService
+from .models import (
+    CategoryDailySales,
+    DailySalesRollup,
+    OrderItems,
+    Product,
+    ProductCategory,
+    ProductDailySales,
+    UserDailySales,
+)
+from .services import AttributeIndexService
 
 
 class SalesStatisticsFilter(FilterSet):
@@ -28,28 +39,123 @@ class SalesStatisticsFilter(FilterSet):
         fields = ["date_range", "category", "manufacturer", "price_range", "user", "rating_min"]
 
 
+class SalesRollupFilter(FilterSet):
+    product_id = django_filters.NumberFilter(field_name="product_id", lookup_expr="exact")
+    date_range = django_filters.DateFromToRangeFilter(field_name="date")
+    category = django_filters.NumberFilter(field_name="category_id", lookup_expr="exact")
+    rating_min = django_filters.NumberFilter(field_name="rating", lookup_expr="gte", required=False)
+    total_orders_min = django_filters.NumberFilter(field_name="total_orders", lookup_expr="gte")
+    user = django_filters.NumberFilter(field_name="user_id", lookup_expr="exact")
+
+    class Meta:
+        model = DailySalesRollup
+        fields = ["product_id", "date_range", "category", "rating_min", "total_orders_min", "user"]
+
+
 class SalesStatisticsQueryBuilder:
+    """
+    Статистика продаж всегда группируется по дню. Если группировку и фильтры можно получить из дневных агрегатов,
+    запрос идёт в самую грубую подходящую таблицу, иначе - по строкам OrderItems.
+    Таблица подходит, только если её ключ входит в группировку: иначе сумма order_count посчитала бы
+    один заказ несколько раз. Исключение - агрегаты по пользователям, так как заказ принадлежит одному пользователю.
+    """
+
+    rollups = [
+        {"model": CategoryDailySales, "group_by": {"category"}, "required": {"category"}, "filters": {"category"}},
+        {"model": UserDailySales, "group_by": {"user"}, "required": set(), "filters": {"user"}},
+        {
+            "model": ProductDailySales,
+            "group_by": {"product", "category", "discount"},
+            "required": {"product"},
+            "filters": {"product_id", "category", "rating_min"},
+        },
+    ]
+    rollup_common_filters = {"date_range", "total_orders_min"}
+    rollup_group_by_mapping = {
+        "date": {"field": "date", "annotations": {}},
+        "category": {"field": "category_id", "annotations": {"category_name": F("category__name")}},
+        "product": {
+            "field": "product_id",
+            "annotations": {"product_name": F("product__name"), "rating": F("product__stats__average_rating")},
+        },
+        "discount": {"field": "product__discount", "annotations": {}},
+        "user": {"field": "user_id", "annotations": {"user_email": F("user__email")}},
+    }
+
     def __init__(self, params):
         self.params = params
         self.group_by_fields = []
         self.queryset = OrderItems.objects.annotate()
+        self.filterset_class = SalesStatisticsFilter
 
     def get_queryset(self):
+        rollup = self._get_rollup()
+        if rollup is not None:
+            self.filterset_class = SalesRollupFilter
+            return self._get_rollup_queryset(rollup["model"]).order_by("date")
+
         self._add_group_by_fields()
         self._add_rating()
         self._add_aggregations()
 
         return self.queryset.order_by("date")
 
+    def _get_group_by_params(self) -> set[str]:
+        group_by_param = self.params.get("group_by", "")
+        return set(group_by_param.split(",")) - {"", "date"} if group_by_param else set()
+
+    def _get_used_filters(self) -> set[str]:
+        used = set()
+        for name in SalesStatisticsFilter.base_filters:
+            if any(value for key, value in self.params.items() if key == name or key.startswith(f"{name}_")):
+                used.add(name)
+        return used
+
+    def _get_rollup(self) -> dict | None:
+        group_by = self._get_group_by_params()
+        used_filters = self._get_used_filters()
+        for rollup in self.rollups:
+            if (
+                group_by <= rollup["group_by"]
+                and rollup["required"] <= group_by
+                and used_filters <= rollup["filters"] | self.rollup_common_filters
+            ):
+                return rollup
+        return None
+
+    def _get_rollup_queryset(self, model):
+        fields = []
+        annotations = {}
+        for name in ["date", *sorted(self._get_group_by_params())]:
+            mapping = self.rollup_group_by_mapping[name]
+            fields.append(mapping["field"])
+            annotations.update(mapping["annotations"])
+
+        # avg_check идёт первым: после аннотации total_sales имя поля перекрывается агрегатом
+        aggregations = {
+            "avg_check": ExpressionWrapper(
+                Sum("total_sales") / Sum("line_count"), output_field=DecimalField(max_digits=20, decimal_places=2)
+            ),
+            "total_orders": Sum("order_count"),
+            "total_sales": Sum("total_sales"),
+            "total_discount": Sum("total_discount"),
+        }
+        if model is ProductDailySales:
+            aggregations["product_quantity"] = Sum("quantity")
+        return model.objects.annotate(**annotations).values(*fields, *annotations).annotate(**aggregations)
+
     def _add_group_by_fields(self):
 
         group_by_mapping = {
-            "category": {"field": "product__category", "annotations": {"category_name": F("product__category__name")}},
+            "category": {
+                "field": "product__category",
+                "annotations": {"category_name": F("product__category__name"), "category_id": F("product__category")},
+            },
             "manufacturer": {"field": "product__manufacturer", "annotations": {}},
             "date": {"field": "order__created_at", "annotations": {}},
             "product": {
                 "field": "product_id",
-                "annotations": {"product_name": F("product__name"), "product_quantity": F("quantity")},
+                "annotations": {"product_name": F("product__name")},
             },
             "discount": {"field": "product__discount", "annotations": {}},
             "user": {
@@ -74,7 +180,7 @@ class SalesStatisticsQueryBuilder:
             self.group_by_fields = ["order__created_at"]
 
     def _add_rating(self):
-        self.queryset = self.queryset.annotate(rating=Avg("product__reviews__rating"))
+        self.queryset = self.queryset.annotate(rating=Avg("product__stats__average_rating"))
 
     def _add_aggregations(self):
         self.queryset = self.queryset.annotate(**self.additional_annotations)
@@ -88,29 +194,37 @@ class SalesStatisticsQueryBuilder:
             avg_check=Avg(F("price") * F("quantity")),
             date=F("order__created_at"),
         )
+        if "product_id" in self.group_by_fields:
+            self.queryset = self.queryset.annotate(product_quantity=Sum("quantity"))
 
 
 class ProductFilter(FilterSet):
     min_comments = django_filters.NumberFilter(
-        field_name="_comment_count", lookup_expr="gte", label="Минимум комментариев"
+        field_name="stats__comment_count", lookup_expr="gte", label="Минимум комментариев"
     )
     min_rating = django_filters.NumberFilter(
-        field_name="average_rating", lookup_expr="gte", label="Минимальный рейтинг"
+        field_name="stats__average_rating", lookup_expr="gte", label="Минимальный рейтинг"
     )
     search = django_filters.CharFilter(method="search_with_trigram")
     search_vector = django_filters.CharFilter(method="search_with_vector")
     filters = django_filters.CharFilter(method="apply_eav_filters", label="Дополнительные фильтры")
     ordering = django_filters.OrderingFilter(
         fields=(
-            ("popularity", "popularity"),
-            ("rating", "rating"),
+            ("stats__popularity", "popularity"),
+            ("stats__average_rating", "rating"),
+            ("price", "price"),
+            ("id", "id"),
         ),
         field_labels={
             "popularity": "Популярность",
             "rating": "Рейтинг",
+            "price": "Цена",
+            "id": "Новизна",
         },
     )
 
+    trigram_candidate_limit = 1000
+
     class Meta:
         model = Product
         fields = ["min_comments", "min_rating", "filters", "search"]
@@ -124,56 +238,44 @@ class ProductFilter(FilterSet):
             "similarity_description": "description",
         }
 
-        similar_categories = ProductCategory.objects.annotate(similarity=TrigramWordSimilarity(value, "name")).filter(
-            name__trigram_word_similar=value
+        matched_category_ids = ProductCategory.objects.filter(name__trigram_word_similar=value).values_list(
+            "id", flat=True
         )
-        categories_list = []
-
-        if similar_categories.exists():
-            for category in similar_categories:
-                descendant = category.get_descendants(include_self=True)
-                if descendant:
-                    categories_list.append(descendant)
-
-        categories_list = set([category.id for category_object in categories_list for category in category_object])
+        subtree_ids = CategoryTreeService.get_subtree_ids(matched_category_ids)
 
         for alias, field in similarity_fields.items():
             queryset = queryset.annotate(**{alias: TrigramWordSimilarity(value, field)})
 
-        trigram_filters = Q()
+        # кандидаты берутся из уже отфильтрованной выборки и режутся по лимиту после сортировки по сходству,
+        # иначе в лимит попадают случайные строки, а лучшие совпадения теряются
+        candidate_ids = (
+            queryset.filter(
+                Q(name__trigram_word_similar=value)
+                | Q(description__trigram_word_similar=value)
+                | Q(category_id__in=subtree_ids)
+            )
+            .alias(similarity=Greatest("similarity_name", "similarity_description"))
+            .order_by("-similarity", "id")
+            .values("id")[: self.trigram_candidate_limit]
+        )
 
-        for alias in similarity_fields:
-            trigram_filters |= Q(**{f"{alias}__gt": 0.4})
+        queryset = queryset.filter(id__in=candidate_ids)
 
-        queryset = queryset.filter(
-            Q(name__trigram_word_similar=value)
-            | Q(description__trigram_word_similar=value)
-            | Q(category__in=categories_list)
-        ).order_by(
+        return queryset.order_by(
             "-similarity_name",
             "-similarity_description",
         )
 
-        return queryset
-
     def search_with_vector(self, queryset, name, value):
         if not value:
             return queryset
 
+        query = SearchQuery(value, config=settings.PRODUCT_SEARCH_CONFIG)
         queryset = (
-            queryset.annotate(
-                search=SearchVector(
-                    "name",
-                    "description",
-                    "category__name",
-                    "category__parent__name",
-                ),
-                rank=SearchRank(F("search"), SearchQuery(value)),
-            )
-            .filter(search=SearchQuery(value))
+            queryset.filter(search_document=query)
+            .annotate(rank=SearchRank(F("search_document"), query))
             .order_by("-rank")
         )
-        print(queryset.explain(analyze=True))
         return queryset
 
     def apply_eav_filters(self, queryset, name, value):
@@ -191,18 +293,22 @@ class ProductFilter(FilterSet):
 
             match data_type:
                 case "text" | "enum":
-                    key = attr_name if attr_name in fields else f"eav__{attr_name}"
-                    query &= Q(**{f"{key}__in": value})
+                    if attr_name in fields:
+                        query &= Q(**{f"{attr_name}__in": value})
+                    else:
+                        query &= AttributeIndexService.text_filter(attr_name, value)
                 case "number":
                     gte = value.get("gte")
                     lte = value.get("lte")
-                    key = attr_name if attr_name in fields else f"eav__{attr_name}"
                     self.validate_gte_and_lte(gte, lte)
+                    if attr_name not in fields:
+                        query &= AttributeIndexService.number_filter(attr_name, gte=gte, lte=lte)
+                        continue
                     range_filters = {}
                     if gte is not None:
-                        range_filters[f"{key}__gte"] = float(gte)
+                        range_filters[f"{attr_name}__gte"] = float(gte)
                     if lte is not None:
-                        range_filters[f"{key}__lte"] = float(lte)
+                        range_filters[f"{attr_name}__lte"] = float(lte)
                     if range_filters:
                         query &= Q(**range_filters)
 
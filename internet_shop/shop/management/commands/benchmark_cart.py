@@ -0,0 +1,75 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+from shop.models import Cart, Product, ProductCategory
+from shop.views import CartViewSet
+
+
+class Command(BaseCommand):
+    help = "Cart mutations: N requests to /cart/item/ against one request to /cart/items/ with the same N operations"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--items", default="5,20,100", help="Операций в корзине, через запятую")
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--products", type=int, default=500)
+
+    def handle(self, *args, **options):
+        category = ProductCategory.objects.create(name=f"benchmark-cart-{time.time_ns()}")
+        products = Product.objects.bulk_create(
+            [
+                Product(category=category, name=f"product {number}", old_price=1, discount=0, price=1)
+                for number in range(options["products"])
+            ]
+        )
+        product_ids = [product.id for product in products]
+        Product.objects.filter(id__in=product_ids).update(available_quantity=100)
+        user = User.objects.create_user(username=category.name)
+        factory = APIRequestFactory()
+        item_view = CartViewSet.as_view({"post": "item", "delete": "item"})
+        items_view = CartViewSet.as_view({"post": "items"})
+
+        def per_item(operations):
+            for product_id, quantity in operations:
+                method = factory.post if quantity else factory.delete
+                request = method("/shop/cart/item/", {"product_id": product_id, "quantity": quantity}, format="json")
+                force_authenticate(request, user)
+                item_view(request)
+
+        def batch(operations):
+            items = [{"product_id": product_id, "quantity": quantity} for product_id, quantity in operations]
+            request = factory.post("/shop/cart/items/", {"items": items}, format="json")
+            force_authenticate(request, user)
+            items_view(request)
+
+        for size in [int(size) for size in options["items"].split(",")]:
+            for name, path in (("по одной", per_item), ("пакетом", batch)):
+                elapsed, queries = 0.0, 0
+                for _ in range(options["repeat"]):
+                    Cart.objects.filter(user=user).delete()
+                    sample = random.sample(product_ids, size)
+                    half, three_quarters = size // 2, size // 2 + size // 4
+                    # добавление, затем изменение половины позиций и удаление четверти
+                    rounds = [
+                        [(product_id, random.randint(1, 5)) for product_id in sample],
+                        [(product_id, random.randint(1, 5)) for product_id in sample[:half]]
+                        + [(product_id, 0) for product_id in sample[half:three_quarters]],
+                    ]
+                    for operations in rounds:
+                        with CaptureQueriesContext(connection) as context:
+                            started = time.perf_counter()
+                            path(operations)
+                            elapsed += time.perf_counter() - started
+                        queries += len(context)
+                self.stdout.write(
+                    f"{size} операций {name}: {elapsed / options['repeat'] * 1000:.2f} ms, "
+                    f"{queries / options['repeat']:.0f} запросов к базе на корзину"
+                )
+
+        user.delete()
+        Product.objects.filter(category=category).delete()
+        category.delete()
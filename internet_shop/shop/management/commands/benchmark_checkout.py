@@ -0,0 +1,108 @@
+import random
+import statistics
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.exceptions import ValidationError
+from shop.models import Cart, CartItems, Order, Product, ProductCategory, UserBalance
+from shop.services import OrderService, PaymentProcessor
+from shop.stock import StockShardService
+
+
+class Command(BaseCommand):
+    help = "Concurrent checkouts against a few hot products: throughput, latency and final stock consistency"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--orders", type=int, default=25, help="Оформлений на поток")
+        parser.add_argument("--products", type=int, default=3, help="Количество горячих товаров")
+        parser.add_argument("--stock", type=int, default=1000)
+        parser.add_argument("--shards", type=int, default=0, help="Шардов остатка на товар, 0 - без шардирования")
+
+    def handle(self, *args, **options):
+        category = ProductCategory.objects.create(name=f"benchmark-checkout-{time.time_ns()}")
+        products = Product.objects.bulk_create(
+            [
+                Product(
+                    category=category,
+                    name=f"hot product {number}",
+                    old_price=1,
+                    discount=0,
+                    price=1,
+                    available_quantity=options["stock"],
+                )
+                for number in range(options["products"])
+            ]
+        )
+        if options["shards"]:
+            for product in products:
+                StockShardService.enable(product.id, options["shards"])
+        users = []
+        for number in range(options["threads"]):
+            user = User.objects.create_user(username=f"{category.name}-{number}")
+            UserBalance.objects.update_or_create(user=user, defaults={"balance": 10**9})
+            users.append(user)
+
+        timings, ordered, rejected = [], [], []
+        lock = threading.Lock()
+
+        def worker(user):
+            cart, _ = Cart.objects.get_or_create(user=user)
+            try:
+                for _ in range(options["orders"]):
+                    CartItems.objects.bulk_create(
+                        [
+                            CartItems(cart=cart, product=product, price=product.price, quantity=random.randint(1, 3))
+                            for product in random.sample(products, random.randint(1, len(products)))
+                        ]
+                    )
+                    started = time.perf_counter()
+                    try:
+                        order = OrderService(user, PaymentProcessor()).create_order()
+                    except ValidationError:
+                        CartItems.objects.filter(cart=cart).delete()
+                        with lock:
+                            rejected.append(1)
+                        continue
+                    elapsed = (time.perf_counter() - started) * 1000
+                    quantity = sum(order.items.values_list("quantity", flat=True))
+                    with lock:
+                        timings.append(elapsed)
+                        ordered.append(quantity)
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        StockShardService.reconcile()
+        remaining = sum(
+            Product.objects.filter(id__in=[product.id for product in products]).values_list(
+                "available_quantity", flat=True
+            )
+        )
+        expected = options["stock"] * len(products) - sum(ordered)
+        timings.sort()
+        if timings:
+            p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+            self.stdout.write(
+                f"{len(timings)} заказов за {elapsed:.2f} s ({len(timings) / elapsed:.1f} заказов/с), "
+                f"отказов {len(rejected)}; p50 {statistics.median(timings):.2f} ms, p99 {p99:.2f} ms"
+            )
+        if remaining == expected:
+            self.stdout.write(self.style.SUCCESS(f"Остаток сходится: {remaining}"))
+        else:
+            self.stderr.write(f"Остаток {remaining}, ожидалось {expected}")
+
+        Order.objects.filter(user__in=users).delete()
+        Product.objects.filter(category=category).delete()
+        User.objects.filter(id__in=[user.id for user in users]).delete()
+        category.delete()
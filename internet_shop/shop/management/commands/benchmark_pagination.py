@@ -0,0 +1,76 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from shop.pagination import ProductKeysetPagination
+from shop.views import ProductViewSet
+
+
+class Command(BaseCommand):
+    help = "Compare page-number and keyset pagination latency of the product list at different depths"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pages", type=int, nargs="+", default=[1, 1000, 100000])
+        parser.add_argument("--page-size", type=int, default=10)
+        parser.add_argument("--ordering", default="-popularity")
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        factory = APIRequestFactory(SERVER_NAME="localhost")
+        view = ProductViewSet.as_view({"get": "list"})
+        page_size = options["page_size"]
+        ordering = options["ordering"]
+
+        for page in options["pages"]:
+            page_params = {"page": page, "page_size": page_size, "ordering": ordering}
+            page_timings = self._measure(view, factory, page_params, options["repeat"])
+
+            cursor_params = {"pagination": "cursor", "page_size": page_size, "ordering": ordering}
+            if page > 1:
+                cursor = self._cursor_for_page(factory, page, page_size, ordering)
+                if cursor is None:
+                    self.stderr.write(f"Страница {page} за пределами каталога")
+                    continue
+                cursor_params["cursor"] = cursor
+            cursor_timings = self._measure(view, factory, cursor_params, options["repeat"])
+
+            self.stdout.write(
+                f"page {page:>7}: page-number {self._format(page_timings)} | keyset {self._format(cursor_timings)}"
+            )
+
+    @staticmethod
+    def _measure(view, factory, params, repeat):
+        timings = []
+        for _ in range(repeat):
+            request = factory.get("/shop/product/", params)
+            started = time.perf_counter()
+            response = view(request)
+            response.render()
+            timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                return None
+        return timings
+
+    @staticmethod
+    def _cursor_for_page(factory, page, page_size, ordering):
+        """
+        Курсор на начало страницы page: значения ключа последней строки предыдущей страницы (подготовка, без замера).
+        """
+        request = Request(factory.get("/shop/product/", {"ordering": ordering}))
+        paginator = ProductKeysetPagination()
+        field, descending = paginator.get_ordering(request)
+        viewset = ProductViewSet(action="list", request=request)
+        queryset = paginator.order_queryset(viewset.get_queryset(), field, descending)
+        try:
+            row = queryset.values_list(field, "pk")[(page - 1) * page_size - 1]
+        except IndexError:
+            return None
+        return paginator.encode_cursor(*row)
+
+    @staticmethod
+    def _format(timings):
+        if timings is None:
+            return "n/a"
+        return f"median {statistics.median(timings):8.2f} ms, max {max(timings):8.2f} ms"
@@ -0,0 +1,70 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from shop.models import Product, ProductCategory, StockReservation
+from shop.serializers import StockReservationBatchSerializer
+from shop.services import StockReservationService
+
+
+class Command(BaseCommand):
+    help = "Batch stock reservations: lines per second for each batch size and stock consistency after release"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-sizes", default="1,10,100,1000", help="Строк в пакете, через запятую")
+        parser.add_argument("--lines", type=int, default=2000, help="Строк на каждый размер пакета")
+        parser.add_argument("--products", type=int, default=500)
+        parser.add_argument("--items-per-order", type=int, default=5)
+
+    def handle(self, *args, **options):
+        category = ProductCategory.objects.create(name=f"benchmark-reservations-{time.time_ns()}")
+        products = Product.objects.bulk_create(
+            [
+                Product(category=category, name=f"product {number}", old_price=1, discount=0, price=1)
+                for number in range(options["products"])
+            ]
+        )
+        product_ids = [product.id for product in products]
+        Product.objects.filter(id__in=product_ids).update(available_quantity=10**6)
+        user = User.objects.create_user(username=category.name)
+        items_per_order = options["items_per_order"]
+
+        for batch_size in [int(size) for size in options["batch_sizes"].split(",")]:
+            batches = options["lines"] // batch_size or 1
+            started = time.perf_counter()
+            for batch in range(batches):
+                orders = [
+                    {
+                        "external_order_id": f"{batch_size}-{batch}-{number}",
+                        "items": [
+                            {"product_id": product_id, "quantity": random.randint(1, 3)}
+                            for product_id in random.sample(product_ids, min(items_per_order, batch_size - number))
+                        ],
+                    }
+                    for number in range(0, batch_size, items_per_order)
+                ]
+                serializer = StockReservationBatchSerializer(data={"orders": orders})
+                serializer.is_valid(raise_exception=True)
+                StockReservationService(user, serializer.validated_data["orders"]).reserve()
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"пакет {batch_size}: {batches} запросов, {batches * batch_size / elapsed:.0f} строк/с, "
+                f"{elapsed / batches * 1000:.2f} ms на запрос"
+            )
+
+        external_order_ids = list(
+            StockReservation.objects.filter(user=user).values_list("external_order_id", flat=True).distinct()
+        )
+        started = time.perf_counter()
+        released = StockReservationService.release(user, external_order_ids)
+        self.stdout.write(f"снято {released} резервов за {time.perf_counter() - started:.2f} s")
+        remaining = set(Product.objects.filter(id__in=product_ids).values_list("available_quantity", flat=True))
+        if remaining == {10**6}:
+            self.stdout.write(self.style.SUCCESS("Остатки восстановлены"))
+        else:
+            self.stderr.write(f"Остатки после снятия резервов: {sorted(remaining)[:10]}")
+
+        user.delete()
+        Product.objects.filter(category=category).delete()
+        category.delete()
@@ -0,0 +1,100 @@
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from shop.models import Product, ProductCategory, ReviewComment
+from shop.services import ReviewCreateService, ReviewIngestService
+
+
+class Command(BaseCommand):
+    help = "Review ingestion: per-row ReviewComment.objects.create against ReviewIngestService, rows per second"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reviews", type=int, default=500, help="Отзывов (корней) на каждый прогон")
+        parser.add_argument("--replies", type=int, default=2000, help="Ответов на каждый прогон")
+        parser.add_argument("--products", type=int, default=20)
+        parser.add_argument("--batch-size", type=int, default=1000, help="Строк в пакете ReviewIngestService")
+
+    def handle(self, *args, **options):
+        category = ProductCategory.objects.create(name=f"benchmark-review-ingest-{time.time_ns()}")
+        products = Product.objects.bulk_create(
+            [
+                Product(category=category, name=f"product {number}", old_price=1, discount=0, price=1)
+                for number in range(options["products"])
+            ]
+        )
+        user = User.objects.create_user(username=category.name)
+        # форма леса одна на оба прогона: индекс родителя или None для отзыва
+        shape = [None] * options["reviews"]
+        for number in range(options["replies"]):
+            shape.append(random.randrange(len(shape)))
+        rows = len(shape)
+
+        per_row = self.run_per_row(shape, products, user)
+        self.stdout.write(f"по одной строке: {rows / per_row:.0f} строк/с ({per_row:.2f} s)")
+
+        batch_size = options["batch_size"]
+        started = time.perf_counter()
+        created_at = timezone.now()
+        comments = []
+        for start in range(0, rows, batch_size):
+            end = start + batch_size
+            batch = []
+            for parent_index in shape[start:end]:
+                # ответы на отзывы из предыдущих пакетов попадают в уже существующие деревья
+                parent = comments[parent_index] if parent_index is not None else None
+                comment = ReviewComment(
+                    product=parent.product if parent else random.choice(products),
+                    user=user,
+                    parent=parent,
+                    text="ответ" if parent else "отзыв",
+                    rating=None if parent else random.randint(1, 5),
+                    # разные created_at, чтобы порядок соседей был однозначен и для partial_rebuild
+                    created_at=created_at + timedelta(microseconds=len(comments)),
+                )
+                comments.append(comment)
+                batch.append(comment)
+            ReviewIngestService(batch_size=batch_size).ingest(batch)
+        bulk = time.perf_counter() - started
+        self.stdout.write(f"пакетами по {batch_size}: {rows / bulk:.0f} строк/с ({bulk:.2f} s), x{per_row / bulk:.1f}")
+
+        if self.tree_is_valid(category):
+            self.stdout.write(self.style.SUCCESS("Деревья совпадают с перестроенными MPTT"))
+        else:
+            self.stderr.write("Поля MPTT расходятся с результатом partial_rebuild")
+
+        ReviewComment.objects.filter(product__category=category).delete()
+        user.delete()
+        Product.objects.filter(category=category).delete()
+        category.delete()
+
+    def run_per_row(self, shape, products, user) -> float:
+        created = []
+        started = time.perf_counter()
+        for parent_index in shape:
+            product = random.choice(products)
+            if parent_index is None:
+                service = ReviewCreateService(product_id=product.id, user=user)
+                created.append(service.create_review(text="отзыв", rating_value=random.randint(1, 5)))
+            else:
+                parent = created[parent_index]
+                service = ReviewCreateService(product_id=parent.product_id, user=user)
+                created.append(service.create_comment(text="ответ", parent_id=parent.id))
+        return time.perf_counter() - started
+
+    @staticmethod
+    def tree_is_valid(category) -> bool:
+        comments = ReviewComment.objects.filter(product__category=category)
+        fields = ("id", "tree_id", "lft", "rght", "level")
+        before = set(comments.values_list(*fields))
+        tree_ids = {row[1] for row in before}
+        with transaction.atomic():
+            for tree_id in tree_ids:
+                ReviewComment.objects.partial_rebuild(tree_id)
+            after = set(comments.values_list(*fields))
+            transaction.set_rollback(True)
+        return before == after
@@ -0,0 +1,34 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from shop.filters import ProductFilter
+from shop.models import Product
+
+DEFAULT_QUERIES = ["смартфон", "книга", "Samsung", "диван Ikea", "наушники Sony", "корм для собак"]
+
+
+class Command(BaseCommand):
+    help = "Measure p50/p99 latency of full-text product search (search_vector filter)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queries", nargs="+", default=DEFAULT_QUERIES)
+        parser.add_argument("--repeat", type=int, default=50)
+        parser.add_argument("--limit", type=int, default=20)
+        parser.add_argument("--explain", action="store_true", help="Вывести план запроса (один раз на запрос)")
+
+    def handle(self, *args, **options):
+        for query in options["queries"]:
+            queryset = ProductFilter({"search_vector": query}, queryset=Product.objects.all()).qs[: options["limit"]]
+            if options["explain"]:
+                self.stdout.write(queryset.explain(analyze=True))
+
+            timings = []
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                list(queryset.all())
+                timings.append((time.perf_counter() - started) * 1000)
+
+            timings.sort()
+            p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+            self.stdout.write(f"{query!r:>24}: p50 {statistics.median(timings):8.2f} ms, p99 {p99:8.2f} ms")
@@ -0,0 +1,71 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.utils.encoders import JSONEncoder
+from shop.models import CartItems, OrderItems, Product
+from shop.serializers import (
+    CartItemSerializer,
+    CartItemValuesSerializer,
+    OrderItemSerializer,
+    OrderItemValuesSerializer,
+    ProductListSerializer,
+    ProductListValuesSerializer,
+)
+
+
+class Command(BaseCommand):
+    help = "Compare DRF serializers with the values_list() fast path on large pages"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10000)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        rows = options["rows"]
+        cases = [
+            (
+                "product list",
+                Product.objects.select_related("category").order_by("id")[:rows],
+                ProductListSerializer,
+                ProductListValuesSerializer(),
+            ),
+            (
+                "cart items",
+                CartItems.objects.select_related("product").order_by("id")[:rows],
+                CartItemSerializer,
+                CartItemValuesSerializer(),
+            ),
+            (
+                "order items",
+                OrderItems.objects.select_related("product").order_by("id")[:rows],
+                OrderItemSerializer,
+                OrderItemValuesSerializer(),
+            ),
+        ]
+        for name, queryset, serializer_class, values_serializer in cases:
+            drf_data = serializer_class(queryset.all(), many=True).data
+            fast_data = values_serializer.serialize(queryset.all())
+            encode = JSONEncoder().encode
+            if json.loads(encode(drf_data)) != json.loads(encode(fast_data)):
+                self.stderr.write(f"{name}: вывод быстрого сериализатора отличается от DRF")
+                continue
+
+            drf_timings = self._measure(lambda: serializer_class(queryset.all(), many=True).data, options["repeat"])
+            fast_timings = self._measure(lambda: values_serializer.serialize(queryset.all()), options["repeat"])
+            drf_median = statistics.median(drf_timings)
+            fast_median = statistics.median(fast_timings)
+            self.stdout.write(
+                f"{name:>12} ({len(fast_data)} строк): DRF {drf_median:9.2f} ms, "
+                f"values {fast_median:9.2f} ms, ускорение x{drf_median / fast_median if fast_median else 0:.1f}"
+            )
+
+    @staticmethod
+    def _measure(func, repeat: int) -> list[float]:
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+        return timings
@@ -2,6 +2,8 @@ import random
 
 from django.core.management.base import BaseCommand
 from django.db import transaction
+from django.utils import timezone
+from shop.bulk import CopyLoader, assign_tree_fields, lock_tree_ids, next_tree_id
 from shop.models import Product, ReviewComment, User
 
 
@@ -9,7 +11,7 @@ class Command(BaseCommand):
     help = "Generate test data for reviews"
 
     def handle(self, *args, **kwargs):
-        users = User.objects.all()
+        users = list(User.objects.all())
 
         batch_size = 10000
         total_reviews = 100000
@@ -18,9 +20,13 @@ class Command(BaseCommand):
         products_per_page = 1000
         product_offset = 0
 
+        loader = CopyLoader(ReviewComment, include_pk=True, batch_size=batch_size)
+
         with transaction.atomic():
+            lock_tree_ids(ReviewComment)
+            tree_id = next_tree_id(ReviewComment)
             while reviews_left > 0:
-                products = Product.objects.all()[product_offset : product_offset + products_per_page]
+                products = list(Product.objects.order_by("id")[product_offset : product_offset + products_per_page])
                 product_offset += products_per_page
                 if not products:
                     break
@@ -29,20 +35,28 @@ class Command(BaseCommand):
                     reviews_to_create = min(reviews_left, batch_size)
                     reviews_left -= reviews_to_create
 
-                    for _ in range(reviews_to_create):
+                    reviews = []
+                    now = timezone.now()
+                    for review_id in loader.reserve_ids(reviews_to_create):
                         product = random.choice(products)
                         user = random.choice(users)
                         rating = random.choice([1, 2, 3, 4, 5])
                         text = f"Отзыв пользователя {user.username} для товара {product.name}. Рейтинг: {rating}."
-                        parent = None
-
-                        review = ReviewComment(
-                            product=product,
-                            user=user,
-                            rating=rating,
-                            text=text,
-                            parent=parent,
+
+                        reviews.append(
+                            ReviewComment(
+                                id=review_id,
+                                product=product,
+                                user=user,
+                                rating=rating,
+                                text=text,
+                                parent=None,
+                                created_at=now,
+                                updated_at=now,
+                            )
                         )
-                        review.save()
+
+                    tree_id = assign_tree_fields(reviews, start_tree_id=tree_id, order_by="created_at")
+                    loader.load(reviews)
 
                     print(f"Осталось отзывов: {reviews_left}")
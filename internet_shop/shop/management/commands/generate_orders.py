@@ -3,6 +3,7 @@ from datetime import date, datetime, timedelta
 
 from django.core.management.base import BaseCommand
 from django.db import transaction
+from shop.bulk import CopyLoader
 from shop.models import Order, OrderItems, Product, User
 from tqdm import tqdm
 
@@ -35,27 +36,28 @@ class Command(BaseCommand):
             random_days = random.randint(0, time_delta.days)
             return start_date + timedelta(days=random_days)
 
+        order_loader = CopyLoader(Order, include_pk=True, batch_size=batch_size)
+        item_loader = CopyLoader(OrderItems, batch_size=batch_size)
+
         with transaction.atomic():
             while orders_left > 0:
                 orders_to_create = min(orders_left, batch_size)
                 orders_left -= orders_to_create
 
                 orders = []
-                for _ in range(orders_to_create):
+                for order_id in order_loader.reserve_ids(orders_to_create):
                     user = random.choice(users)
 
                     start_date = datetime(2024, 1, 1)
                     end_date = datetime.today()
                     order_date = random_date(start_date, end_date)
 
-                    orders.append(Order(user=user, created_at=order_date))
-
-                Order.objects.bulk_create(orders, batch_size=batch_size)
+                    orders.append(Order(id=order_id, user=user, created_at=order_date.date()))
 
-                created_orders = Order.objects.order_by("-id")[:orders_to_create]
+                order_loader.load(orders)
 
                 order_items = []
-                for order in tqdm(created_orders, desc="Добавление товаров в заказы", leave=True):
+                for order in tqdm(orders, desc="Добавление товаров в заказы", leave=True):
                     num_items = random.randint(1, 5)
                     selected_products = random.sample(products, num_items)
 
@@ -66,5 +68,5 @@ class Command(BaseCommand):
                             OrderItems(order=order, product=product, price=product.price, quantity=quantity)
                         )
 
-                OrderItems.objects.bulk_create(order_items, batch_size=batch_size)
+                item_loader.load(order_items)
                 print(f"Осталось заказов: {orders_left}")
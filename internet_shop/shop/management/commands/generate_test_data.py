@@ -1,9 +1,11 @@
 import random
 from decimal import Decimal
 
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
 from django.db import transaction
-from shop.models import Product, ProductCategory
+from shop.bulk import CopyLoader
+from shop.models import Product, ProductCategory, ProductStatistics
 from tqdm import tqdm
 
 from .services import categories_inp, products_inp
@@ -25,33 +27,41 @@ class Command(BaseCommand):
 
         categories += nested_categories
 
+        product_loader = CopyLoader(Product, include_pk=True, batch_size=batch_size)
+        statistics_loader = CopyLoader(ProductStatistics, include_pk=True, batch_size=batch_size)
+
         with transaction.atomic():
             while products_left > 0:
                 products_to_create = min(products_left, batch_size)
                 products_left -= products_to_create
 
-                products = []
-                for _ in range(products_to_create):
-                    category = random.choice(categories)
-                    category_name = category.name
-                    product_name = random.choice(products_inp[category_name])  # случайный товар из выбранной категории
-                    old_price = random.randint(100, 5000)
-                    discount = random.randint(0, 50)
-                    price = Decimal(old_price - old_price * discount / 100)
-                    available_quantity = random.randint(0, 100)
-
-                    product = Product(
-                        category=category,
-                        name=product_name,
-                        description=f"Описание товара {product_name}",
-                        old_price=old_price,
-                        discount=discount,
-                        price=price,
-                        available_quantity=available_quantity,
-                    )
-                    products.append(product)
-
-                for _ in tqdm(range(0, len(products), batch_size), desc="Добавление товаров", leave=True):
-                    Product.objects.bulk_create(products, batch_size=batch_size)
+                product_ids = product_loader.reserve_ids(products_to_create)
+
+                def products():
+                    for product_id in product_ids:
+                        category = random.choice(categories)
+                        category_name = category.name
+                        product_name = random.choice(products_inp[category_name])  # случайный товар из категории
+                        old_price = random.randint(100, 5000)
+                        discount = random.randint(0, 50)
+                        price = Decimal(old_price - old_price * discount / 100)
+                        available_quantity = random.randint(0, 100)
+
+                        yield Product(
+                            id=product_id,
+                            category=category,
+                            name=product_name,
+                            description=f"Описание товара {product_name}",
+                            old_price=old_price,
+                            discount=discount,
+                            price=price,
+                            available_quantity=available_quantity,
+                        )
+
+                product_loader.load(tqdm(products(), total=products_to_create, desc="Добавление товаров", leave=True))
+                statistics_loader.load(ProductStatistics(product_id=product_id) for product_id in product_ids)
 
                 print(f"Осталось товаров: {products_left}")
+
+        # COPY пишет строки мимо пересчёта search_document, документы заполняются батчами по id
+        call_command("rebuild_search_documents")
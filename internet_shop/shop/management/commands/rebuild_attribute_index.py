@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from shop.models import ProductAttributeIndex
+from shop.services import AttributeIndexService
+
+
+class Command(BaseCommand):
+    help = "Rebuild the typed product attribute index from django-eav2 values"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            ProductAttributeIndex.objects.all().delete()
+            rebuilt = AttributeIndexService.rebuild(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Проиндексировано значений атрибутов: {rebuilt}"))
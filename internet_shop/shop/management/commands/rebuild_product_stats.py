@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+from shop.models import Product
+from shop.services import ProductStatisticsService
+from tqdm import tqdm
+
+
+class Command(BaseCommand):
+    help = "Rebuild denormalized product statistics (rating, reviews, comments, sales, popularity)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="Количество id товаров в одном батче")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        bounds = Product.objects.aggregate(min_id=Min("id"), max_id=Max("id"))
+        if bounds["min_id"] is None:
+            self.stderr.write("Ошибка: нет продуктов в базе данных.")
+            return
+
+        rebuilt = 0
+        for start_id in tqdm(
+            range(bounds["min_id"], bounds["max_id"] + 1, batch_size), desc="Пересчёт статистики", leave=True
+        ):
+            with transaction.atomic():
+                rebuilt += ProductStatisticsService.rebuild(start_id, start_id + batch_size)
+
+        self.stdout.write(self.style.SUCCESS(f"Статистика пересчитана для {rebuilt} товаров"))
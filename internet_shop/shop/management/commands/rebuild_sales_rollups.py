@@ -0,0 +1,19 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from shop.services import SalesRollupService
+
+
+class Command(BaseCommand):
+    help = "Rebuild daily sales rollups per product, category and user from order items"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start-date", type=date.fromisoformat, default=None)
+        parser.add_argument("--end-date", type=date.fromisoformat, default=None)
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        created = SalesRollupService.rebuild(
+            start_date=options["start_date"], end_date=options["end_date"], batch_size=options["batch_size"]
+        )
+        self.stdout.write(self.style.SUCCESS(f"Создано строк агрегатов продаж: {created}"))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+from shop.models import Product
+from shop.search import ProductSearchDocumentService
+from tqdm import tqdm
+
+
+class Command(BaseCommand):
+    help = "Rebuild stored product search documents (tsvector) in id-range batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50000, help="Количество id товаров в одном батче")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        bounds = Product.objects.aggregate(min_id=Min("id"), max_id=Max("id"))
+        if bounds["min_id"] is None:
+            self.stderr.write("Ошибка: нет продуктов в базе данных.")
+            return
+
+        refreshed = 0
+        for start_id in tqdm(
+            range(bounds["min_id"], bounds["max_id"] + 1, batch_size), desc="Пересчёт поисковых документов", leave=True
+        ):
+            with transaction.atomic():
+                refreshed += ProductSearchDocumentService.refresh(
+                    Product.objects.filter(id__gte=start_id, id__lt=start_id + batch_size)
+                )
+
+        self.stdout.write(self.style.SUCCESS(f"Поисковые документы пересчитаны для {refreshed} товаров"))
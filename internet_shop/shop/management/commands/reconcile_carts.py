@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from shop.carts import CartReconciliationService
+from tqdm import tqdm
+
+
+class Command(BaseCommand):
+    help = "Clamp cart item quantities to product stock and refresh prices for all carts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50000, help="Количество id позиций корзин в одном батче")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        updated = 0
+        for start_id in tqdm(CartReconciliationService.batches(batch_size), desc="Сверка корзин", leave=True):
+            updated += CartReconciliationService.reconcile(start_id, start_id + batch_size)
+
+        self.stdout.write(self.style.SUCCESS(f"Обновлено позиций корзин: {updated}"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from shop.services import ProductDetailCacheService
+from shop.stock import StockShardService
+
+
+class Command(BaseCommand):
+    help = "Split a hot product's stock across N counter rows (0 turns sharding off)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("product_ids", nargs="+", type=int)
+        parser.add_argument("--shards", type=int, default=8)
+
+    def handle(self, *args, **options):
+        for product_id in options["product_ids"]:
+            product = StockShardService.enable(product_id, options["shards"])
+            ProductDetailCacheService.invalidate(product_id)
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Товар {product_id}: шардов {product.stock_shards}, остаток {product.available_quantity}"
+                )
+            )
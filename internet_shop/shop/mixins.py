@@ -1,6 +1,75 @@
+from itertools import islice
+
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+
 class ModelViewMixin:
     def get_serializer_class(self):
         try:
             return self.serializer_action_classes[self.action]
         except (KeyError, AttributeError):
             return super().get_serializer_class()
+
+
+class KeysetPaginationMixin:
+    """
+    Включает keyset-пагинацию по запросу ?pagination=cursor для экшенов из keyset_pagination_classes.
+    """
+
+    keyset_pagination_classes = {}
+    keyset_query_param = "pagination"
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            pagination_class = self.get_pagination_class()
+            self._paginator = pagination_class() if pagination_class is not None else None
+        return self._paginator
+
+    def get_pagination_class(self):
+        if self.request.query_params.get(self.keyset_query_param) == "cursor":
+            return self.keyset_pagination_classes.get(self.action, self.pagination_class)
+        return self.pagination_class
+
+
+class StreamingResponseMixin:
+    """
+    Потоковая отдача списков по запросу ?stream=ndjson (объект на строку) или ?stream=json (массив частями).
+    Queryset читается через iterator(chunk_size) и сериализуется построчно,
+    поэтому память и время до первого байта не зависят от размера выборки.
+    """
+
+    stream_query_param = "stream"
+    stream_chunk_size = 2000
+    stream_batch_size = 100
+    stream_content_types = {"ndjson": "application/x-ndjson", "json": "application/json"}
+
+    def get_stream_format(self) -> str | None:
+        stream_format = self.request.query_params.get(self.stream_query_param)
+        return stream_format if stream_format in self.stream_content_types else None
+
+    def streaming_response(self, queryset, stream_format: str, serializer_class=None) -> StreamingHttpResponse:
+        serializer_class = serializer_class or self.get_serializer_class()
+        context = self.get_serializer_context()
+        encoder = JSONEncoder(ensure_ascii=False)
+
+        def render_rows():
+            rows = queryset.iterator(chunk_size=self.stream_chunk_size)
+            while batch := list(islice(rows, self.stream_batch_size)):
+                yield [encoder.encode(serializer_class(row, context=context).data) for row in batch]
+
+        def render_ndjson():
+            for batch in render_rows():
+                yield "".join(f"{row}\n" for row in batch)
+
+        def render_json():
+            yield "["
+            separator = ""
+            for batch in render_rows():
+                yield separator + ",".join(batch)
+                separator = ","
+            yield "]"
+
+        content = render_ndjson() if stream_format == "ndjson" else render_json()
+        return StreamingHttpResponse(content, content_type=self.stream_content_types[stream_format])
@@ -1,5 +1,7 @@
 import eav
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.exceptions import ValidationError
 from django.db import models
 from mptt.models import MPTTModel, TreeForeignKey
@@ -9,6 +11,9 @@ class ProductCategory(MPTTModel):
     name = models.TextField("Название категории", unique=True)
     parent = TreeForeignKey("self", on_delete=models.CASCADE, null=True, blank=True, related_name="children")
 
+    class Meta:
+        indexes = [GinIndex(fields=["name"], opclasses=["gin_trgm_ops"], name="category_name_trgm_idx")]
+
     class MPTTMeta:
         order_insertion_by = ["name"]
 
@@ -33,13 +38,37 @@ class Product(models.Model):
     )
     available = models.BooleanField("Доступность товара", default=True)
     available_quantity = models.PositiveIntegerField("Остаток товара на складе", default=0)
+    external_id = models.CharField("Артикул поставщика", max_length=64, unique=True, null=True, blank=True)
+    stock_shards = models.PositiveSmallIntegerField("Количество шардов остатка", default=0)
+    search_document = SearchVectorField("Поисковый документ", null=True, editable=False)
 
     class Meta:
         verbose_name_plural = "Товары"
+        indexes = [
+            models.Index(fields=["price", "id"], name="product_price_id_idx"),
+            GinIndex(fields=["search_document"], name="product_search_document_idx"),
+            GinIndex(fields=["name"], opclasses=["gin_trgm_ops"], name="product_name_trgm_idx"),
+            GinIndex(fields=["description"], opclasses=["gin_trgm_ops"], name="product_description_trgm_idx"),
+        ]
+
+    # поля, из которых собирается search_document
+    SEARCH_FIELDS = ("name", "description", "category_id")
 
     def __str__(self):
         return f"Название товара: {self.name}; Цена со скидкой: {self.price}; Скидка: {self.discount}%"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.search_source = instance.get_search_source()
+        return instance
+
+    def get_search_source(self) -> tuple:
+        """
+        Значения полей поискового документа; отложенные поля не догружаются из базы.
+        """
+        return tuple(self.__dict__.get(field, models.DEFERRED) for field in self.SEARCH_FIELDS)
+
     def clean(self, *args, **kwargs):
         if not self.available and self.available_quantity > 0:
             raise ValidationError("Невозможно наличие товара на складе если он недоступен")
@@ -49,6 +78,60 @@ class Product(models.Model):
 eav.register(Product)
 
 
+class ProductStockShard(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="shards")
+    number = models.PositiveSmallIntegerField("Номер шарда")
+    quantity = models.PositiveIntegerField("Остаток в шарде", default=0)
+
+    class Meta:
+        verbose_name_plural = "Шарды остатков товаров"
+        constraints = [models.UniqueConstraint(fields=["product", "number"], name="unique_product_stock_shard")]
+
+
+class ProductAttributeIndex(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="attribute_index")
+    attribute = models.SlugField("Атрибут", max_length=50)
+    value_text = models.TextField("Текстовое значение", null=True, blank=True)
+    value_number = models.FloatField("Числовое значение", null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = "Индекс атрибутов товаров"
+        constraints = [
+            models.UniqueConstraint(fields=["product", "attribute"], name="unique_product_attribute_index"),
+        ]
+        indexes = [
+            models.Index(fields=["attribute", "value_text", "product"], name="attribute_index_text_idx"),
+            models.Index(fields=["attribute", "value_number", "product"], name="attribute_index_number_idx"),
+        ]
+
+    def __str__(self):
+        return (
+            f"{self.product_id}: {self.attribute}={self.value_text if self.value_number is None else self.value_number}"
+        )
+
+
+class ProductStatistics(models.Model):
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name="stats")
+    average_rating = models.FloatField("Средний рейтинг", null=True, blank=True)
+    rating_sum = models.PositiveBigIntegerField("Сумма оценок", default=0)
+    rating_count = models.PositiveIntegerField("Количество оценок", default=0)
+    review_count = models.PositiveIntegerField("Количество отзывов", default=0)
+    comment_count = models.PositiveIntegerField("Количество комментариев", default=0)
+    units_sold = models.PositiveBigIntegerField("Продано единиц", default=0)
+    popularity = models.PositiveBigIntegerField("Популярность", default=0)
+
+    class Meta:
+        verbose_name_plural = "Статистика товаров"
+        indexes = [
+            models.Index(fields=["popularity", "product"], name="product_stats_popularity_idx"),
+            models.Index(fields=["average_rating", "product"], name="product_stats_rating_idx"),
+            models.Index(fields=["comment_count"], name="product_stats_comments_idx"),
+        ]
+
+    def __str__(self):
+        return f"Статистика товара {self.product_id}: популярность {self.popularity}, рейтинг {self.average_rating}"
+
+
 class ReviewComment(MPTTModel):
     class RatingChoices(models.IntegerChoices):
         ONE = 1
@@ -65,6 +148,15 @@ class ReviewComment(MPTTModel):
     updated_at = models.DateTimeField(auto_now=True)
     rating = models.IntegerField(choices=RatingChoices.choices, verbose_name="Rating", null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["product", "created_at", "id"],
+                name="review_root_created_idx",
+                condition=models.Q(parent__isnull=True),
+            )
+        ]
+
     class MPTTMeta:
         order_insertion_by = ["created_at"]
 
@@ -83,6 +175,7 @@ class Cart(models.Model):
 
     class Meta:
         verbose_name_plural = "Корзина"
+        constraints = [models.UniqueConstraint(fields=["user"], name="unique_user_cart")]
 
     def __str__(self):
         return f"Корзина {self.user}"
@@ -102,6 +195,9 @@ class CartItems(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     added_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["cart", "product"], name="unique_cart_product")]
+
 
 class Order(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -110,6 +206,14 @@ class Order(models.Model):
     created_at = models.DateField(auto_now_add=True)
     total_sum = models.DecimalField("Сумма заказа", decimal_places=6, max_digits=20, null=True)
     products = models.ManyToManyField(Product, through="OrderItems", related_name="orders")
+    idempotency_key = models.CharField("Ключ идемпотентности", max_length=64, null=True, blank=True)
+    # продажи заказа ещё не учтены в ProductStatistics и дневных агрегатах: флаг снимает register_order_sales
+    sales_pending = models.BooleanField("Продажи не учтены в статистике", default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "idempotency_key"], name="unique_order_idempotency_key"),
+        ]
 
 
 class OrderItems(models.Model):
@@ -126,6 +230,44 @@ class OrderItems(models.Model):
     quantity = models.PositiveIntegerField(default=1)
 
 
+class DailySalesRollup(models.Model):
+    date = models.DateField("Дата")
+    quantity = models.PositiveBigIntegerField("Продано единиц", default=0)
+    total_sales = models.DecimalField("Сумма продаж", decimal_places=2, max_digits=20, default=0)
+    total_discount = models.DecimalField("Сумма скидок", decimal_places=2, max_digits=20, default=0)
+    order_count = models.PositiveIntegerField("Количество заказов", default=0)
+    line_count = models.PositiveIntegerField("Количество позиций заказов", default=0)
+
+    class Meta:
+        abstract = True
+
+
+class ProductDailySales(DailySalesRollup):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="daily_sales")
+    category = models.ForeignKey(ProductCategory, on_delete=models.CASCADE, related_name="product_daily_sales")
+
+    class Meta:
+        verbose_name_plural = "Продажи товаров по дням"
+        constraints = [models.UniqueConstraint(fields=["date", "product"], name="unique_product_daily_sales")]
+        indexes = [models.Index(fields=["product", "date"], name="product_daily_sales_idx")]
+
+
+class CategoryDailySales(DailySalesRollup):
+    category = models.ForeignKey(ProductCategory, on_delete=models.CASCADE, related_name="daily_sales")
+
+    class Meta:
+        verbose_name_plural = "Продажи категорий по дням"
+        constraints = [models.UniqueConstraint(fields=["date", "category"], name="unique_category_daily_sales")]
+
+
+class UserDailySales(DailySalesRollup):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="daily_sales")
+
+    class Meta:
+        verbose_name_plural = "Покупки пользователей по дням"
+        constraints = [models.UniqueConstraint(fields=["date", "user"], name="unique_user_daily_sales")]
+
+
 class UserBalance(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     balance = models.DecimalField("Баланс юзера", decimal_places=6, max_digits=20, null=False, default=0)
@@ -140,3 +282,101 @@ class UserBalanceHistory(models.Model):
     operation_type = models.CharField("Тип операции", max_length=7, blank=False, choices=OperationType)
     amount = models.DecimalField("Сумма операции", decimal_places=6, max_digits=20, null=False)
     created_at = models.DateTimeField(auto_now_add=True)
+
+
+class ProductImportJob(models.Model):
+    class State(models.TextChoices):
+        PENDING = "pending"
+        RUNNING = "running"
+        SUCCEEDED = "succeeded"
+        FAILED = "failed"
+
+    class Mode(models.TextChoices):
+        INSERT = "insert"
+        UPSERT = "upsert"
+
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    file_name = models.CharField("Имя загруженного файла", max_length=255)
+    file_path = models.CharField("Путь к файлу на диске", max_length=500)
+    chunk_size = models.PositiveIntegerField("Размер чанка", default=10000)
+    mode = models.CharField("Режим импорта", max_length=6, choices=Mode, default=Mode.INSERT)
+    state = models.CharField("Статус", max_length=9, choices=State, default=State.PENDING)
+    rows_processed = models.PositiveBigIntegerField("Обработано строк", default=0)
+    rows_created = models.PositiveBigIntegerField("Создано товаров", default=0)
+    rows_updated = models.PositiveBigIntegerField("Обновлено товаров", default=0)
+    rows_unchanged = models.PositiveBigIntegerField("Товаров без изменений", default=0)
+    rows_failed = models.PositiveBigIntegerField("Отклонено строк", default=0)
+    rows_per_sec = models.FloatField("Строк в секунду", default=0)
+    error = models.TextField("Ошибка", blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = "Импорт товаров"
+
+    def __str__(self):
+        return f"Импорт {self.file_name}: {self.state}"
+
+
+class SalesReportJob(models.Model):
+    class State(models.TextChoices):
+        PENDING = "pending"
+        RUNNING = "running"
+        SUCCEEDED = "succeeded"
+        FAILED = "failed"
+
+    class Format(models.TextChoices):
+        CSV = "csv"
+        XLSX = "xlsx"
+        PARQUET = "parquet"
+
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    params = models.JSONField("Параметры отчёта", default=dict, blank=True)
+    format = models.CharField("Формат файла", max_length=7, choices=Format, default=Format.CSV)
+    state = models.CharField("Статус", max_length=9, choices=State, default=State.PENDING)
+    rows_written = models.PositiveBigIntegerField("Записано строк", default=0)
+    file_path = models.CharField("Путь к файлу на диске", max_length=500, blank=True)
+    error = models.TextField("Ошибка", blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = "Отчёты по продажам"
+
+    def __str__(self):
+        return f"Отчёт {self.id} ({self.format}): {self.state}"
+
+
+class StockReservation(models.Model):
+    class State(models.TextChoices):
+        ACTIVE = "active"
+        CONFIRMED = "confirmed"
+        RELEASED = "released"
+        EXPIRED = "expired"
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    external_order_id = models.CharField("Номер заказа во внешней системе", max_length=64)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="reservations")
+    requested_quantity = models.PositiveIntegerField("Запрошено")
+    quantity = models.PositiveIntegerField("Зарезервировано")
+    state = models.CharField("Статус", max_length=9, choices=State, default=State.ACTIVE)
+    expires_at = models.DateTimeField("Резерв действует до")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = "Резервы товаров"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "external_order_id", "product"], name="unique_stock_reservation_line"
+            ),
+        ]
+        indexes = [
+            models.Index(
+                fields=["expires_at"], condition=models.Q(state="active"), name="active_reservation_expiry_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"Резерв {self.external_order_id}: {self.product_id} x {self.quantity} ({self.state})"
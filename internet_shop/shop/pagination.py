@@ -1,4 +1,11 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class ReviewPagination(PageNumberPagination):
@@ -11,3 +18,133 @@ class NestedReviewPagination(PageNumberPagination):
     page_size = 5
     page_size_query_param = "page_size"
     max_page_size = 50
+
+
+class KeysetPagination(BasePagination):
+    """
+    Пагинация по составному ключу (поле сортировки, pk) без COUNT(*) и OFFSET.
+    Курсор хранит значения ключа последней строки страницы, поэтому время ответа не зависит от глубины.
+    """
+
+    page_size = 10
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    cursor_query_param = "cursor"
+    ordering_query_param = "ordering"
+    ordering_fields = {"id": "pk"}
+    default_ordering = "id"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.field, self.descending = self.get_ordering(request)
+        queryset = self.order_queryset(queryset.annotate(keyset_value=F(self.field)), self.field, self.descending)
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            queryset = queryset.filter(self.get_cursor_filter(self.field, self.descending, *cursor))
+
+        results = list(queryset[: self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        results = results[: self.page_size]
+        self.next_cursor = None
+        if self.has_next:
+            last = results[-1]
+            self.next_cursor = self.encode_cursor(last.keyset_value, last.pk)
+        return results
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, request) -> tuple[str, bool]:
+        ordering = request.query_params.get(self.ordering_query_param) or self.default_ordering
+        descending = ordering.startswith("-")
+        field = self.ordering_fields.get(ordering.lstrip("-"))
+        if field is None:
+            field = self.ordering_fields[self.default_ordering.lstrip("-")]
+            descending = self.default_ordering.startswith("-")
+        return field, descending
+
+    @staticmethod
+    def order_queryset(queryset, field: str, descending: bool):
+        prefix = "-" if descending else ""
+        if field == "pk":
+            return queryset.order_by(f"{prefix}pk")
+        return queryset.order_by(f"{prefix}{field}", f"{prefix}pk")
+
+    @staticmethod
+    def get_cursor_filter(field: str, descending: bool, value, pk) -> Q:
+        """
+        Условие "строго после (value, pk)" в порядке сортировки. NULL в PostgreSQL больше любого значения:
+        при сортировке по возрастанию такие строки идут в конце, по убыванию - в начале.
+        Префикс field <= value (или >=) оставляет условие пригодным для range scan по индексу (field, pk).
+        """
+        direction = "lt" if descending else "gt"
+        if field == "pk":
+            return Q(**{f"pk__{direction}": pk})
+        if value is None:
+            after_nulls = Q(**{f"{field}__isnull": True, f"pk__{direction}": pk})
+            return after_nulls | Q(**{f"{field}__isnull": False}) if descending else after_nulls
+        after_value = Q(**{f"{field}__{direction}e": value}) & (
+            Q(**{f"{field}__{direction}": value}) | Q(**{f"pk__{direction}": pk})
+        )
+        return after_value if descending else after_value | Q(**{f"{field}__isnull": True})
+
+    @staticmethod
+    def encode_cursor(value, pk) -> str:
+        if hasattr(value, "isoformat"):
+            value = value.isoformat()
+        elif value is not None and not isinstance(value, (int, float)):
+            value = str(value)
+        payload = json.dumps([value, pk], separators=(",", ":"))
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            return value, int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+
+class ProductKeysetPagination(KeysetPagination):
+    ordering_fields = {
+        "id": "pk",
+        "popularity": "stats__popularity",
+        "rating": "stats__average_rating",
+        "price": "price",
+    }
+
+
+class ReviewKeysetPagination(KeysetPagination):
+    ordering_fields = {"created_at": "created_at"}
+    default_ordering = "created_at"
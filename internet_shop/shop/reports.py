@@ -0,0 +1,147 @@
+import csv
+import logging
+from decimal import Decimal
+from itertools import chain, islice
+from pathlib import Path
+from typing import Iterator
+
+import openpyxl
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.conf import settings
+from django.db import transaction
+from django.http import QueryDict
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .filters import SalesStatisticsQueryBuilder
+from .models import SalesReportJob
+from .tasks import generate_sales_report
+
+logger = logging.getLogger(__name__)
+
+
+class SalesReportService:
+    """
+    Асинхронная выгрузка статистики продаж: запрос SalesStatisticsQueryBuilder читается серверным курсором
+    пачками по chunk_size и сразу пишется в файл, поэтому память не зависит от количества строк.
+    """
+
+    chunk_size = 5000
+
+    @classmethod
+    def enqueue(cls, params: QueryDict, report_format: str, user=None) -> SalesReportJob:
+        if report_format not in SalesReportJob.Format.values:
+            raise ValidationError(f"неподдерживаемый формат отчёта: {report_format}")
+        job = SalesReportJob.objects.create(
+            user=user if user is not None and user.is_authenticated else None,
+            params={key: params.getlist(key) for key in params},
+            format=report_format,
+        )
+        transaction.on_commit(lambda: generate_sales_report.delay(job.id))
+        return job
+
+    @classmethod
+    def run(cls, job_id: int) -> None:
+        claimed = SalesReportJob.objects.filter(id=job_id, state=SalesReportJob.State.PENDING).update(
+            state=SalesReportJob.State.RUNNING, started_at=timezone.now()
+        )
+        if not claimed:
+            return
+
+        job = SalesReportJob.objects.get(id=job_id)
+        path = Path(settings.SALES_REPORT_DIR) / f"sales_report_{job.id}.{job.format}"
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            writer = getattr(cls, f"_write_{job.format}")
+            rows_written = writer(path, cls.iter_rows(job.params))
+        except Exception as e:
+            logger.exception("sales report job %s failed", job_id)
+            path.unlink(missing_ok=True)
+            SalesReportJob.objects.filter(id=job_id).update(
+                state=SalesReportJob.State.FAILED, error=str(e), finished_at=timezone.now()
+            )
+            return
+
+        SalesReportJob.objects.filter(id=job_id).update(
+            state=SalesReportJob.State.SUCCEEDED,
+            rows_written=rows_written,
+            file_path=str(path),
+            finished_at=timezone.now(),
+        )
+
+    @classmethod
+    def iter_rows(cls, params: dict) -> Iterator[dict]:
+        query_params = QueryDict(mutable=True)
+        for key, values in params.items():
+            query_params.setlist(key, values)
+        query_builder = SalesStatisticsQueryBuilder(query_params)
+        queryset = query_builder.get_queryset()
+        queryset = query_builder.filterset_class(query_params, queryset=queryset).qs
+        return queryset.iterator(chunk_size=cls.chunk_size)
+
+    @staticmethod
+    def _peek(rows: Iterator[dict]) -> tuple[list[str], Iterator[dict]]:
+        first = next(rows, None)
+        if first is None:
+            return [], iter(())
+        return list(first), chain([first], rows)
+
+    @classmethod
+    def _write_csv(cls, path: Path, rows: Iterator[dict]) -> int:
+        columns, rows = cls._peek(rows)
+        written = 0
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                written += 1
+        return written
+
+    @classmethod
+    def _write_xlsx(cls, path: Path, rows: Iterator[dict]) -> int:
+        columns, rows = cls._peek(rows)
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet("sales")
+        sheet.append(columns)
+        written = 0
+        for row in rows:
+            sheet.append([row[column] for column in columns])
+            written += 1
+        workbook.save(path)
+        return written
+
+    @classmethod
+    def _write_parquet(cls, path: Path, rows: Iterator[dict]) -> int:
+        columns, rows = cls._peek(rows)
+        written = 0
+        writer = None
+        try:
+            while batch := list(islice(rows, cls.chunk_size)):
+                table = pa.Table.from_pylist(
+                    [
+                        {
+                            column: float(row[column]) if isinstance(row[column], Decimal) else row[column]
+                            for column in columns
+                        }
+                        for row in batch
+                    ]
+                )
+                if writer is None:
+                    # колонка, пустая в первой пачке (например rating), в отчёте может быть только числовой
+                    schema = pa.schema(
+                        [
+                            field.with_type(pa.float64()) if pa.types.is_null(field.type) else field
+                            for field in table.schema
+                        ]
+                    )
+                    writer = pq.ParquetWriter(path, schema)
+                writer.write_table(table.cast(writer.schema))
+                written += len(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            pq.write_table(pa.table({}), path)
+        return written
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.contrib.postgres.search import SearchVector
+from django.db import connection
+from django.db.models import OuterRef, Q, Subquery
+
+from .models import Product, ProductCategory
+
+
+class ProductSearchDocumentService:
+    """
+    Поддержка хранимого Product.search_document: взвешенный tsvector
+    (имя - A, категория и родительская категория - B, описание - C), пересчитываемый одним UPDATE.
+    """
+
+    @staticmethod
+    def get_document_expression():
+        config = settings.PRODUCT_SEARCH_CONFIG
+        category_name = ProductCategory.objects.filter(id=OuterRef("category_id")).values("name")[:1]
+        parent_name = ProductCategory.objects.filter(children__id=OuterRef("category_id")).values("name")[:1]
+        return (
+            SearchVector("name", weight="A", config=config)
+            + SearchVector(Subquery(category_name), weight="B", config=config)
+            + SearchVector(Subquery(parent_name), weight="B", config=config)
+            + SearchVector("description", weight="C", config=config)
+        )
+
+    @classmethod
+    def refresh(cls, queryset) -> int:
+        if connection.vendor != "postgresql":
+            return 0
+        return queryset.update(search_document=cls.get_document_expression())
+
+    @classmethod
+    def refresh_products(cls, product_ids) -> int:
+        return cls.refresh(Product.objects.filter(id__in=list(product_ids)))
+
+    @classmethod
+    def refresh_category(cls, category_id: int) -> int:
+        return cls.refresh(Product.objects.filter(Q(category_id=category_id) | Q(category__parent_id=category_id)))
@@ -1,7 +1,10 @@
 from decimal import Decimal
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.exceptions import FieldDoesNotExist
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 
 from .models import (
     Cart,
@@ -10,7 +13,9 @@ from .models import (
     OrderItems,
     Product,
     ProductCategory,
+    ProductImportJob,
     ReviewComment,
+    SalesReportJob,
     UserBalance,
     UserBalanceHistory,
 )
@@ -55,7 +60,7 @@ class SalesStatisticsSerializer(serializers.Serializer):
     product_quantity = serializers.IntegerField(required=False)
 
     category_name = serializers.CharField(required=False)
-    category_id = serializers.IntegerField(source="product__category", required=False)
+    category_id = serializers.IntegerField(required=False)
 
     total_sales = serializers.DecimalField(max_digits=15, decimal_places=2)
     total_orders = serializers.IntegerField()
@@ -76,15 +81,20 @@ class ProductListSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Product
-        fields = "__all__"
+        exclude = ["search_document"]
 
 
 class RootReviewSerializer(serializers.ModelSerializer):
     children = serializers.SerializerMethodField()
+    replies_count = serializers.SerializerMethodField()
 
     class Meta:
         model = ReviewComment
-        fields = ["id", "user", "text", "created_at", "updated_at", "rating", "children"]
+        fields = ["id", "user", "text", "created_at", "updated_at", "rating", "replies_count", "children"]
+
+    def get_replies_count(self, obj):
+        # все потомки узла MPTT лежат между его lft и rght
+        return (obj.rght - obj.lft - 1) // 2
 
     def get_children(self, obj):
         if hasattr(obj, "children_list") and obj.children_list:
@@ -92,6 +102,45 @@ class RootReviewSerializer(serializers.ModelSerializer):
         return []
 
 
+class ReviewIngestItemSerializer(serializers.Serializer):
+    ref = serializers.CharField(max_length=64, required=False)
+    product_id = serializers.IntegerField(min_value=1)
+    user_id = serializers.IntegerField(min_value=1)
+    text = serializers.CharField(allow_blank=True, required=False, allow_null=True)
+    rating = serializers.ChoiceField(choices=ReviewComment.RatingChoices.choices, required=False, allow_null=True)
+    created_at = serializers.DateTimeField(required=False)
+    parent_id = serializers.IntegerField(min_value=1, required=False)
+    parent_ref = serializers.CharField(max_length=64, required=False)
+
+    def validate(self, attrs):
+        if "parent_id" in attrs and "parent_ref" in attrs:
+            raise serializers.ValidationError("нужно указать parent_id или parent_ref, но не оба")
+        return attrs
+
+
+class ReviewIngestSerializer(serializers.Serializer):
+    """
+    Пакет отзывов и ответов: ответ ссылается на существующий комментарий через parent_id
+    или на комментарий из того же пакета через его ref.
+    """
+
+    comments = ReviewIngestItemSerializer(many=True, allow_empty=False, max_length=settings.REVIEW_INGEST_LIMIT)
+
+    def validate_comments(self, comments):
+        refs = [comment["ref"] for comment in comments if "ref" in comment]
+        if len(refs) != len(set(refs)):
+            raise serializers.ValidationError("значения ref должны быть уникальны")
+        unknown = {comment["parent_ref"] for comment in comments if "parent_ref" in comment} - set(refs)
+        if unknown:
+            raise serializers.ValidationError(f"неизвестные parent_ref: {sorted(unknown)}")
+        for model, key in ((Product, "product_id"), (get_user_model(), "user_id")):
+            ids = {comment[key] for comment in comments}
+            missing = ids - set(model.objects.filter(id__in=ids).values_list("id", flat=True))
+            if missing:
+                raise serializers.ValidationError(f"не найдены {key}: {sorted(missing)}")
+        return comments
+
+
 class ProductSerializer(serializers.ModelSerializer):
     attributes = serializers.DictField(source="eav.get_values_dict", read_only=True)
 
@@ -172,3 +221,178 @@ class UserBalanceHistorySerializer(serializers.ModelSerializer):
     class Meta:
         model = UserBalanceHistory
         fields = "__all__"
+
+
+class ProductImportJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ProductImportJob
+        fields = [
+            "id",
+            "file_name",
+            "mode",
+            "state",
+            "rows_processed",
+            "rows_created",
+            "rows_updated",
+            "rows_unchanged",
+            "rows_failed",
+            "rows_per_sec",
+            "error",
+            "created_at",
+            "started_at",
+            "finished_at",
+        ]
+
+
+class SalesReportJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SalesReportJob
+        fields = ["id", "params", "format", "state", "rows_written", "error", "created_at", "started_at", "finished_at"]
+
+
+class CartProductSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField(min_value=1)
+
+
+class CartBatchItemSerializer(CartProductSerializer):
+    quantity = serializers.IntegerField(min_value=0)
+
+
+class CartBatchSerializer(serializers.Serializer):
+    """
+    Пакет изменений корзины: quantity 0 убирает товар, при повторе товара действует последняя операция.
+    """
+
+    items = CartBatchItemSerializer(many=True, allow_empty=False, max_length=settings.CART_BATCH_LIMIT)
+
+    def validate_items(self, items):
+        return {item["product_id"]: item["quantity"] for item in items}
+
+
+class StockReservationItemSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class StockReservationOrderSerializer(serializers.Serializer):
+    external_order_id = serializers.CharField(max_length=64)
+    items = StockReservationItemSerializer(many=True, allow_empty=False)
+
+
+class StockReservationBatchSerializer(serializers.Serializer):
+    orders = StockReservationOrderSerializer(many=True, allow_empty=False)
+    ttl = serializers.IntegerField(min_value=1, max_value=settings.STOCK_RESERVATION_MAX_TTL, required=False)
+
+    def validate_orders(self, orders):
+        lines = sum(len(order["items"]) for order in orders)
+        if lines > settings.STOCK_RESERVATION_BATCH_LIMIT:
+            raise serializers.ValidationError(
+                f"в пакете {lines} строк, допускается не больше {settings.STOCK_RESERVATION_BATCH_LIMIT}"
+            )
+        return orders
+
+
+class StockReservationOrdersSerializer(serializers.Serializer):
+    external_order_ids = serializers.ListField(child=serializers.CharField(max_length=64), allow_empty=False)
+
+
+class ValuesSerializer:
+    """
+    Быстрая сериализация только для чтения: строки читаются через values_list(),
+    значения приводятся предкомпилированными конвертерами полей serializer_class.
+    Формат ответа совпадает с serializer_class; поля-аннотации, которых нет в queryset, пропускаются так же,
+    как их пропускает DRF.
+    """
+
+    serializer_class = None
+
+    def __init__(self):
+        self.columns = []
+        for name, field in self.serializer_class().fields.items():
+            if field.write_only:
+                continue
+            self.columns.append((name, field.source.replace(".", "__"), self.get_converter(field)))
+
+    @staticmethod
+    def get_converter(field):
+        if isinstance(field, serializers.DecimalField):
+            quantum = Decimal(1).scaleb(-field.decimal_places)
+            if getattr(field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING):
+                return lambda value: f"{value.quantize(quantum):f}"
+            return lambda value: value.quantize(quantum)
+        if isinstance(field, serializers.IntegerField):
+            return int
+        if isinstance(field, serializers.FloatField):
+            return float
+        if isinstance(field, (serializers.CharField, serializers.BooleanField, serializers.PrimaryKeyRelatedField)):
+            return None
+        return field.to_representation
+
+    @staticmethod
+    def has_lookup(queryset, lookup: str) -> bool:
+        if lookup in queryset.query.annotations:
+            return True
+        model = queryset.model
+        try:
+            for part in lookup.split("__"):
+                model = model._meta.get_field(part).related_model
+        except (FieldDoesNotExist, AttributeError):
+            return False
+        return True
+
+    def serialize(self, queryset) -> list[dict]:
+        columns = [column for column in self.columns if self.has_lookup(queryset, column[1])]
+        return self.serialize_rows(queryset.values_list(*[lookup for _, lookup, _ in columns]), columns)
+
+    def serialize_rows(self, rows, columns=None) -> list[dict]:
+        """
+        Сериализует готовые кортежи, например строки сырого SQL; порядок значений - как в columns,
+        по умолчанию как у полей serializer_class.
+        """
+        columns = self.columns if columns is None else columns
+        names = [name for name, _, _ in columns]
+        converters = [(name, converter) for name, _, converter in columns if converter is not None]
+        data = []
+        for row in rows:
+            item = dict(zip(names, row))
+            for name, converter in converters:
+                value = item[name]
+                if value is not None:
+                    item[name] = converter(value)
+            data.append(item)
+        return data
+
+
+class SerializedRows:
+    """
+    Ленивая последовательность для Paginator: количество считается по queryset,
+    а в ответ сериализуется только срез текущей страницы.
+    """
+
+    def __init__(self, queryset, serializer: ValuesSerializer):
+        self.queryset = queryset
+        self.serializer = serializer
+
+    def count(self) -> int:
+        return self.queryset.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.serializer.serialize(self.queryset[key])
+        end = key + 1
+        return self.serializer.serialize(self.queryset[key:end])[0]
+
+
+class ProductListValuesSerializer(ValuesSerializer):
+    serializer_class = ProductListSerializer
+
+
+class CartItemValuesSerializer(ValuesSerializer):
+    serializer_class = CartItemSerializer
+
+
+class OrderItemValuesSerializer(ValuesSerializer):
+    serializer_class = OrderItemSerializer
@@ -1,26 +1,56 @@
+import hashlib
+import json
+import logging
+import time
+import uuid
 from abc import ABC, abstractmethod
+from datetime import timedelta
 from decimal import Decimal
 from pathlib import Path
-from typing import Dict, Literal
+from typing import Callable, Dict, Iterator, Literal
 
+import openpyxl
 import pandas as pd
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.files.storage import FileSystemStorage
 from django.core.files.uploadedfile import UploadedFile
-from django.db import transaction
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Case, Count, F, FloatField, Q, Sum, When, Window
+from django.db.models.functions import Cast, RowNumber
+from django.utils import timezone
 from eav.models import Attribute, Value
 from rest_framework.exceptions import ValidationError
 
+from .bulk import CopyLoader, assign_tree_fields, lock_tree_ids, next_tree_id
 from .models import (
-    Cart,
     CartItems,
+    CategoryDailySales,
     Order,
     OrderItems,
     Product,
+    ProductAttributeIndex,
     ProductCategory,
+    ProductDailySales,
+    ProductImportJob,
+    ProductStatistics,
     ReviewComment,
+    StockReservation,
     UserBalance,
     UserBalanceHistory,
+    UserDailySales,
 )
+from .pagination import NestedReviewPagination
+from .search import ProductSearchDocumentService
 from .signals import order_fully_created
+from .stock import StockShardService
+from .tasks import import_products_file, register_order_sales
+
+logger = logging.getLogger(__name__)
+
+LOCK_NOT_AVAILABLE = "55P03"
 
 DATATYPE_MAP = {
     "int": Attribute.TYPE_INT,
@@ -41,30 +71,746 @@ class ReviewService:
         return ReviewComment.objects.filter(product=product, user=user).values_list("rating", flat=True).first()
 
 
+class ProductStatisticsService:
+    """
+    Инкрементальное обновление денормализованной статистики товаров (ProductStatistics).
+    Популярность считается так же, как раньше в ProductViewSet.list: продажи + комментарии * отзывы.
+    """
+
+    @staticmethod
+    def ensure_statistics(product_ids) -> None:
+        ProductStatistics.objects.bulk_create(
+            [ProductStatistics(product_id=product_id) for product_id in set(product_ids)], ignore_conflicts=True
+        )
+
+    @classmethod
+    def register_review(cls, product_id: int, rating: int | None) -> None:
+        cls.ensure_statistics([product_id])
+        updates = {
+            "review_count": F("review_count") + 1,
+            "popularity": F("units_sold") + F("comment_count") * (F("review_count") + 1),
+        }
+        if rating is not None:
+            updates.update(
+                rating_sum=F("rating_sum") + int(rating),
+                rating_count=F("rating_count") + 1,
+                average_rating=Cast(F("rating_sum") + int(rating), FloatField()) / (F("rating_count") + 1),
+            )
+        ProductStatistics.objects.filter(product_id=product_id).update(**updates)
+
+    @classmethod
+    def register_comment(cls, product_id: int) -> None:
+        cls.ensure_statistics([product_id])
+        ProductStatistics.objects.filter(product_id=product_id).update(
+            comment_count=F("comment_count") + 1,
+            popularity=F("units_sold") + (F("comment_count") + 1) * F("review_count"),
+        )
+
+    @classmethod
+    def register_reviews(cls, comments: list[ReviewComment]) -> None:
+        """
+        Пакетный аналог register_review/register_comment: корни считаются отзывами, ответы - комментариями.
+        """
+        deltas = {}
+        for comment in comments:
+            if comment.product_id is None:
+                continue
+            delta = deltas.setdefault(comment.product_id, {"reviews": 0, "comments": 0, "rating_sum": 0, "rated": 0})
+            if comment.parent_id is not None:
+                delta["comments"] += 1
+                continue
+            delta["reviews"] += 1
+            if comment.rating is not None:
+                delta["rating_sum"] += int(comment.rating)
+                delta["rated"] += 1
+        if not deltas:
+            return
+        cls.ensure_statistics(deltas.keys())
+        cls._lock(deltas.keys())
+
+        def delta_of(key):
+            return Case(
+                *[When(product_id=product_id, then=delta[key]) for product_id, delta in deltas.items() if delta[key]],
+                default=0,
+            )
+
+        reviews, comments_delta, rating_sum, rated = (
+            delta_of("reviews"),
+            delta_of("comments"),
+            delta_of("rating_sum"),
+            delta_of("rated"),
+        )
+        ProductStatistics.objects.filter(product_id__in=deltas.keys()).update(
+            review_count=F("review_count") + reviews,
+            comment_count=F("comment_count") + comments_delta,
+            rating_sum=F("rating_sum") + rating_sum,
+            rating_count=F("rating_count") + rated,
+            average_rating=Case(
+                When(
+                    product_id__in=[product_id for product_id, delta in deltas.items() if delta["rated"]],
+                    then=Cast(F("rating_sum") + rating_sum, FloatField()) / (F("rating_count") + rated),
+                ),
+                default=F("average_rating"),
+            ),
+            popularity=F("units_sold") + (F("comment_count") + comments_delta) * (F("review_count") + reviews),
+        )
+
+    @classmethod
+    def register_sales(cls, order_items: list[OrderItems]) -> None:
+        sold = {}
+        for item in order_items:
+            sold[item.product_id] = sold.get(item.product_id, 0) + item.quantity
+        if not sold:
+            return
+        cls.ensure_statistics(sold.keys())
+        cls._lock(sold.keys())
+        sold_delta = Case(
+            *[When(product_id=product_id, then=quantity) for product_id, quantity in sold.items()],
+            default=0,
+        )
+        ProductStatistics.objects.filter(product_id__in=sold.keys()).update(
+            units_sold=F("units_sold") + sold_delta,
+            popularity=F("units_sold") + sold_delta + F("comment_count") * F("review_count"),
+        )
+
+    @staticmethod
+    def _lock(product_ids) -> None:
+        """
+        Блокирует строки статистики в порядке product_id, чтобы пакетные обновления и rebuild
+        не брали их навстречу друг другу.
+        """
+        list(
+            ProductStatistics.objects.select_for_update()
+            .filter(product_id__in=list(product_ids))
+            .order_by("product_id")
+            .values_list("product_id", flat=True)
+        )
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls, start_id: int, end_id: int) -> int:
+        """
+        Полный пересчёт статистики для товаров с id в диапазоне [start_id, end_id).
+        Рейтинг, как и в register_review/register_reviews, считается только по отзывам (корням).
+        Строки статистики блокируются до подсчёта: инкременты, пришедшие во время пересчёта, ждут его
+        и применяются поверх, а не теряются при перезаписи. Продажи считаются только по заказам,
+        которые уже учла register_order_sales, - остальные она добавит сама.
+        """
+        product_ids = list(Product.objects.filter(id__gte=start_id, id__lt=end_id).values_list("id", flat=True))
+        statistics = {product_id: ProductStatistics(product_id=product_id) for product_id in product_ids}
+        if not statistics:
+            return 0
+        cls.ensure_statistics(product_ids)
+        cls._lock(product_ids)
+
+        reviews = (
+            ReviewComment.objects.filter(product_id__in=statistics.keys())
+            .order_by()
+            .values("product_id")
+            .annotate(
+                rating_sum=Sum("rating", filter=Q(parent__isnull=True), default=0),
+                rating_count=Count("rating", filter=Q(parent__isnull=True)),
+                review_count=Count("id", filter=Q(parent__isnull=True)),
+                comment_count=Count("id", filter=Q(parent__isnull=False)),
+            )
+        )
+        for row in reviews:
+            stats = statistics[row["product_id"]]
+            stats.rating_sum = row["rating_sum"]
+            stats.rating_count = row["rating_count"]
+            stats.review_count = row["review_count"]
+            stats.comment_count = row["comment_count"]
+            stats.average_rating = row["rating_sum"] / row["rating_count"] if row["rating_count"] else None
+
+        sales = (
+            OrderItems.objects.filter(product_id__in=statistics.keys(), order__sales_pending=False)
+            .order_by()
+            .values("product_id")
+            .annotate(units_sold=Sum("quantity"))
+        )
+        for row in sales:
+            statistics[row["product_id"]].units_sold = row["units_sold"]
+
+        for stats in statistics.values():
+            stats.popularity = stats.units_sold + stats.comment_count * stats.review_count
+
+        ProductStatistics.objects.bulk_create(
+            statistics.values(),
+            update_conflicts=True,
+            unique_fields=["product"],
+            update_fields=[
+                "average_rating",
+                "rating_sum",
+                "rating_count",
+                "review_count",
+                "comment_count",
+                "units_sold",
+                "popularity",
+            ],
+        )
+        return len(statistics)
+
+
+class SalesRollupService:
+    """
+    Дневные агрегаты продаж по товарам, категориям и пользователям.
+    Агрегаты считаются группировкой по OrderItems: для одного заказа - инкрементально, для диапазона дат - целиком.
+    """
+
+    METRICS = ["quantity", "total_sales", "total_discount", "order_count", "line_count"]
+    ROLLUPS = {
+        ProductDailySales: {
+            "keys": {"date": "order__created_at", "product_id": "product_id"},
+            "attributes": {"category_id": "product__category_id"},
+        },
+        CategoryDailySales: {
+            "keys": {"date": "order__created_at", "category_id": "product__category_id"},
+            "attributes": {},
+        },
+        UserDailySales: {
+            "keys": {"date": "order__created_at", "user_id": "order__user_id"},
+            "attributes": {},
+        },
+    }
+
+    @classmethod
+    def register_order(cls, order_id: int) -> None:
+        order_items = OrderItems.objects.filter(order_id=order_id)
+        for model in cls.ROLLUPS:
+            cls._increment(model, list(cls._aggregate(model, order_items)))
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls, start_date=None, end_date=None, batch_size: int = 5000) -> int:
+        """
+        Пересчёт агрегатов за диапазон дат [start_date, end_date]; без границ - за всё время.
+        """
+        rollup_dates = Q()
+        order_dates = Q()
+        if start_date is not None:
+            rollup_dates &= Q(date__gte=start_date)
+            order_dates &= Q(order__created_at__gte=start_date)
+        if end_date is not None:
+            rollup_dates &= Q(date__lte=end_date)
+            order_dates &= Q(order__created_at__lte=end_date)
+        # заказы, которые ещё ждут register_order_sales, она добавит в агрегаты сама
+        order_items = OrderItems.objects.filter(order_dates, order__sales_pending=False)
+
+        created = 0
+        for model in cls.ROLLUPS:
+            model.objects.filter(rollup_dates).delete()
+            batch = []
+            for row in cls._aggregate(model, order_items, chunk_size=batch_size):
+                batch.append(model(**row))
+                if len(batch) >= batch_size:
+                    created += len(model.objects.bulk_create(batch))
+                    batch = []
+            created += len(model.objects.bulk_create(batch))
+        return created
+
+    @classmethod
+    def _aggregate(cls, model, order_items, chunk_size: int = 2000) -> Iterator[dict]:
+        columns = {**cls.ROLLUPS[model]["keys"], **cls.ROLLUPS[model]["attributes"]}
+        rows = (
+            order_items.order_by()
+            .values(*columns.values())
+            .annotate(
+                total_sales=Sum(F("price") * F("quantity")),
+                total_discount=Sum((F("product__old_price") - F("price")) * F("quantity")),
+                order_count=Count("order", distinct=True),
+                line_count=Count("id"),
+                units=Sum("quantity"),
+            )
+        )
+        for row in rows.iterator(chunk_size=chunk_size):
+            yield {
+                **{name: row[path] for name, path in columns.items()},
+                **{metric: row[metric] for metric in cls.METRICS if metric != "quantity"},
+                "quantity": row["units"],
+            }
+
+    @classmethod
+    def _increment(cls, model, rows: list[dict]) -> None:
+        if not rows:
+            return
+        keys = list(cls.ROLLUPS[model]["keys"])
+        model.objects.bulk_create(
+            [model(**{name: value for name, value in row.items() if name not in cls.METRICS}) for row in rows],
+            ignore_conflicts=True,
+        )
+        conditions = [Q(**{key: row[key] for key in keys}) for row in rows]
+        matched = Q()
+        for condition in conditions:
+            matched |= condition
+        model.objects.filter(matched).update(
+            **{
+                metric: F(metric)
+                + Case(
+                    *[When(condition, then=row[metric]) for condition, row in zip(conditions, rows)],
+                    default=0,
+                    output_field=model._meta.get_field(metric),
+                )
+                for metric in cls.METRICS
+            }
+        )
+
+
+class ProductDetailCacheService:
+    """
+    Кэш карточки товара вместе с первой страницей отзывов.
+    В ключ входит версия товара: инвалидация увеличивает версию после коммита, и все варианты ответа
+    разом становятся недостижимыми. Начальная версия берётся из времени, чтобы после вытеснения
+    ключа версии старые ответы не стали снова доступны.
+    """
+
+    key_prefix = "product-detail"
+
+    @classmethod
+    def get_key(cls, product_id: int, variant: str) -> str:
+        version = cache.get_or_set(cls._version_key(product_id), time.time_ns, timeout=None)
+        return f"{cls.key_prefix}:{product_id}:{version}:{variant}"
+
+    @classmethod
+    def get(cls, key: str):
+        data = cache.get(key)
+        cls._count("hits" if data is not None else "misses")
+        return data
+
+    @staticmethod
+    def set(key: str, data) -> None:
+        cache.set(key, data, settings.PRODUCT_DETAIL_CACHE_TIMEOUT)
+
+    @classmethod
+    def invalidate(cls, *product_ids: int) -> None:
+        def bump_versions():
+            for product_id in set(product_ids):
+                try:
+                    cache.incr(cls._version_key(product_id))
+                except ValueError:
+                    pass
+
+        transaction.on_commit(bump_versions)
+
+    @classmethod
+    def get_metrics(cls) -> dict:
+        hits = cache.get(f"{cls.key_prefix}:metrics:hits", 0)
+        misses = cache.get(f"{cls.key_prefix}:metrics:misses", 0)
+        return {"hits": hits, "misses": misses, "hit_ratio": hits / (hits + misses) if hits + misses else None}
+
+    @classmethod
+    def _version_key(cls, product_id: int) -> str:
+        return f"{cls.key_prefix}:version:{product_id}"
+
+    @classmethod
+    def _count(cls, metric: str) -> None:
+        key = f"{cls.key_prefix}:metrics:{metric}"
+        cache.add(key, 0, timeout=None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            pass
+
+
 class ReviewCreateService:
     def __init__(self, product_id, user):
         self.product = Product.objects.get(id=product_id)
         self.user = user
 
+    @transaction.atomic
     def create_review(self, text, rating_value):
         self.validate_purchase()
         rating_value = rating_value or ReviewService.get_existing_rating(product=self.product, user=self.user)
-        return ReviewComment.objects.create(product=self.product, user=self.user, text=text, rating=rating_value)
+        # новый отзыв - новое дерево, tree_id выдаётся под той же блокировкой, что и в ReviewIngestService
+        lock_tree_ids(ReviewComment)
+        review = ReviewComment.objects.create(product=self.product, user=self.user, text=text, rating=rating_value)
+        ProductStatisticsService.register_review(product_id=self.product.id, rating=rating_value)
+        ProductDetailCacheService.invalidate(self.product.id)
+        return review
+
+    @transaction.atomic
+    def create_comment(self, text, parent_id):
+        parent = ReviewComment.objects.get(id=parent_id)
+        comment = ReviewComment.objects.create(user=self.user, product=self.product, text=text, parent=parent)
+        ProductStatisticsService.register_comment(product_id=self.product.id)
+        ProductDetailCacheService.invalidate(self.product.id)
+        return comment
 
     def validate_purchase(self):
         if not Order.objects.filter(user=self.user, products=self.product).exists():
             return ValidationError({"error": "товар не приобретен"})
 
 
+class ReviewIngestService:
+    """
+    Пакетная загрузка отзывов и ответов без пересчёта дерева на каждую строку.
+    Id резервируются заранее, поля MPTT считаются в памяти: новые ветки получают свои tree_id,
+    а деревья, в которые добавляются ответы, читаются одним запросом под блокировкой
+    и пересчитываются целиком - обновляются только строки, у которых сдвинулись lft/rght.
+    Вставка идёт через COPY при отключённых обновлениях MPTT.
+    Родитель задаётся parent_id существующего комментария или parent - объектом из того же пакета.
+    """
+
+    def __init__(self, batch_size: int = 10000):
+        self.batch_size = batch_size
+
+    @transaction.atomic
+    def ingest(self, comments: list[ReviewComment]) -> list[ReviewComment]:
+        if not comments:
+            return comments
+        loader = CopyLoader(ReviewComment, include_pk=True, batch_size=self.batch_size)
+        now = timezone.now()
+        for comment, comment_id in zip(comments, loader.reserve_ids(len(comments))):
+            comment.id = comment_id
+            comment.created_at = comment.created_at or now
+            comment.updated_at = comment.updated_at or now
+        for comment in comments:
+            if comment.parent_id is None and comment.parent is not None:
+                comment.parent_id = comment.parent.id
+
+        anchors = self._anchors(comments)
+        existing = self._lock_trees({anchor for anchor in anchors.values() if anchor is not None})
+        missing = {anchor for anchor in anchors.values() if anchor is not None} - existing.keys()
+        if missing:
+            raise ValidationError({"error": f"родительские комментарии не найдены: {sorted(missing)}"})
+        self._check_products(comments, existing)
+
+        trees = {}
+        new_trees = []
+        for comment in comments:
+            anchor = anchors[comment.id]
+            if anchor is None:
+                new_trees.append(comment)
+            else:
+                trees.setdefault(existing[anchor].tree_id, []).append(comment)
+        if new_trees:
+            lock_tree_ids(ReviewComment)
+            assign_tree_fields(new_trees, start_tree_id=next_tree_id(ReviewComment), order_by="created_at")
+
+        shifted = []
+        tree_nodes = {}
+        for node in existing.values():
+            tree_nodes.setdefault(node.tree_id, []).append(node)
+        for tree_id, added in trees.items():
+            nodes = tree_nodes[tree_id]
+            before = {node.id: (node.lft, node.rght) for node in nodes}
+            assign_tree_fields(nodes + added, start_tree_id=tree_id, order_by="created_at")
+            shifted.extend(node for node in nodes if (node.lft, node.rght) != before[node.id])
+
+        created_at = [comment.created_at for comment in comments]
+        with ReviewComment.objects.disable_mptt_updates():
+            loader.load(comments)
+            ReviewComment.objects.bulk_update(shifted, ["lft", "rght"], batch_size=self.batch_size)
+            if not loader.is_postgresql:
+                # bulk_create заменяет auto_now_add текущим временем, а порядок в дереве посчитан по переданному
+                for comment, value in zip(comments, created_at):
+                    comment.created_at = value
+                ReviewComment.objects.bulk_update(comments, ["created_at"], batch_size=self.batch_size)
+
+        ProductStatisticsService.register_reviews(comments)
+        ProductDetailCacheService.invalidate(*{comment.product_id for comment in comments if comment.product_id})
+        return comments
+
+    @staticmethod
+    def _anchors(comments: list[ReviewComment]) -> dict[int, int | None]:
+        """
+        Для каждого нового комментария - id существующего комментария, под которым висит его ветка,
+        или None, если ветка начинается новым отзывом.
+        """
+        parents = {comment.id: comment.parent_id for comment in comments}
+        anchors = {}
+        for comment in comments:
+            chain = []
+            node_id = comment.id
+            while node_id in parents and node_id not in anchors:
+                if len(chain) > len(parents):
+                    raise ValidationError({"error": "комментарии пакета образуют цикл"})
+                chain.append(node_id)
+                node_id = parents[node_id]
+            anchor = anchors[node_id] if node_id in anchors else node_id
+            for node_id in chain:
+                anchors[node_id] = anchor
+        return anchors
+
+    @staticmethod
+    def _check_products(comments: list[ReviewComment], existing: dict[int, ReviewComment]) -> None:
+        """
+        Ответ относится к тому же товару, что и родитель: иначе ветка одного товара попала бы
+        в статистику и выдачу другого.
+        """
+        products = {node.id: node.product_id for node in existing.values()}
+        products.update({comment.id: comment.product_id for comment in comments})
+        mismatched = [
+            comment.id
+            for comment in comments
+            if comment.parent_id is not None and comment.product_id != products[comment.parent_id]
+        ]
+        if mismatched:
+            raise ValidationError({"error": f"товар ответа не совпадает с товаром родителя: {mismatched}"})
+
+    @staticmethod
+    def _lock_trees(parent_ids: set[int]) -> dict[int, ReviewComment]:
+        """
+        Все узлы деревьев, в которые добавляются ответы, в порядке lft. Блокировка не даёт
+        построчным вставкам сдвигать эти деревья до конца загрузки.
+        """
+        if not parent_ids:
+            return {}
+        tree_ids = ReviewComment.objects.filter(id__in=parent_ids).values("tree_id")
+        nodes = (
+            ReviewComment.objects.select_for_update(no_key=True)
+            .filter(tree_id__in=tree_ids)
+            .only("id", "parent_id", "product_id", "created_at", "tree_id", "lft", "rght", "level")
+            .order_by("tree_id", "lft")
+        )
+        return {node.id: node for node in nodes}
+
+
+class ReviewThreadService:
+    """
+    Ветки отзывов: потомки страницы корней выбираются одним запросом по диапазонам tree_id/lft/rght
+    и собираются в дерево за один проход в порядке lft. Глубина ограничивается параметром depth,
+    ответы на каждом уровне - children_page_size, первый уровень под корнем листается children_offset.
+    Остальные ответы узла видны по replies_count и догружаются через ветку этого комментария.
+    """
+
+    DEFAULT_DEPTH = 5
+    MAX_DEPTH = 20
+
+    def __init__(self, params):
+        self.depth = self._int_param(params, "depth", self.DEFAULT_DEPTH, self.MAX_DEPTH)
+        self.children_limit = self._int_param(
+            params, "children_page_size", NestedReviewPagination.page_size, NestedReviewPagination.max_page_size
+        )
+        self.children_offset = self._int_param(params, "children_offset", 0, None)
+
+    def load(self, roots) -> list[ReviewComment]:
+        """
+        Заполняет children_list у корней и их потомков, возвращает корни в исходном порядке.
+        """
+        roots = list(roots)
+        for root in roots:
+            root.children_list = []
+        if not roots or self.depth == 0:
+            return roots
+
+        subtrees = Q()
+        for root in roots:
+            subtrees |= Q(
+                tree_id=root.tree_id, lft__gt=root.lft, rght__lt=root.rght, level__lte=root.level + self.depth
+            )
+        descendants = (
+            ReviewComment.objects.filter(subtrees)
+            .select_related("user")
+            .annotate(position=Window(RowNumber(), partition_by=[F("parent_id")], order_by=F("lft").asc()))
+            .filter(position__lte=self.children_offset + self.children_limit)
+            .order_by("tree_id", "lft")
+        )
+
+        nodes = {root.id: root for root in roots}
+        root_ids = set(nodes)
+        for comment in descendants:
+            parent = nodes.get(comment.parent_id)
+            if parent is None:
+                # предок не попал в страницу своего уровня
+                continue
+            if parent.id in root_ids:
+                if comment.position <= self.children_offset:
+                    continue
+            elif comment.position > self.children_limit:
+                continue
+            comment.children_list = []
+            parent.children_list.append(comment)
+            nodes[comment.id] = comment
+        return roots
+
+    @staticmethod
+    def _int_param(params, name: str, default: int, maximum: int | None) -> int:
+        try:
+            value = int(params[name])
+        except (KeyError, ValueError):
+            return default
+        if value < 0:
+            return default
+        return value if maximum is None else min(value, maximum)
+
+
+class AttributeIndexService:
+    """
+    Типизированная проекция EAV-значений товаров в ProductAttributeIndex:
+    числовые атрибуты хранятся в value_number, остальные - в value_text, оба поля под составными индексами.
+    Фильтр по нескольким атрибутам собирается в один запрос из полусоединений (id IN подзапрос) по этим индексам.
+    """
+
+    NUMBER_DATATYPES = {Attribute.TYPE_INT, Attribute.TYPE_FLOAT}
+
+    @classmethod
+    def project(cls, product_id: int, attribute: str, value, datatype: str) -> ProductAttributeIndex:
+        if hasattr(value, "value"):
+            value = value.value
+        if datatype in cls.NUMBER_DATATYPES:
+            return ProductAttributeIndex(product_id=product_id, attribute=attribute, value_number=float(value))
+        return ProductAttributeIndex(product_id=product_id, attribute=attribute, value_text=str(value))
+
+    @staticmethod
+    def save(rows: list[ProductAttributeIndex]) -> None:
+        ProductAttributeIndex.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=["product", "attribute"],
+            update_fields=["value_text", "value_number"],
+        )
+
+    @classmethod
+    def sync(cls, product_id: int, attributes: dict) -> None:
+        """
+        Тип значения берётся из сохранённых Attribute, а не из запроса: переданный клиентом тип
+        может расходиться с типом атрибута, и значение попало бы не в ту колонку индекса.
+        """
+        datatypes = dict(Attribute.objects.filter(slug__in=attributes.keys()).values_list("slug", "datatype"))
+        cls.save(
+            [
+                cls.project(product_id, attribute, value, datatypes[attribute])
+                for attribute, (value, _) in attributes.items()
+                if value is not None and attribute in datatypes
+            ]
+        )
+
+    @staticmethod
+    def delete(product_id: int, attribute_name: str) -> None:
+        ProductAttributeIndex.objects.filter(product_id=product_id, attribute=attribute_name).delete()
+
+    @classmethod
+    def rebuild(cls, batch_size: int = 10000) -> int:
+        values = (
+            Value.objects.filter(entity_ct=ContentType.objects.get_for_model(Product), entity_id__isnull=False)
+            .select_related("attribute", "value_enum")
+            .order_by()
+            .iterator(chunk_size=batch_size)
+        )
+        rebuilt = 0
+        rows = []
+        for value in values:
+            if value.value is None:
+                continue
+            rows.append(cls.project(value.entity_id, value.attribute.slug, value.value, value.attribute.datatype))
+            if len(rows) >= batch_size:
+                cls.save(rows)
+                rebuilt += len(rows)
+                rows = []
+        cls.save(rows)
+        return rebuilt + len(rows)
+
+    @staticmethod
+    def text_filter(attribute: str, values) -> Q:
+        values = values if isinstance(values, (list, tuple, set)) else [values]
+        matched = ProductAttributeIndex.objects.filter(
+            attribute=attribute, value_text__in=[str(value) for value in values]
+        ).values("product_id")
+        return Q(id__in=matched)
+
+    @staticmethod
+    def number_filter(attribute: str, gte: float | None = None, lte: float | None = None) -> Q:
+        range_filters = {}
+        if gte is not None:
+            range_filters["value_number__gte"] = float(gte)
+        if lte is not None:
+            range_filters["value_number__lte"] = float(lte)
+        matched = ProductAttributeIndex.objects.filter(
+            attribute=attribute, value_number__isnull=False, **range_filters
+        ).values("product_id")
+        return Q(id__in=matched)
+
+
+class FacetService:
+    """
+    Счётчики фасетов (категории, ценовые диапазоны, значения атрибутов) для текущего состояния фильтров.
+    Каждый тип фасета считается одним GROUP BY по уже отфильтрованному набору товаров;
+    результат кэшируется по нормализованному ключу фильтров.
+    """
+
+    PRICE_BUCKETS = [0, 500, 1000, 2000, 5000, None]
+    IGNORED_PARAMS = {"page", "page_size", "cursor", "pagination", "ordering", "stream"}
+
+    def __init__(self, queryset, params):
+        self.queryset = queryset.order_by()
+        self.params = params
+
+    def get_cache_key(self) -> str:
+        normalized = {}
+        for key in sorted(set(self.params.keys()) - self.IGNORED_PARAMS):
+            values = self.params.getlist(key) if hasattr(self.params, "getlist") else [self.params[key]]
+            if key == "filters":
+                try:
+                    values = [json.loads(value) for value in values]
+                except ValueError:
+                    pass
+            normalized[key] = values
+        digest = hashlib.sha1(json.dumps(normalized, sort_keys=True, default=str).encode()).hexdigest()
+        return f"product-facets:{digest}"
+
+    def get_facets(self) -> dict:
+        cache_key = self.get_cache_key()
+        facets = cache.get(cache_key)
+        if facets is None:
+            facets = {
+                "categories": self.count_categories(),
+                "price": self.count_price_buckets(),
+                "attributes": self.count_attributes(),
+            }
+            cache.set(cache_key, facets, settings.FACETS_CACHE_TIMEOUT)
+        return facets
+
+    def count_categories(self) -> list[dict]:
+        rows = (
+            self.queryset.values("category_id", "category__name")
+            .annotate(count=Count("id"))
+            .order_by("-count", "category_id")
+        )
+        return [
+            {"category_id": row["category_id"], "category_name": row["category__name"], "count": row["count"]}
+            for row in rows
+        ]
+
+    def count_price_buckets(self) -> list[dict]:
+        buckets = list(zip(self.PRICE_BUCKETS, self.PRICE_BUCKETS[1:]))
+        aggregates = {}
+        for number, (price_from, price_to) in enumerate(buckets):
+            condition = Q(price__gte=price_from)
+            if price_to is not None:
+                condition &= Q(price__lt=price_to)
+            aggregates[f"bucket_{number}"] = Count("id", filter=condition)
+        counts = self.queryset.aggregate(**aggregates)
+        return [
+            {"from": price_from, "to": price_to, "count": counts[f"bucket_{number}"]}
+            for number, (price_from, price_to) in enumerate(buckets)
+        ]
+
+    def count_attributes(self) -> dict:
+        rows = (
+            ProductAttributeIndex.objects.filter(product_id__in=self.queryset.values("id"))
+            .values("attribute", "value_text", "value_number")
+            .annotate(count=Count("product_id"))
+            .order_by("attribute", "-count")
+        )
+        attributes = {}
+        for row in rows:
+            value = row["value_text"] if row["value_number"] is None else row["value_number"]
+            attributes.setdefault(row["attribute"], []).append({"value": value, "count": row["count"]})
+        return attributes
+
+
 class ProductAttributeService:
     def __init__(self, product_id, attributes):
         self.product = Product.objects.get(id=product_id)
         self.attributes = attributes
 
+    @transaction.atomic
     def attach_attribute(self):
         for attr in self.attributes:
             setattr(self.product.eav, attr, self.attributes[attr][0])
         self.product.save()
+        AttributeIndexService.sync(self.product.id, self.attributes)
+        ProductDetailCacheService.invalidate(self.product.id)
         return self.product
 
 
@@ -85,8 +831,11 @@ class AttributeService:
         return self.attributes
 
     @staticmethod
+    @transaction.atomic
     def delete_attribute(product_id, attribute_name):
         Value.objects.filter(entity_id=product_id, attribute__name=attribute_name).delete()
+        AttributeIndexService.delete(product_id, attribute_name)
+        ProductDetailCacheService.invalidate(product_id)
 
 
 class BalanceProcessor(ABC):
@@ -114,27 +863,64 @@ class FileProcessor(ABC):
     def process(self, file):
         pass
 
+    @abstractmethod
+    def iter_chunks(self, file, chunk_size: int) -> Iterator[list[dict]]:
+        pass
+
+    @staticmethod
+    def _records(frame: pd.DataFrame) -> list[dict]:
+        return frame.astype(object).where(frame.notna(), None).to_dict(orient="records")
+
 
 class CsvFileProcessor(FileProcessor):
     def process(self, file):
         data = pd.read_csv(file).to_dict(orient="records")
         return data
 
+    def iter_chunks(self, file, chunk_size: int) -> Iterator[list[dict]]:
+        with pd.read_csv(file, chunksize=chunk_size) as reader:
+            for frame in reader:
+                yield self._records(frame)
+
 
 class ExcelFileProcessor(FileProcessor):
     def process(self, file):
         data = pd.read_excel(file).to_dict(orient="records")
         return data
 
+    def iter_chunks(self, file, chunk_size: int) -> Iterator[list[dict]]:
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            chunk = []
+            for row in rows:
+                chunk.append(dict(zip(header, row)))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        finally:
+            workbook.close()
+
 
 class FileProcessorFactory:
     PROCESSORS = {".csv": CsvFileProcessor(), ".xlsx": ExcelFileProcessor(), ".xls": ExcelFileProcessor()}
+    # кусками читаются только форматы с построчным чтением: openpyxl не открывает старый .xls
+    STREAMING_EXTENSIONS = {".csv", ".xlsx"}
 
     @classmethod
-    def get_processor(cls, filename: str) -> FileProcessor:
+    def get_processor(cls, filename: str, streaming: bool = False) -> FileProcessor:
         extension = Path(filename).suffix.lower()
         if extension not in cls.PROCESSORS:
             raise ValueError("неподдерживаемый файл")
+        if streaming and extension not in cls.STREAMING_EXTENSIONS:
+            raise ValueError(
+                f"файлы {extension} загружаются только целиком, для загрузки кусками сохраните файл в .xlsx"
+            )
         return cls.PROCESSORS[extension]
 
 
@@ -146,10 +932,12 @@ class ProductFileProcessor:
         self.file = file
 
     def create_products(self):
+        self._load_data(self.file)
         self._prepare_categories()
         products = self._prepare_products()
-        self._load_data(self.file)
         Product.objects.bulk_create(products)
+        ProductStatisticsService.ensure_statistics([product.id for product in products if product.id])
+        ProductSearchDocumentService.refresh_products([product.id for product in products if product.id])
 
     def _load_data(self, file) -> None:
         self.data = self.file_processor.process(file)
@@ -183,13 +971,268 @@ class ProductFileProcessor:
 
     @staticmethod
     def _calculate_price(product: Dict) -> Decimal:
-        old_price = product.get("price")
+        old_price = product.get("old_price") or product.get("price")
         discount = product.get("discount", 0)
         if old_price and discount:
-            return Decimal(old_price) * (1 - Decimal(discount) / 100)
+            return Decimal(str(old_price)) * (1 - Decimal(str(discount)) / 100)
         return old_price
 
 
+class StreamingProductFileProcessor(ProductFileProcessor):
+    """
+    Потоковый импорт: файл читается кусками по chunk_size строк, категории резолвятся по чанку
+    с общим кэшем, каждый чанк вставляется в своей транзакции. Память ограничена размером чанка.
+    """
+
+    def __init__(
+        self,
+        file_processor: FileProcessor,
+        file: UploadedFile,
+        chunk_size: int = 10000,
+        on_chunk: Callable[[dict, dict], None] | None = None,
+        use_copy: bool = False,
+    ):
+        super().__init__(file_processor=file_processor, file=file)
+        self.chunk_size = chunk_size
+        self.on_chunk = on_chunk
+        self.use_copy = use_copy
+
+    report_counters = ("created", "rejected")
+    validated_fields = ("name", "description", "old_price", "discount", "price", "available_quantity", "external_id")
+    CENT = Decimal("0.01")
+
+    def create_products(self) -> dict:
+        report = {"rows_total": 0, **{f"rows_{counter}": 0 for counter in self.report_counters}}
+        report.update(rows_per_sec=0, chunks=[])
+        started = time.perf_counter()
+
+        for number, rows in enumerate(self.file_processor.iter_chunks(self.file, self.chunk_size), start=1):
+            chunk_report = self._process_chunk(number, rows)
+            report["chunks"].append(chunk_report)
+            report["rows_total"] += chunk_report["rows"]
+            for counter in self.report_counters:
+                report[f"rows_{counter}"] += chunk_report[counter]
+            if self.on_chunk is not None:
+                elapsed = time.perf_counter() - started
+                report["rows_per_sec"] = round(report["rows_total"] / elapsed, 1) if elapsed else 0
+                self.on_chunk(chunk_report, report)
+
+        elapsed = time.perf_counter() - started
+        report["rows_per_sec"] = round(report["rows_total"] / elapsed, 1) if elapsed else 0
+        return report
+
+    def _process_chunk(self, number: int, rows: list[dict]) -> dict:
+        started = time.perf_counter()
+        self._resolve_categories(rows)
+
+        products = []
+        for row in rows:
+            product = self._build_product(row)
+            if product is not None:
+                products.append(product)
+
+        with transaction.atomic():
+            counters = self._write_chunk(products)
+        # _write_chunk может отклонить часть собранных товаров сам, например дубли внутри чанка
+        counters["rejected"] = counters.get("rejected", 0) + len(rows) - len(products)
+
+        elapsed = time.perf_counter() - started
+        chunk_report = {
+            "chunk": number,
+            "rows": len(rows),
+            **counters,
+            "rows_per_sec": round(len(rows) / elapsed, 1) if elapsed else 0,
+        }
+        logger.info(
+            "product import chunk %(chunk)s: %(rows)s rows, %(rejected)s rejected, %(rows_per_sec)s rows/s",
+            chunk_report,
+        )
+        return chunk_report
+
+    def _write_chunk(self, products: list[Product]) -> dict:
+        if self.use_copy:
+            product_loader = CopyLoader(Product, include_pk=True, batch_size=self.chunk_size)
+            for product, product_id in zip(products, product_loader.reserve_ids(len(products))):
+                product.id = product_id
+            product_loader.load(products)
+            CopyLoader(ProductStatistics, include_pk=True, batch_size=self.chunk_size).load(
+                ProductStatistics(product_id=product.id) for product in products
+            )
+        else:
+            Product.objects.bulk_create(products, batch_size=self.chunk_size)
+            ProductStatisticsService.ensure_statistics([product.id for product in products if product.id])
+        ProductSearchDocumentService.refresh_products([product.id for product in products if product.id])
+        return {"created": len(products)}
+
+    def _resolve_categories(self, rows: list[dict]) -> None:
+        missing = {row.get("category") for row in rows} - self.category_cache.keys() - {None}
+        if missing:
+            categories = ProductCategory.objects.filter(name__in=missing)
+            self.category_cache.update({category.name: category for category in categories})
+
+    def _build_product(self, row: dict) -> Product | None:
+        """
+        Товар из строки файла или None, если строка отклоняется. Значения проверяются валидаторами полей
+        модели (длина строк, неотрицательность, разрядность цен): строка, которая нарушила бы ограничение
+        базы, иначе уронила бы весь чанк.
+        """
+        category = self.category_cache.get(row.get("category"))
+        if category is None or not row.get("name") or row.get("old_price") is None:
+            return None
+        try:
+            product = Product(
+                name=str(row["name"]),
+                old_price=Decimal(str(row["old_price"])).quantize(self.CENT),
+                available_quantity=int(row.get("available_quantity") or 0),
+                category=category,
+                description=str(row.get("description") or ""),
+                discount=int(row.get("discount") or 0),
+                price=Decimal(str(self._calculate_price(row))).quantize(self.CENT),
+                external_id=str(row["external_id"]) if row.get("external_id") is not None else None,
+            )
+            for field_name in self.validated_fields:
+                Product._meta.get_field(field_name).run_validators(getattr(product, field_name))
+        except (TypeError, ValueError, ArithmeticError, DjangoValidationError):
+            return None
+        return product
+
+
+class UpsertProductFileProcessor(StreamingProductFileProcessor):
+    """
+    Импорт с обновлением по external_id: чанк сравнивается с существующими товарами одним запросом,
+    в базу уходят только новые строки и строки с изменившимися ценой, скидкой или остатком.
+    Остаток шардированных товаров раскладывается по шардам через StockShardService.set_stock,
+    иначе сверка шардов перезаписала бы импортированное значение.
+    При повторе external_id внутри чанка побеждает последняя строка, предыдущие считаются отклонёнными.
+    Флаг available выставляется по остатку только у новых товаров: у существующих его мог снять вручную менеджер.
+    """
+
+    report_counters = ("created", "updated", "unchanged", "rejected")
+    compared_fields = ("old_price", "discount", "price", "available_quantity")
+
+    def _build_product(self, row: dict) -> Product | None:
+        product = super()._build_product(row)
+        if product is None or not product.external_id:
+            return None
+        product.available = product.available_quantity > 0
+        return product
+
+    def _write_chunk(self, products: list[Product]) -> dict:
+        incoming = {product.external_id: product for product in products}
+        duplicates = len(products) - len(incoming)
+        existing = {
+            row["external_id"]: row
+            for row in Product.objects.filter(external_id__in=incoming.keys()).values(
+                "external_id", "id", "stock_shards", *self.compared_fields
+            )
+        }
+
+        created = [product for external_id, product in incoming.items() if external_id not in existing]
+        changed = [
+            product
+            for external_id, product in incoming.items()
+            if external_id in existing
+            and any(getattr(product, field) != existing[external_id][field] for field in self.compared_fields)
+        ]
+
+        Product.objects.bulk_create(created, batch_size=self.chunk_size)
+        ProductStatisticsService.ensure_statistics([product.id for product in created if product.id])
+        ProductSearchDocumentService.refresh_products([product.id for product in created if product.id])
+        for product in changed:
+            row = existing[product.external_id]
+            if row["stock_shards"] and product.available_quantity != row["available_quantity"]:
+                StockShardService.set_stock(row["id"], product.available_quantity)
+        Product.objects.bulk_create(
+            changed,
+            batch_size=self.chunk_size,
+            update_conflicts=True,
+            unique_fields=["external_id"],
+            update_fields=list(self.compared_fields),
+        )
+        ProductDetailCacheService.invalidate(*[existing[product.external_id]["id"] for product in changed])
+        return {
+            "created": len(created),
+            "updated": len(changed),
+            "unchanged": len(incoming) - len(created) - len(changed),
+            "rejected": duplicates,
+        }
+
+
+class ProductImportJobService:
+    """
+    Фоновый импорт: файл сохраняется на локальный диск, обработка идёт в celery-задаче
+    через StreamingProductFileProcessor, прогресс пишется в ProductImportJob после каждого чанка.
+    """
+
+    storage = FileSystemStorage(location=settings.PRODUCT_IMPORT_DIR)
+
+    @classmethod
+    def enqueue(
+        cls, file: UploadedFile, user=None, chunk_size: int = 10000, mode: str = ProductImportJob.Mode.INSERT
+    ) -> ProductImportJob:
+        FileProcessorFactory.get_processor(file.name, streaming=True)
+        stored_name = cls.storage.save(f"{uuid.uuid4().hex}{Path(file.name).suffix.lower()}", file)
+        job = ProductImportJob.objects.create(
+            user=user if user is not None and user.is_authenticated else None,
+            file_name=file.name,
+            file_path=cls.storage.path(stored_name),
+            chunk_size=chunk_size,
+            mode=mode,
+        )
+        transaction.on_commit(lambda: import_products_file.delay(job.id))
+        return job
+
+    @classmethod
+    def run(cls, job_id: int) -> None:
+        claimed = ProductImportJob.objects.filter(id=job_id, state=ProductImportJob.State.PENDING).update(
+            state=ProductImportJob.State.RUNNING, started_at=timezone.now()
+        )
+        if not claimed:
+            return
+
+        job = ProductImportJob.objects.get(id=job_id)
+        try:
+            file_processor = FileProcessorFactory.get_processor(job.file_name, streaming=True)
+            processor_class = (
+                UpsertProductFileProcessor
+                if job.mode == ProductImportJob.Mode.UPSERT
+                else StreamingProductFileProcessor
+            )
+            with open(job.file_path, "rb") as file:
+                processor = processor_class(
+                    file_processor=file_processor,
+                    file=file,
+                    chunk_size=job.chunk_size,
+                    on_chunk=lambda chunk_report, report: cls._save_progress(job_id, report),
+                )
+                report = processor.create_products()
+        except Exception as e:
+            logger.exception("product import job %s failed", job_id)
+            ProductImportJob.objects.filter(id=job_id).update(
+                state=ProductImportJob.State.FAILED, error=str(e), finished_at=timezone.now()
+            )
+            return
+        finally:
+            # задача из PENDING забирается один раз, повторно файл не понадобится и после ошибки
+            Path(job.file_path).unlink(missing_ok=True)
+
+        cls._save_progress(job_id, report)
+        ProductImportJob.objects.filter(id=job_id).update(
+            state=ProductImportJob.State.SUCCEEDED, finished_at=timezone.now()
+        )
+
+    @staticmethod
+    def _save_progress(job_id: int, report: dict) -> None:
+        ProductImportJob.objects.filter(id=job_id).update(
+            rows_processed=report["rows_total"],
+            rows_created=report["rows_created"],
+            rows_updated=report.get("rows_updated", 0),
+            rows_unchanged=report.get("rows_unchanged", 0),
+            rows_failed=report["rows_rejected"],
+            rows_per_sec=report["rows_per_sec"],
+        )
+
+
 class ProductService:
     def __init__(
         self,
@@ -202,8 +1245,11 @@ class ProductService:
         self.field = field
 
     def update_field(self, field_value: int | str) -> Product:
+        if self.field == "available_quantity" and self.product.stock_shards:
+            StockShardService.set_stock(self.product.id, int(field_value))
         setattr(self.product, self.field, field_value)
         self.product.save()
+        ProductDetailCacheService.invalidate(self.product.id)
         return self.product
 
 
@@ -212,29 +1258,275 @@ class OrderItemsService(ABC):
     def validate_quantity(self):
         pass
 
+    @staticmethod
+    def lock_stock(product_ids) -> dict[int, Product]:
+        """
+        Блокирует строки товаров в порядке id, одинаковом для оформлений, резервов и их снятия,
+        поэтому взаимных блокировок между ними нет. FOR NO KEY UPDATE: меняется только остаток,
+        и вставки позиций корзин и заказов (проверка внешнего ключа берёт FOR KEY SHARE) не ждут.
+        Товары с шардированным остатком читаются без блокировки: их остаток списывается с шардов.
+        """
+        product_ids = sorted(set(product_ids))
+        fields = ("id", "name", "price", "available_quantity", "stock_shards")
+        products = {
+            product.id: product
+            for product in Product.objects.select_for_update(no_key=True)
+            .filter(id__in=product_ids, stock_shards=0)
+            .order_by("id")
+            .only(*fields)
+        }
+        if len(products) < len(product_ids):
+            sharded = Product.objects.filter(id__in=product_ids, stock_shards__gt=0).only(*fields)
+            products.update((product.id, product) for product in sharded)
+        return products
+
+    @staticmethod
+    def decrement_stock(decrements: dict[int, int]) -> dict[int, int]:
+        """
+        Одно выражение UPDATE ... RETURNING для всех товаров. Условие available_quantity >= списание
+        не даёт остатку уйти в минус; если какая-то строка не обновилась, вся операция откатывается.
+        Возвращает новые остатки {product_id: available_quantity}.
+        """
+        remaining = OrderItemsService._update_stock(decrements, "-")
+        if len(remaining) != len(decrements):
+            raise ValidationError("остаток товара изменился, повторите оформление")
+        return remaining
 
-class ExternalOrderItemsService(OrderItemsService):
-    def __init__(self, order_data: list[CartItems]):
-        self.products = Product.objects.filter(id__in=[product.product_id for product in order_data])
-        self.order_data = order_data
+    @staticmethod
+    def increment_stock(increments: dict[int, int]) -> dict[int, int]:
+        return OrderItemsService._update_stock(increments, "+")
 
-    def validate_quantity(self) -> list[Product]:
-        updated_products = []
-        for product, order_item in zip(self.products, self.order_data):
-            if product.available_quantity == 0:
+    @staticmethod
+    def _update_stock(deltas: dict[int, int], operator: Literal["+", "-"]) -> dict[int, int]:
+        if not deltas:
+            return {}
+        quote = connection.ops.quote_name
+        table, pk, quantity = quote(Product._meta.db_table), quote("id"), quote("available_quantity")
+        case = f"CASE {pk} " + " ".join(["WHEN %s THEN %s"] * len(deltas)) + " END"
+        case_params = [value for pair in deltas.items() for value in pair]
+        placeholders = ", ".join(["%s"] * len(deltas))
+        sql = f"UPDATE {table} SET {quantity} = {quantity} {operator} {case} WHERE {pk} IN ({placeholders})"
+        params = [*case_params, *deltas]
+        if operator == "-":
+            sql += f" AND {quantity} >= {case}"
+            params += case_params
+        with connection.cursor() as cursor:
+            cursor.execute(f"{sql} RETURNING {pk}, {quantity}", params)
+            return dict(cursor.fetchall())
+
+
+class StockReservationService(OrderItemsService):
+    """
+    Пакетное резервирование остатков под заказы внешних площадок.
+    Все строки пакета обрабатываются одной транзакцией: товары блокируются одним запросом,
+    остатки распределяются по строкам в порядке их следования, списание идёт одним UPDATE.
+    Резерв держится до expires_at; неподтверждённые резервы возвращает на склад release_expired.
+    """
+
+    def __init__(self, user, orders: list[dict], ttl: int | None = None):
+        self.user = user
+        self.orders = orders
+        self.ttl = ttl or settings.STOCK_RESERVATION_TTL
+
+    def get_lines(self) -> dict[tuple[str, int], int]:
+        """
+        Строки пакета {(external_order_id, product_id): количество}; повторы товара в заказе суммируются.
+        """
+        lines = {}
+        for order in self.orders:
+            for item in order["items"]:
+                key = (order["external_order_id"], item["product_id"])
+                lines[key] = lines.get(key, 0) + item["quantity"]
+        return lines
+
+    def reserve(self) -> dict:
+        try:
+            return self._reserve()
+        except IntegrityError:
+            # параллельный повтор того же пакета успел создать резервы: отдаём сохранённый результат
+            return self._reserve()
+
+    @transaction.atomic
+    def _reserve(self) -> dict:
+        lines = self.get_lines()
+        # товары блокируются до чтения сохранённых резервов: параллельный повтор пакета ждёт здесь
+        # и после коммита первого видит его резервы
+        products = self.lock_stock(product_id for _, product_id in lines)
+        existing = {
+            (reservation.external_order_id, reservation.product_id): reservation
+            for reservation in StockReservation.objects.filter(
+                user=self.user, external_order_id__in={external_id for external_id, _ in lines}
+            )
+        }
+        new_lines = {key: quantity for key, quantity in lines.items() if key not in existing}
+        reservations = self.validate_quantity(new_lines, products)
+
+        decrements = {}
+        for reservation in reservations:
+            if not products[reservation.product_id].stock_shards:
+                decrements[reservation.product_id] = decrements.get(reservation.product_id, 0) + reservation.quantity
+        self.decrement_stock(decrements)
+        ProductDetailCacheService.invalidate(*decrements)
+        loader = CopyLoader(StockReservation, include_pk=True)
+        for reservation, reservation_id in zip(reservations, loader.reserve_ids(len(reservations))):
+            reservation.id = reservation_id
+        loader.load(reservations)
+        for reservation in reservations:
+            existing[reservation.external_order_id, reservation.product_id] = reservation
+        return self.build_result(lines, existing, products)
+
+    def validate_quantity(self, lines: dict[tuple[str, int], int], products: dict[int, Product]):
+        """
+        Распределяет остаток заблокированных товаров по строкам в порядке следования:
+        строка получает min(запрошено, осталось). Строки без остатка резерва не получают.
+        С шардированных товаров сразу списывается сумма запрошенного по всем строкам, она и распределяется.
+        """
+        expires_at = timezone.now() + timedelta(seconds=self.ttl)
+        stock = {}
+        sharded = {}
+        for (_, product_id), requested in lines.items():
+            product = products.get(product_id)
+            if product is None:
                 continue
-            order_item.quantity = min(product.available_quantity, order_item.quantity)
-            product.available_quantity -= order_item.quantity
-            updated_products.append(product)
-        Product.objects.bulk_update(updated_products, ["available_quantity"])
-        return updated_products
+            if product.stock_shards:
+                sharded[product_id] = sharded.get(product_id, 0) + requested
+            else:
+                stock[product_id] = product.available_quantity
+        for product_id, requested in sorted(sharded.items()):
+            stock[product_id] = StockShardService.take(product_id, requested)
+        reservations = []
+        for (external_order_id, product_id), requested in lines.items():
+            quantity = min(requested, stock.get(product_id, 0))
+            if quantity == 0:
+                continue
+            stock[product_id] -= quantity
+            reservations.append(
+                StockReservation(
+                    user=self.user,
+                    external_order_id=external_order_id,
+                    product_id=product_id,
+                    requested_quantity=requested,
+                    quantity=quantity,
+                    expires_at=expires_at,
+                )
+            )
+        return reservations
+
+    @staticmethod
+    def build_result(lines: dict, reservations: dict, products: dict) -> dict:
+        """
+        Снятые и истёкшие резервы остаток не держат: такие строки возвращаются с reserved 0
+        и статусом released/expired.
+        """
+        now = timezone.now()
+        orders = {}
+        for (external_order_id, product_id), requested in lines.items():
+            reservation = reservations.get((external_order_id, product_id))
+            reserved = reservation.quantity if reservation else 0
+            status = "reserved" if reserved >= requested else "partial" if reserved else "rejected"
+            if reservation and not (
+                reservation.state == StockReservation.State.CONFIRMED
+                or reservation.state == StockReservation.State.ACTIVE
+                and reservation.expires_at > now
+            ):
+                reserved = 0
+                # активный резерв с прошедшим expires_at ещё не снят сборщиком, но уже не действует
+                status = "expired" if reservation.state == StockReservation.State.ACTIVE else str(reservation.state)
+            line = {
+                "product_id": product_id,
+                "requested": requested,
+                "reserved": reserved,
+                "status": status,
+            }
+            if reservation:
+                line.update(reservation_id=reservation.id, state=reservation.state, expires_at=reservation.expires_at)
+            elif product_id not in products:
+                line["error"] = "товар не найден"
+            orders.setdefault(external_order_id, []).append(line)
+
+        result = []
+        for external_order_id, items in orders.items():
+            statuses = {item["status"] for item in items}
+            status = statuses.pop() if len(statuses) == 1 else "partial"
+            result.append({"external_order_id": external_order_id, "status": status, "items": items})
+        return {"orders": result}
+
+    @staticmethod
+    def confirm(user, external_order_ids: list[str]) -> int:
+        """
+        Подтверждает действующие резервы: остаток остаётся списанным, резерв больше не истекает.
+        """
+        return StockReservation.objects.filter(
+            user=user,
+            external_order_id__in=external_order_ids,
+            state=StockReservation.State.ACTIVE,
+            expires_at__gt=timezone.now(),
+        ).update(state=StockReservation.State.CONFIRMED)
+
+    @classmethod
+    def release(cls, user, external_order_ids: list[str]) -> int:
+        reservations = StockReservation.objects.filter(
+            user=user, external_order_id__in=external_order_ids, state=StockReservation.State.ACTIVE
+        ).order_by("id")
+        return cls._release(reservations, StockReservation.State.RELEASED)
+
+    @classmethod
+    def release_expired(cls, batch_size: int = 1000) -> int:
+        """
+        Возвращает на склад истёкшие резервы пачками по batch_size.
+        Строки, заблокированные подтверждением или другим сборщиком, пропускаются до следующего запуска.
+        """
+        released = 0
+        while True:
+            expired = StockReservation.objects.filter(
+                state=StockReservation.State.ACTIVE, expires_at__lte=timezone.now()
+            ).order_by("expires_at")[:batch_size]
+            count = cls._release(expired, StockReservation.State.EXPIRED, skip_locked=True)
+            released += count
+            if count < batch_size:
+                return released
+
+    @classmethod
+    @transaction.atomic
+    def _release(cls, reservations, state: str, skip_locked: bool = False) -> int:
+        rows = list(
+            reservations.select_for_update(skip_locked=skip_locked, no_key=True).values_list(
+                "id", "product_id", "quantity"
+            )
+        )
+        if not rows:
+            return 0
+        increments = {}
+        for _, product_id, quantity in rows:
+            increments[product_id] = increments.get(product_id, 0) + quantity
+        products = cls.lock_stock(increments)
+        cls.increment_stock(
+            {
+                product_id: quantity
+                for product_id, quantity in increments.items()
+                if product_id in products and not products[product_id].stock_shards
+            }
+        )
+        for product_id, quantity in sorted(increments.items()):
+            if product_id in products and products[product_id].stock_shards:
+                StockShardService.give_back(product_id, quantity)
+        ProductDetailCacheService.invalidate(*increments)
+        StockReservation.objects.filter(id__in=[row[0] for row in rows]).update(state=state)
+        return len(rows)
 
 
 class InternalOrderItemsService(OrderItemsService):
+    """
+    Списание остатков при оформлении заказа из корзины.
+    Строки товаров блокируются в порядке id, одинаковом для всех оформлений, поэтому взаимных блокировок нет;
+    остатки уменьшаются одним условным UPDATE ... RETURNING. Шардированные товары не блокируются,
+    их остаток списывается с шардов в том же порядке id.
+    """
+
     def __init__(self, order_data: list[CartItems], order: Order):
-        self.products = Product.objects.filter(id__in=[product.product_id for product in order_data])
         self.order_data = order_data
         self.order = order
+        self.products = {}
 
     @staticmethod
     def count_total_sum(order_items) -> Decimal:
@@ -243,68 +1535,122 @@ class InternalOrderItemsService(OrderItemsService):
             total_sum += item.quantity * item.price
         return Decimal(total_sum)
 
-    def validate_quantity(self) -> tuple[list[OrderItems], list[Product]]:
-        updated_products = []
-        order_items = []
-        for product, order_item in zip(self.products, self.order_data):
-            if product.available_quantity == 0:
-                continue
-            order_item.quantity = min(product.available_quantity, order_item.quantity)
-            product.available_quantity -= order_item.quantity
-            updated_products.append(product)
-            order_items.append(
-                OrderItems(
-                    order=self.order,
-                    price=Decimal(order_item.price),
-                    product_id=order_item.product_id,
-                    quantity=order_item.quantity,
-                )
-            )
-        return order_items, updated_products
+    def lock_products(self) -> dict[int, Product]:
+        self.products = self.lock_stock(item.product_id for item in self.order_data)
+        return self.products
 
+    def validate_quantity(self) -> tuple[list[OrderItems], dict[int, int]]:
+        """
+        Количество по каждому товару урезается до остатка заблокированной строки.
+        Возвращает позиции заказа и списания {product_id: количество} для нешардированных товаров;
+        с шардов остаток списывается сразу.
+        """
+        requested = {}
+        prices = {}
+        for item in self.order_data:
+            requested[item.product_id] = requested.get(item.product_id, 0) + item.quantity
+            prices.setdefault(item.product_id, item.price)
 
-class CartItemsService:
-    @staticmethod
-    def validate_quantity(requested_quantity: int, cart: Cart, product_id: int):
-        print(cart, product_id)
-        cart_item = CartItems.objects.get(cart=cart, product=product_id)
-        product = Product.objects.get(pk=product_id)
-        if product.available_quantity == 0:
-            raise ValueError("not enough product")
-        cart_item.quantity = min(product.available_quantity, requested_quantity)
-        cart_item.price = product.price
-        cart_item.save()
-        return cart
+        order_items = []
+        decrements = {}
+        for product_id, quantity in sorted(requested.items()):
+            product = self.products.get(product_id)
+            price = prices[product_id] if prices[product_id] is not None else getattr(product, "price", None)
+            if product is None or price is None:
+                continue
+            if product.stock_shards:
+                quantity = StockShardService.take(product_id, quantity)
+            else:
+                quantity = decrements[product_id] = min(product.available_quantity, quantity)
+            if quantity == 0:
+                decrements.pop(product_id, None)
+                continue
+            order_items.append(OrderItems(order=self.order, product=product, price=Decimal(price), quantity=quantity))
+        return order_items, decrements
 
 
 class OrderService:
-    def __init__(self, user, payment_processor: BalanceProcessor):
+    IDEMPOTENCY_KEY_MAX_LENGTH = 64
+
+    def __init__(self, user, payment_processor: BalanceProcessor, idempotency_key: str | None = None):
         self.user = user
         self.payment_processor = payment_processor
-        self.order = Order.objects.create(user=self.user)
+        self.idempotency_key = idempotency_key
+        self.order = None
+        self.replayed = False
+        if idempotency_key is not None and not 0 < len(idempotency_key) <= self.IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise ValidationError(
+                f"ключ идемпотентности должен быть от 1 до {self.IDEMPOTENCY_KEY_MAX_LENGTH} символов"
+            )
+
+    def get_existing_order(self) -> Order | None:
+        """
+        Заказ, уже оформленный с этим ключом: повтор запроса стоит одного поиска по уникальному индексу
+        и не берёт блокировок корзины, товаров и баланса.
+        """
+        if self.idempotency_key is None:
+            return None
+        order = Order.objects.filter(user=self.user, idempotency_key=self.idempotency_key).first()
+        self.replayed = order is not None
+        return order
 
-    @transaction.atomic
     def create_order(self) -> Order | ValidationError:
-        cart_items = CartItems.objects.select_for_update().filter(cart__user=self.user)
+        try:
+            return self._create_order()
+        except IntegrityError:
+            # параллельный запрос с тем же ключом успел зафиксировать заказ раньше
+            if order := self.get_existing_order():
+                self.replayed = True
+                return order
+            raise
+        except OperationalError as e:
+            if getattr(e.__cause__, "pgcode", None) == LOCK_NOT_AVAILABLE:
+                raise ValidationError("товары заказа заблокированы другими оформлениями, повторите попытку")
+            raise
+
+    @transaction.atomic
+    def _create_order(self) -> Order:
+        # заказ создаётся первым в транзакции: дубль с тем же ключом ждёт на уникальном индексе,
+        # а при любой ошибке оформления строка откатывается вместе с остальным
+        self.order = Order.objects.create(user=self.user, idempotency_key=self.idempotency_key, sales_pending=True)
+        # ограничение ставится после вставки: ожидание на уникальном индексе может длиться всё оформление
+        # первого запроса и должно закончиться IntegrityError и повтором заказа, а не отказом по таймауту
+        self._set_lock_timeout()
+        cart_items = list(CartItems.objects.select_for_update().filter(cart__user=self.user).order_by("product_id"))
 
         if not cart_items:
             raise ValidationError("empty cart")
 
         products_processor = InternalOrderItemsService(cart_items, order=self.order)
+        products_processor.lock_products()
         user_balance = UserBalance.objects.select_for_update().get(user=self.user)
-        Product.objects.select_for_update().filter(cartitems__cart__user=self.user)
-        order_items, updated_products = products_processor.validate_quantity()
+        order_items, decrements = products_processor.validate_quantity()
         order_sum = products_processor.count_total_sum(order_items)
-        if user_balance.balance >= order_sum:
-            user_balance.balance -= order_sum
-            Product.objects.bulk_update(updated_products, ["available_quantity"])
-            user_balance.save()
-            OrderItems.objects.bulk_create(order_items)
-            cart_items.delete()
-            self.order.total_sum = Decimal(order_sum)
-            self.order.save()
-            self.payment_processor.create_balance_history(self.user, order_sum)
-            order_fully_created.send(sender=None, user=self.user, order_items=order_items, total_sum=order_sum)
-            return self.order
-
-        raise ValidationError("not enough money")
+        if user_balance.balance < order_sum:
+            raise ValidationError("not enough money")
+
+        products_processor.decrement_stock(decrements)
+        ProductDetailCacheService.invalidate(*decrements)
+        user_balance.balance -= order_sum
+        user_balance.save(update_fields=["balance"])
+        OrderItems.objects.bulk_create(order_items)
+        CartItems.objects.filter(id__in=[item.id for item in cart_items]).delete()
+        self.order.total_sum = Decimal(order_sum)
+        self.order.save(update_fields=["total_sum"])
+        self.payment_processor.create_balance_history(self.user, order_sum)
+        order_id = self.order.id
+        # статистика и дневные агрегаты - по строке на горячий товар; обновляются фоном после коммита,
+        # чтобы оформления не выстраивались в очередь на этих строках
+        transaction.on_commit(lambda: register_order_sales.delay(order_id))
+        order_fully_created.send(sender=None, user=self.user, order_items=order_items, total_sum=order_sum)
+        return self.order
+
+    @staticmethod
+    def _set_lock_timeout() -> None:
+        """
+        Ограничивает ожидание блокировок строк товаров: при горячем товаре оформление быстрее получит отказ,
+        чем будет ждать в очереди. Действует до конца текущей транзакции.
+        """
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL lock_timeout = %s", [settings.CHECKOUT_LOCK_TIMEOUT])
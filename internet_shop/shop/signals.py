@@ -1,14 +1,29 @@
 from decimal import Decimal
 
-from django.db.models.signals import post_save
+from django.db import connections, transaction
+from django.db.models.signals import post_delete, post_save, pre_migrate
 from django.dispatch import Signal, receiver
 
-from .models import User, UserBalance
-from .tasks import send_email
+from .categories import CategoryTreeService
+from .models import Product, ProductCategory, ProductStatistics, User, UserBalance
+from .search import ProductSearchDocumentService
+from .tasks import refresh_category_search_documents, send_email
 
 order_fully_created = Signal()
 
 
+@receiver(pre_migrate)
+def create_trigram_extension(sender, using, **kwargs):
+    # триграммные индексы товаров (gin_trgm_ops) требуют pg_trgm, а миграции в репозитории не хранятся,
+    # поэтому расширение создаётся здесь, как это сделала бы операция TrigramExtension
+    if sender.name != "shop":
+        return
+    connection = connections[using]
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+
 @receiver(post_save, sender=User)
 def send_email_on_register(sender, instance, created, **kwargs):
     if created:
@@ -19,6 +34,39 @@ def send_email_on_register(sender, instance, created, **kwargs):
         send_email.delay(subject=subject, message=message, recipient=recipient)
 
 
+@receiver(post_save, sender=Product)
+def create_product_statistics(sender, instance, created, **kwargs):
+    if created:
+        ProductStatistics.objects.get_or_create(product=instance)
+
+
+@receiver(post_save, sender=Product)
+def refresh_product_search_document(sender, instance, created, update_fields=None, **kwargs):
+    # остатки, цены и доступность сохраняются намного чаще имени и описания: документ пересчитывается,
+    # только если сохранение могло затронуть поля поиска и они отличаются от загруженных
+    if not created:
+        if update_fields is not None and not {"name", "description", "category", "category_id"} & set(update_fields):
+            return
+        if getattr(instance, "search_source", None) == instance.get_search_source():
+            return
+    ProductSearchDocumentService.refresh_products([instance.id])
+    instance.search_source = instance.get_search_source()
+    # документ в памяти устарел: отложенное поле следующий save() не запишет поверх пересчитанного
+    instance.__dict__.pop("search_document", None)
+
+
+@receiver(post_save, sender=ProductCategory)
+def refresh_category_products_search_documents(sender, instance, created, **kwargs):
+    if not created:
+        transaction.on_commit(lambda: refresh_category_search_documents.delay(instance.id))
+
+
+@receiver(post_save, sender=ProductCategory)
+@receiver(post_delete, sender=ProductCategory)
+def invalidate_category_tree(sender, instance, **kwargs):
+    CategoryTreeService.invalidate()
+
+
 @receiver(order_fully_created)
 def send_email_after_order(sender, order_items, user, total_sum, **kwargs):
     subject = f"Спасибо за заказ, {user.username}!"
@@ -0,0 +1,134 @@
+from django.db import connection, transaction
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Product, ProductStockShard
+
+
+class StockShardService:
+    """
+    Шардированный остаток горячих товаров. Остаток товара со stock_shards > 0 делится на N строк
+    ProductStockShard: оформление списывает со случайного шарда с достаточным остатком через SKIP LOCKED
+    и не блокирует строку товара, поэтому параллельные оформления одного товара не ждут друг друга.
+    Для такого товара шарды - источник истины, Product.available_quantity периодически сверяется
+    с их суммой (reconcile) и для чтения может отставать на интервал сверки.
+    """
+
+    @classmethod
+    @transaction.atomic
+    def enable(cls, product_id: int, shards: int) -> Product:
+        """
+        Включает шардирование (или меняет число шардов): текущий остаток делится между шардами поровну.
+        shards=0 возвращает остаток в Product.available_quantity и выключает режим.
+        """
+        # FOR NO KEY UPDATE, как в lock_stock: оформление, уже держащее шард, вставляет позиции заказа
+        # с проверкой внешнего ключа (FOR KEY SHARE на товар) и не должно ждать эту блокировку
+        product = Product.objects.select_for_update(no_key=True).get(id=product_id)
+        if product.stock_shards:
+            product.available_quantity = sum(shard.quantity for shard in cls._lock_shards(product_id))
+            ProductStockShard.objects.filter(product_id=product_id).delete()
+        if shards:
+            ProductStockShard.objects.bulk_create(
+                [
+                    ProductStockShard(product_id=product_id, number=number, quantity=quantity)
+                    for number, quantity in enumerate(cls.split(product.available_quantity, shards))
+                ]
+            )
+        product.stock_shards = shards
+        product.save(update_fields=["stock_shards", "available_quantity"])
+        return product
+
+    @classmethod
+    @transaction.atomic
+    def set_stock(cls, product_id: int, quantity: int) -> None:
+        """
+        Задаёт общий остаток шардированного товара, распределяя его между шардами заново.
+        """
+        shards = cls._lock_shards(product_id)
+        for shard, shard_quantity in zip(shards, cls.split(quantity, len(shards))):
+            shard.quantity = shard_quantity
+        ProductStockShard.objects.bulk_update(shards, ["quantity"])
+        Product.objects.filter(id=product_id).update(available_quantity=quantity)
+
+    @staticmethod
+    def split(quantity: int, shards: int) -> list[int]:
+        base, rest = divmod(quantity, shards)
+        return [base + (number < rest) for number in range(shards)]
+
+    @classmethod
+    def take(cls, product_id: int, quantity: int) -> int:
+        """
+        Списывает до quantity единиц и возвращает списанное количество. Сначала пробует один случайный
+        незанятый шард, где хватает остатка; если такого нет, блокирует все шарды товара по порядку номеров
+        и собирает количество из нескольких. Должен выполняться внутри транзакции оформления.
+        """
+        table = connection.ops.quote_name(ProductStockShard._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET quantity = quantity - %s WHERE id = ("
+                f"SELECT id FROM {table} WHERE product_id = %s AND quantity >= %s "
+                f"ORDER BY random() LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING id",
+                [quantity, product_id, quantity],
+            )
+            if cursor.fetchone():
+                return quantity
+
+        taken = 0
+        changed = []
+        for shard in cls._lock_shards(product_id):
+            part = min(shard.quantity, quantity - taken)
+            if part:
+                shard.quantity -= part
+                taken += part
+                changed.append(shard)
+            if taken == quantity:
+                break
+        ProductStockShard.objects.bulk_update(changed, ["quantity"])
+        return taken
+
+    @staticmethod
+    def give_back(product_id: int, quantity: int) -> None:
+        """
+        Возвращает остаток в наименее заполненный незанятый шард, а если все заняты - в шард с номером 0.
+        """
+        table = connection.ops.quote_name(ProductStockShard._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET quantity = quantity + %s WHERE id = ("
+                f"SELECT id FROM {table} WHERE product_id = %s "
+                f"ORDER BY quantity LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING id",
+                [quantity, product_id],
+            )
+            if cursor.fetchone():
+                return
+            cursor.execute(
+                f"UPDATE {table} SET quantity = quantity + %s WHERE product_id = %s AND number = 0",
+                [quantity, product_id],
+            )
+
+    @staticmethod
+    def reconcile() -> list[int]:
+        """
+        Записывает в Product.available_quantity сумму шардов для товаров, где она разошлась.
+        Возвращает id обновлённых товаров.
+        """
+        total = Subquery(
+            ProductStockShard.objects.filter(product_id=OuterRef("id"))
+            .order_by()
+            .values("product_id")
+            .annotate(total=Sum("quantity"))
+            .values("total")
+        )
+        stale = list(
+            Product.objects.filter(stock_shards__gt=0)
+            .exclude(available_quantity=Coalesce(total, 0))
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        if stale:
+            Product.objects.filter(id__in=stale).update(available_quantity=Coalesce(total, 0))
+        return stale
+
+    @staticmethod
+    def _lock_shards(product_id: int) -> list[ProductStockShard]:
+        return list(ProductStockShard.objects.select_for_update().filter(product_id=product_id).order_by("number"))
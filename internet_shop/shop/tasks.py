@@ -1,7 +1,70 @@
 from celery import shared_task
 from django.core.mail import send_mail
+from django.db import transaction
+
+from .search import ProductSearchDocumentService
+from .stock import StockShardService
 
 
 @shared_task
 def send_email(subject, message, recipient):
     send_mail(subject=subject, message=message, from_email=None, recipient_list=recipient, fail_silently=False)
+
+
+@shared_task
+def import_products_file(job_id):
+    from .services import ProductImportJobService
+
+    ProductImportJobService.run(job_id)
+
+
+@shared_task
+def refresh_category_search_documents(category_id):
+    ProductSearchDocumentService.refresh_category(category_id)
+
+
+@shared_task
+def generate_sales_report(job_id):
+    from .reports import SalesReportService
+
+    SalesReportService.run(job_id)
+
+
+@shared_task
+def release_expired_reservations():
+    from .services import StockReservationService
+
+    return StockReservationService.release_expired()
+
+
+@shared_task
+def reconcile_stock_shards():
+    from .services import ProductDetailCacheService
+
+    product_ids = StockShardService.reconcile()
+    ProductDetailCacheService.invalidate(*product_ids)
+    return len(product_ids)
+
+
+@shared_task
+def reconcile_carts(batch_size=50000):
+    from .carts import CartReconciliationService
+
+    return sum(
+        CartReconciliationService.reconcile(start_id, start_id + batch_size)
+        for start_id in CartReconciliationService.batches(batch_size)
+    )
+
+
+@shared_task
+def register_order_sales(order_id):
+    from .models import Order, OrderItems
+    from .services import ProductStatisticsService, SalesRollupService
+
+    with transaction.atomic():
+        # флаг снимается в той же транзакции, что и инкременты: повторная доставка задачи
+        # не найдёт заказ и не учтёт его продажи второй раз, а откат вернёт заказ в очередь
+        if not Order.objects.filter(id=order_id, sales_pending=True).update(sales_pending=False):
+            return
+        ProductStatisticsService.register_sales(list(OrderItems.objects.filter(order_id=order_id)))
+        SalesRollupService.register_order(order_id)
@@ -1,3 +1,63 @@
+import io
+
 from django.test import TestCase
 
-# Create your tests here.
+from .models import Product, ProductCategory
+from .services import (
+    CsvFileProcessor,
+    StreamingProductFileProcessor,
+    UpsertProductFileProcessor,
+)
+
+
+class StreamingProductFileProcessorTest(TestCase):
+    def setUp(self):
+        ProductCategory.objects.create(name="Телефоны")
+
+    def test_rows_breaking_field_constraints_are_rejected(self):
+        rows = [
+            "name,category,old_price,discount,available_quantity,description",
+            "Телефон 1,Телефоны,100,10,5,",
+            f"{'x' * 101},Телефоны,100,10,5,",
+            "Телефон 2,Телефоны,100,10,-1,",
+            "Телефон 3,Телефоны,100,-5,1,",
+            "Телефон 4,Телефоны,100000000000,0,1,",
+            "Телефон 5,Телефоны,200,0,1,",
+        ]
+        file = io.BytesIO("\n".join(rows).encode())
+
+        report = StreamingProductFileProcessor(CsvFileProcessor(), file, chunk_size=100).create_products()
+
+        self.assertEqual(report["rows_total"], 6)
+        self.assertEqual(report["rows_created"], 2)
+        self.assertEqual(report["rows_rejected"], 4)
+        self.assertEqual(
+            sorted(Product.objects.values_list("name", "price")),
+            [("Телефон 1", 90), ("Телефон 5", 200)],
+        )
+
+
+class UpsertProductFileProcessorTest(TestCase):
+    def setUp(self):
+        category = ProductCategory.objects.create(name="Телефоны")
+        self.hidden = Product.objects.create(
+            category=category, name="Скрытый", old_price=100, discount=0, price=100, available=False, external_id="a"
+        )
+
+    def test_duplicates_are_rejected_and_manual_availability_is_kept(self):
+        rows = [
+            "external_id,name,category,old_price,discount,available_quantity",
+            "a,Скрытый,Телефоны,100,0,3",
+            "b,Новый,Телефоны,50,0,1",
+            "b,Новый,Телефоны,60,0,2",
+        ]
+        file = io.BytesIO("\n".join(rows).encode())
+
+        report = UpsertProductFileProcessor(CsvFileProcessor(), file, chunk_size=100).create_products()
+
+        counters = ("rows_created", "rows_updated", "rows_unchanged", "rows_rejected")
+        self.assertEqual([report[counter] for counter in counters], [1, 1, 0, 1])
+        self.assertEqual(sum(report[counter] for counter in counters), report["rows_total"])
+        self.hidden.refresh_from_db()
+        self.assertEqual((self.hidden.available_quantity, self.hidden.available), (3, False))
+        self.assertEqual(Product.objects.get(external_id="b").old_price, 60)
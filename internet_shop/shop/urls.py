@@ -6,8 +6,10 @@ from .views import (
     ExternalOrderViewSet,
     OrderViewSet,
     ProductCategoryViewSet,
+    ProductImportJobViewSet,
     ProductViewSet,
     ReviewCommentViewSet,
+    SalesReportJobViewSet,
     SalesStatisticsViewSet,
     UserBalanceViewSet,
     UserRegistrationViewSet,
@@ -28,6 +30,10 @@ user_balance_router = routers.DefaultRouter()
 user_balance_router.register(r"", UserBalanceViewSet, basename="balance")
 external_order_router = routers.DefaultRouter()
 external_order_router.register(r"", ExternalOrderViewSet, basename="external-orders")
+product_import_router = routers.DefaultRouter()
+product_import_router.register(r"", ProductImportJobViewSet, basename="product-import")
+sales_report_router = routers.DefaultRouter()
+sales_report_router.register(r"", SalesReportJobViewSet, basename="sales-reports")
 review_comment_router = routers.DefaultRouter()
 review_comment_router.register(r"", ReviewCommentViewSet, basename="reviews-comments")
 
@@ -39,6 +45,7 @@ urlpatterns = [
         ProductViewSet.as_view({"get": "comments"}),
         name="product-comments",
     ),
+    path("product_import/", include(product_import_router.urls)),
     path("product_category/", include(category_router.urls)),
     path("cart/", include(cart_router.urls)),
     path("orders/", include(order_router.urls)),
@@ -48,4 +55,5 @@ urlpatterns = [
     path("delete_attribute/", delete_attribute),
     path("review-comment/", include(review_comment_router.urls)),
     path("sales/statistics/", SalesStatisticsViewSet.as_view(), name="sales-statistics"),
+    path("sales/reports/", include(sales_report_router.urls)),
 ]
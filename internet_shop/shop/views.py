@@ -1,21 +1,12 @@
 import json
 import logging
 from decimal import Decimal
+from pathlib import Path
 
 from django.core.exceptions import ValidationError
-from django.db.models import (
-    Avg,
-    Count,
-    ExpressionWrapper,
-    F,
-    IntegerField,
-    Prefetch,
-    Q,
-    Sum,
-    Window,
-)
+from django.db.models import Avg, F, Window
 from django.db.models.functions import Coalesce
-from django.shortcuts import get_object_or_404
+from django.http import FileResponse
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status
 from rest_framework.decorators import action, api_view
@@ -26,45 +17,69 @@ from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
+from .carts import CartStoreFactory
+from .categories import CategoryTreeService
 from .filters import ProductFilter, SalesStatisticsFilter, SalesStatisticsQueryBuilder
-from .mixins import ModelViewMixin
+from .mixins import KeysetPaginationMixin, ModelViewMixin, StreamingResponseMixin
 from .models import (
     Cart,
-    CartItems,
     Order,
     Product,
     ProductCategory,
+    ProductImportJob,
     ReviewComment,
+    SalesReportJob,
     User,
     UserBalance,
     UserBalanceHistory,
 )
-from .pagination import ReviewPagination
+from .pagination import (
+    ProductKeysetPagination,
+    ReviewKeysetPagination,
+    ReviewPagination,
+)
+from .reports import SalesReportService
 from .serializers import (
+    CartBatchItemSerializer,
+    CartBatchSerializer,
+    CartProductSerializer,
     CartSerializer,
     CategorySerializer,
     OrderDetailSerializer,
     OrderSerializer,
+    ProductImportJobSerializer,
     ProductListSerializer,
+    ProductListValuesSerializer,
     ProductSerializer,
+    ReviewIngestSerializer,
     RootReviewSerializer,
+    SalesReportJobSerializer,
     SalesStatisticsSerializer,
+    SerializedRows,
+    StockReservationBatchSerializer,
+    StockReservationOrdersSerializer,
     UserBalanceHistorySerializer,
     UserBalanceSerializer,
     UserRegistrationSerializer,
 )
 from .services import (
     AttributeService,
-    CartItemsService,
     DepositProcessor,
-    ExternalOrderItemsService,
+    FacetService,
     FileProcessorFactory,
     OrderService,
     PaymentProcessor,
     ProductAttributeService,
+    ProductDetailCacheService,
     ProductFileProcessor,
+    ProductImportJobService,
     ProductService,
     ReviewCreateService,
+    ReviewIngestService,
+    ReviewThreadService,
+    StockReservationService,
+    StreamingProductFileProcessor,
+    UpsertProductFileProcessor,
 )
 
 logger = logging.getLogger(__name__)
@@ -100,27 +115,71 @@ class ReviewCommentViewSet(CreateModelMixin, GenericViewSet):
     @action(detail=False, methods=["POST"])
     def create_comment(self, request):
         user = self.request.user
-        product = Product.objects.get(id=request.data.get("product_id"))
         text = request.data.get("text")
         parent = request.data.get("parent")
-        ReviewComment.objects.create(user=user, product=product, text=text, parent=ReviewComment.objects.get(id=parent))
+        service = ReviewCreateService(product_id=request.data.get("product_id"), user=user)
+        service.create_comment(text=text, parent_id=parent)
         return Response("comment successfully create", status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=["POST"], permission_classes=[IsAdminUser], serializer_class=ReviewIngestSerializer)
+    def ingest(self, request):
+        """
+        Пакетная загрузка отзывов и ответов (импорт с внешних площадок): дерево пересчитывается один раз на пакет.
+        """
+        serializer = ReviewIngestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        comments = []
+        by_ref = {}
+        for item in serializer.validated_data["comments"]:
+            comment = ReviewComment(
+                product_id=item["product_id"],
+                user_id=item["user_id"],
+                text=item.get("text"),
+                rating=item.get("rating"),
+                created_at=item.get("created_at"),
+                parent_id=item.get("parent_id"),
+            )
+            comments.append((comment, item.get("parent_ref")))
+            if "ref" in item:
+                by_ref[item["ref"]] = comment
+        for comment, parent_ref in comments:
+            if parent_ref is not None:
+                comment.parent = by_ref[parent_ref]
+        created = ReviewIngestService().ingest([comment for comment, _ in comments])
+        return Response({"created": [comment.id for comment in created]}, status=status.HTTP_201_CREATED)
+
 
 class ExternalOrderViewSet(GenericViewSet):
+    """
+    Резервирование остатков под заказы внешних площадок. reserve принимает пакет заказов и возвращает
+    результат по каждой строке; confirm закрепляет резервы, release и истечение срока возвращают их на склад.
+    """
+
     permission_classes = [IsAuthenticated]
-    serializer_class = OrderSerializer
+    serializer_class = StockReservationBatchSerializer
 
-    @action(detail=False, methods=["GET"])
-    def order(self, request):
-        match request.method:
-            case "GET":
-                try:
-                    order_service = ExternalOrderItemsService(request.data.get("order_data"))
-                    order_service.validate_quantity()
-                    return Response({"status: successfully reduced product stock"}, status=status.HTTP_200_OK)
-                except ValidationError as e:
-                    return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    @action(detail=False, methods=["POST"])
+    def reserve(self, request):
+        serializer = StockReservationBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        service = StockReservationService(
+            request.user, serializer.validated_data["orders"], ttl=serializer.validated_data.get("ttl")
+        )
+        return Response(service.reserve(), status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=["POST"], serializer_class=StockReservationOrdersSerializer)
+    def confirm(self, request):
+        serializer = StockReservationOrdersSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        confirmed = StockReservationService.confirm(request.user, serializer.validated_data["external_order_ids"])
+        return Response({"confirmed": confirmed}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=["POST"], serializer_class=StockReservationOrdersSerializer)
+    def release(self, request):
+        serializer = StockReservationOrdersSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        released = StockReservationService.release(request.user, serializer.validated_data["external_order_ids"])
+        return Response({"released": released}, status=status.HTTP_200_OK)
 
 
 class UserBalanceViewSet(RetrieveModelMixin, GenericViewSet):
@@ -162,27 +221,79 @@ class UserRegistrationViewSet(CreateModelMixin, GenericViewSet):
     }
 
 
-class SalesStatisticsViewSet(ListAPIView):
+class SalesStatisticsViewSet(StreamingResponseMixin, ListAPIView):
     serializer_class = SalesStatisticsSerializer
     permission_classes = [IsAdminUser]
     filter_backends = [DjangoFilterBackend]
-    filterset_class = SalesStatisticsFilter
+
+    @property
+    def filterset_class(self):
+        query_builder = getattr(self, "query_builder", None)
+        return query_builder.filterset_class if query_builder else SalesStatisticsFilter
 
     def get_queryset(self):
         params = self.request.query_params
-        query_builder = SalesStatisticsQueryBuilder(params)
-        return query_builder.get_queryset()
+        self.query_builder = SalesStatisticsQueryBuilder(params)
+        return self.query_builder.get_queryset()
+
+    def list(self, request, *args, **kwargs):
+        stream_format = self.get_stream_format()
+        if stream_format:
+            return self.streaming_response(self.filter_queryset(self.get_queryset()), stream_format)
+        return super().list(request, *args, **kwargs)
+
+
+class SalesReportJobViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet):
+    serializer_class = SalesReportJobSerializer
+    permission_classes = [IsAdminUser]
+    queryset = SalesReportJob.objects.order_by("-id")
+
+    def create(self, request, *args, **kwargs):
+        job = SalesReportService.enqueue(
+            request.query_params, request.data.get("format", SalesReportJob.Format.CSV), user=request.user
+        )
+        return Response(self.get_serializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+    @action(methods=["GET"], detail=True)
+    def download(self, request, pk=None):
+        job = self.get_object()
+        if job.state != SalesReportJob.State.SUCCEEDED:
+            return Response({"error": f"отчёт не готов: {job.state}"}, status=status.HTTP_409_CONFLICT)
+        return FileResponse(open(job.file_path, "rb"), as_attachment=True, filename=Path(job.file_path).name)
 
 
 class ProductCategoryViewSet(CreateModelMixin, GenericViewSet, RetrieveModelMixin, ListModelMixin):
     queryset = ProductCategory.objects.all()
     serializer_class = CategorySerializer
+    # retrieve ищет узел в кэше дерева по int(pk): нечисловой pk должен отсекаться маршрутом с 404
+    lookup_value_regex = r"\d+"
 
     def retrieve(self, request, *args, **kwargs):
-        pass
+        node = CategoryTreeService.get_node(int(kwargs["pk"]))
+        if node is None:
+            return Response({"error": "no such category"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(node, status=status.HTTP_200_OK)
 
+    @action(methods=["GET"], detail=False)
+    def tree(self, request):
+        return Response(CategoryTreeService.get_tree(), status=status.HTTP_200_OK)
 
-class ProductViewSet(ModelViewMixin, RetrieveModelMixin, CreateModelMixin, ListModelMixin, GenericViewSet):
+
+class ProductImportJobViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet):
+    serializer_class = ProductImportJobSerializer
+    permission_classes = [IsAdminUser]
+    queryset = ProductImportJob.objects.order_by("-id")
+
+
+class ProductViewSet(
+    ModelViewMixin,
+    KeysetPaginationMixin,
+    StreamingResponseMixin,
+    RetrieveModelMixin,
+    CreateModelMixin,
+    ListModelMixin,
+    GenericViewSet,
+):
     serializer_class = ProductListSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_class = ProductFilter
@@ -195,34 +306,23 @@ class ProductViewSet(ModelViewMixin, RetrieveModelMixin, CreateModelMixin, ListM
         "get_nested_comments": RootReviewSerializer,
     }
     pagination_class = ReviewPagination
+    keyset_pagination_classes = {
+        "list": ProductKeysetPagination,
+        "retrieve": ReviewKeysetPagination,
+    }
 
     def get_object(self):
-        product = Product.objects.prefetch_related(
-            Prefetch(
-                "reviews",
-                queryset=ReviewComment.objects.filter(parent__isnull=True)
-                .order_by("created_at")
-                .select_related("user"),
-            ),
-            Prefetch("reviews__children", queryset=ReviewComment.objects.select_related("user")),
-        ).get(id=self.kwargs["pk"])
-        return product
+        return Product.objects.get(id=self.kwargs["pk"])
 
     def get_queryset(self):
         queryset = self.queryset
 
         match self.action:
             case "list":
-                queryset = Product.objects.select_related("category").annotate(
-                    average_rating=Avg("reviews__rating"),
-                    rating_count=Count("reviews__rating"),
-                    _popularity_review_count=Count("reviews", filter=Q(reviews__parent=None)),
-                    _comment_count=Count("reviews", filter=Q(reviews__parent__isnull=False)),
-                    _popularity_sales_count=Coalesce(Sum("orders__items__quantity"), 0),
-                    popularity=ExpressionWrapper(
-                        F("_popularity_sales_count") + F("_comment_count") * F("_popularity_review_count"),
-                        output_field=IntegerField(),
-                    ),
+                queryset = Product.objects.select_related("category", "stats").annotate(
+                    average_rating=F("stats__average_rating"),
+                    rating_count=Coalesce(F("stats__rating_count"), 0),
+                    popularity=Coalesce(F("stats__popularity"), 0),
                 )
             case "filter_by_average_price":
                 queryset = Product.objects.annotate(
@@ -231,26 +331,43 @@ class ProductViewSet(ModelViewMixin, RetrieveModelMixin, CreateModelMixin, ListM
 
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        if self.get_pagination_class() is not self.pagination_class:
+            return super().list(request, *args, **kwargs)
+        products = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(SerializedRows(products, ProductListValuesSerializer()))
+        return self.get_paginated_response(page)
+
     def retrieve(self, request, *args, **kwargs):
+        # кэшируется только ответ по умолчанию: карточка с первой страницей отзывов
+        cache_key = None
+        if not request.query_params:
+            cache_key = ProductDetailCacheService.get_key(kwargs["pk"], request.get_host())
+            cached = ProductDetailCacheService.get(cache_key)
+            if cached is not None:
+                return Response(cached, status=status.HTTP_200_OK)
+
         product = self.get_object()
-        queryset = (
-            product.reviews.filter(parent__isnull=True)
-            .select_related("user")
-            .prefetch_related(Prefetch("children", queryset=ReviewComment.objects.select_related("user")))
-            .order_by("created_at")
-        )
-        paginator = self.pagination_class()
+        queryset = product.reviews.filter(parent__isnull=True).select_related("user").order_by("created_at")
+        thread = ReviewThreadService(request.query_params)
+        paginator = self.get_pagination_class()()
         page = paginator.paginate_queryset(queryset, request)
         if page is not None:
-            reviews_data = RootReviewSerializer(page, many=True).data
+            reviews_data = RootReviewSerializer(thread.load(page), many=True).data
             reviews_paginated = paginator.get_paginated_response(reviews_data).data
         else:
-            reviews_paginated = RootReviewSerializer(queryset, many=True).data
+            reviews_paginated = RootReviewSerializer(thread.load(queryset), many=True).data
         product_data = ProductSerializer(product).data
         product_data["reviews"] = reviews_paginated
+        if cache_key is not None:
+            ProductDetailCacheService.set(cache_key, product_data)
 
         return Response(product_data, status=status.HTTP_200_OK)
 
+    @action(methods=["GET"], detail=False, permission_classes=[IsAdminUser])
+    def cache_metrics(self, request):
+        return Response(ProductDetailCacheService.get_metrics(), status=status.HTTP_200_OK)
+
     @staticmethod
     def attrs_handler(attrs, product_id):
         attrs = AttributeService(attributes=attrs).resolve_attributes()
@@ -261,42 +378,38 @@ class ProductViewSet(ModelViewMixin, RetrieveModelMixin, CreateModelMixin, ListM
     @action(methods=["GET"], detail=False)
     def filter_by_average_price(self, request):
         products = self.get_queryset()
+        if stream_format := self.get_stream_format():
+            # ProductListSerializer читает category.name: без select_related поток делал бы запрос на строку
+            return self.streaming_response(products.select_related("category"), stream_format)
         self.pagination_class = None
-        return Response(self.get_serializer(products, many=True).data, status=status.HTTP_200_OK)
+        return Response(ProductListValuesSerializer().serialize(products), status=status.HTTP_200_OK)
+
+    @action(methods=["GET"], detail=False)
+    def facets(self, request):
+        products = self.filter_queryset(self.get_queryset())
+        return Response(FacetService(products, request.query_params).get_facets(), status=status.HTTP_200_OK)
 
     @action(methods=["GET"], detail=False, url_path="category/(?P<category_id>\\d+)")
     def filter_by_category(self, request, category_id=None):
-        root_category = ProductCategory.objects.get(id=category_id)
-        descendants = root_category.get_descendants(include_self=True)
+        descendant_ids = CategoryTreeService.get_descendant_ids(int(category_id))
+        if descendant_ids is None:
+            return Response({"error": "no such category"}, status=status.HTTP_404_NOT_FOUND)
         products = (
             self.get_queryset()
-            .filter(category__in=descendants)
+            .filter(category_id__in=descendant_ids)
             .select_related("category")
             .prefetch_related("eav_values__attribute")
         )
+        if stream_format := self.get_stream_format():
+            return self.streaming_response(products, stream_format)
         serialized_products = self.get_serializer(products, many=True).data
         return Response(serialized_products, status=status.HTTP_200_OK)
 
     @action(methods=["GET"], detail=True, url_path="comments/(?P<comment_id>\\d+)")
     def get_nested_comments(self, request, pk=None, comment_id=None):
         try:
-            root_comment = ReviewComment.objects.get(id=comment_id, product_id=pk)
-            descendants = root_comment.get_descendants(include_self=True).select_related("user")
-
-            comment_dict = {comment.id: comment for comment in descendants}
-
-            for comment in comment_dict.values():
-                comment.children_list = []
-
-            root_comments = []
-
-            for comment in comment_dict.values():
-                if comment.parent_id and comment.parent_id in comment_dict:
-                    parent_comment = comment_dict[comment.parent_id]
-                    parent_comment.children_list.append(comment)
-                else:
-                    root_comments.append(comment)
-
+            root_comment = ReviewComment.objects.select_related("user").get(id=comment_id, product_id=pk)
+            root_comments = ReviewThreadService(request.query_params).load([root_comment])
             serializer = RootReviewSerializer(root_comments, many=True).data
             return Response(serializer, status=status.HTTP_200_OK)
 
@@ -309,7 +422,39 @@ class ProductViewSet(ModelViewMixin, RetrieveModelMixin, CreateModelMixin, ListM
         if not file:
             return Response({"error": "Файл не загружен"}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            file_processor = FileProcessorFactory.get_processor(file.name)
+            mode = request.data.get("mode")
+            file_processor = FileProcessorFactory.get_processor(
+                file.name, streaming=mode in ("background", "background_upsert", "stream", "upsert")
+            )
+            chunk_size = int(request.data.get("chunk_size", 10000))
+            if chunk_size < 1:
+                raise ValueError("chunk_size должен быть не меньше 1")
+            match mode:
+                case "background" | "background_upsert":
+                    job = ProductImportJobService.enqueue(
+                        file=file,
+                        user=request.user,
+                        chunk_size=chunk_size,
+                        mode=(
+                            ProductImportJob.Mode.UPSERT
+                            if mode == "background_upsert"
+                            else ProductImportJob.Mode.INSERT
+                        ),
+                    )
+                    return Response(ProductImportJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+                case "stream":
+                    product_processor = StreamingProductFileProcessor(
+                        file_processor=file_processor,
+                        file=file,
+                        chunk_size=chunk_size,
+                        use_copy=request.data.get("use_copy") == "true",
+                    )
+                    return Response(product_processor.create_products(), status=status.HTTP_200_OK)
+                case "upsert":
+                    product_processor = UpsertProductFileProcessor(
+                        file_processor=file_processor, file=file, chunk_size=chunk_size
+                    )
+                    return Response(product_processor.create_products(), status=status.HTTP_200_OK)
             product_processor = ProductFileProcessor(file_processor=file_processor, file=file)
             product_processor.create_products()
             return Response("new products created", status=status.HTTP_200_OK)
@@ -358,81 +503,59 @@ class ProductViewSet(ModelViewMixin, RetrieveModelMixin, CreateModelMixin, ListM
         if name:
             products = products.filter(name__icontains=name)
 
-        serializer = self.get_serializer(products, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        if stream_format := self.get_stream_format():
+            return self.streaming_response(products.select_related("category"), stream_format)
+        return Response(ProductListValuesSerializer().serialize(products), status=status.HTTP_200_OK)
 
 
 class CartViewSet(GenericViewSet, RetrieveModelMixin, CreateModelMixin, ListModelMixin):
+    """
+    Корзина текущего пользователя. Операции идут через хранилище из CART_BACKEND
+    и возвращают корзину целиком одним обращением к хранилищу.
+    """
+
     permission_classes = [IsAuthenticated]
     serializer_class = CartSerializer
 
     def get_queryset(self):
-        user_cart, created = Cart.objects.get_or_create(user=self.request.user)
-        if created:
-            return user_cart
-        return Cart.objects.prefetch_related("items__product").get(id=user_cart.id)
+        return Cart.objects.filter(user=self.request.user)
 
     def list(self, request, *args, **kwargs):
-        cart = self.get_queryset()
-        serializer = CartSerializer(cart)
-        return Response(serializer.data)
+        return Response(CartStoreFactory.get_store().get(request.user))
 
     def retrieve(self, request, pk=None, *args, **kwargs):
-        cart = self.get_queryset()
-        prod_quant_dct = {}
-        for i in CartSerializer(cart).data["items"]:
-            if i["quantity"] > i["product_available_quantity"]:
-                prod_quant_dct.setdefault(i["product_id"], i["product_available_quantity"])
-
-        for product in prod_quant_dct:
-            cart_item = CartItems.objects.get(cart=cart, product=product)
-            cart_item.quantity = prod_quant_dct[product]
-            cart_item.save()
-        serializer = CartSerializer(cart)
-        return Response(serializer.data)
+        return Response(CartStoreFactory.get_store().clamp(request.user))
 
     @action(detail=False, methods=["POST", "PATCH", "DELETE"])
     def item(self, request):
-        cart = self.get_queryset()
-        product = get_object_or_404(Product, pk=request.data.get("product_id"))
-        requested_quantity = int(request.data.get("quantity"))
-        match request.method:
-            case "POST":
-                try:
-                    validated_cart = CartItemsService.validate_quantity(
-                        requested_quantity=requested_quantity,
-                        cart=cart,
-                        product_id=product.id,
-                    )
-                    return Response(CartSerializer(validated_cart).data, status=status.HTTP_200_OK)
-                except ValueError:
-                    return Response({"error": "not enough product"}, status=status.HTTP_400_BAD_REQUEST)
-                except CartItems.DoesNotExist:
-                    CartItems.objects.create(cart=cart, product=product, quantity=1)
-                    validated_cart = CartItemsService.validate_quantity(
-                        requested_quantity=requested_quantity,
-                        cart=cart,
-                        product_id=product.id,
-                    )
-                    return Response(CartSerializer(validated_cart).data, status=status.HTTP_200_OK)
-
-            case "PATCH":
-                try:
-                    validated_cart = CartItemsService.validate_quantity(
-                        requested_quantity=requested_quantity,
-                        cart=cart,
-                        product_id=product.id,
-                    )
-                    return Response(CartSerializer(validated_cart).data, status=status.HTTP_200_OK)
-                except ValueError:
-                    return Response({"error": "not enough product"}, status=status.HTTP_400_BAD_REQUEST)
-
-            case "DELETE":
-                try:
-                    CartItems.objects.filter(cart=cart, product=product).delete()
-                    return Response(CartSerializer(cart).data, status=status.HTTP_200_OK)
-                except CartItems.DoesNotExist:
-                    return Response(CartSerializer(cart).data, status=status.HTTP_204_NO_CONTENT)
+        """
+        POST/PATCH задают количество товара в корзине (0 убирает позицию), DELETE убирает позицию.
+        """
+        store = CartStoreFactory.get_store()
+        serializer_class = CartProductSerializer if request.method == "DELETE" else CartBatchItemSerializer
+        serializer = serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        product_id = serializer.validated_data["product_id"]
+        quantity = serializer.validated_data.get("quantity", 0)
+        if quantity == 0:
+            return Response(store.remove_item(request.user, product_id), status=status.HTTP_200_OK)
+        try:
+            return Response(store.set_item(request.user, product_id, quantity), status=status.HTTP_200_OK)
+        except ValueError:
+            return Response({"error": "not enough product"}, status=status.HTTP_400_BAD_REQUEST)
+        except Product.DoesNotExist:
+            return Response({"error": "product not found"}, status=status.HTTP_404_NOT_FOUND)
+
+    @action(detail=False, methods=["POST"], serializer_class=CartBatchSerializer)
+    def items(self, request):
+        """
+        Пакетное добавление, изменение и удаление позиций: остатки проверяются одним запросом,
+        изменения применяются разом, в ответе - итоговая корзина и отклонённые позиции.
+        """
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        cart = CartStoreFactory.get_store().apply(request.user, serializer.validated_data["items"])
+        return Response(cart, status=status.HTTP_200_OK)
 
 
 class OrderViewSet(GenericViewSet, ModelViewMixin):
@@ -446,15 +569,28 @@ class OrderViewSet(GenericViewSet, ModelViewMixin):
     def get_queryset(self, **kwargs):
         return Order.objects.filter(user=self.request.user)
 
-    @action(detail=False, methods=["GET", "PATCH", "DELETE"])
+    @action(detail=False, methods=["POST", "PATCH", "DELETE"])
     def order(self, request):
+        """
+        POST оформляет заказ из корзины. Заголовок Idempotency-Key делает запрос безопасным для повторов:
+        заказ, уже оформленный с этим ключом, возвращается без повторного оформления.
+        """
         match request.method:
-            case "GET":
+            case "POST":
                 try:
                     payment_processor = PaymentProcessor()
-                    order_service = OrderService(self.request.user, payment_processor)
+                    order_service = OrderService(
+                        self.request.user, payment_processor, idempotency_key=request.headers.get("Idempotency-Key")
+                    )
+                    if order := order_service.get_existing_order():
+                        return Response(self.serializer_class(order).data, headers={"Idempotent-Replayed": "true"})
+                    cart_store = CartStoreFactory.get_store()
+                    cart_store.persist(request.user)
                     order = order_service.create_order()
-                    return Response(self.serializer_class(order).data)
+                    if order_service.replayed:
+                        return Response(self.serializer_class(order).data, headers={"Idempotent-Replayed": "true"})
+                    cart_store.clear(request.user)
+                    return Response(self.serializer_class(order).data, status=status.HTTP_201_CREATED)
                 except ValidationError as e:
                     return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 